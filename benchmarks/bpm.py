@@ -0,0 +1,106 @@
+"""Benchmark BPM detection throughput against track length and workers.
+
+Usage:
+    python benchmarks/bpm.py --lengths 60 600 3600 --workers 1 2 4 8
+"""
+
+import os
+import sys
+import json
+import time
+import wave
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mvgen.audio import get_bpm, get_bpm_parallel, ANALYSIS_RATE  # noqa: E402
+
+
+def make_track(path, seconds, bpm=128, fs=44100, chunk=60):
+    """Write a mono 16-bit click track of `seconds` length."""
+    rng = np.random.default_rng(0)
+    period = 60. / bpm
+
+    with wave.open(path, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(fs)
+
+        for start in np.arange(0, seconds, chunk):
+            t = np.arange(int(min(chunk, seconds - start) * fs)) / fs + start
+            x = np.exp(-(t % period) * 40) * np.sin(2 * np.pi * 80 * t)
+            x += 0.05 * rng.standard_normal(len(t))
+            file.writeframes((x * 16000).astype('<i2').tobytes())
+
+
+def run(lengths, workers, repeat):
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for seconds in lengths:
+            path = os.path.join(directory, f'{seconds}.wav')
+            make_track(path, seconds)
+
+            for n in workers:
+                for mode in ('wav', 'array'):
+                    if mode == 'array':
+                        samples, fs = _decoded(path)
+
+                    times = []
+                    for _ in range(repeat):
+                        started = time.perf_counter()
+                        if mode == 'wav':
+                            bpm = get_bpm(path, workers=n)
+                        else:
+                            bpm = get_bpm_parallel(samples, fs, workers=n)
+                        times.append(time.perf_counter() - started)
+
+                    result = {
+                        'mode': mode,
+                        'seconds': seconds,
+                        'workers': n,
+                        'bpm': float(bpm),
+                        'time': min(times),
+                        'throughput': seconds / min(times)
+                    }
+                    results.append(result)
+                    print(json.dumps(result), flush=True)
+
+    return results
+
+
+def _decoded(path):
+    """Downsample a track to the analysis rate, as `decode_audio` would."""
+    from scipy.signal import resample_poly
+    from mvgen.audio import WavFile
+
+    wav = WavFile(path)
+    samples = resample_poly(wav.mono().astype(np.float64), ANALYSIS_RATE, wav.fs)
+    return samples.astype(np.int16), ANALYSIS_RATE
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--lengths', type=float, nargs='*', default=[60, 600, 1800],
+        help='Track lengths in seconds.'
+    )
+    parser.add_argument(
+        '--workers', type=int, nargs='*', default=[1, 2, 4, os.cpu_count()],
+        help='Worker counts.'
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Path to JSON results file.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    results = run(args.lengths, sorted(set(args.workers)), args.repeat)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
@@ -0,0 +1,228 @@
+"""Benchmark every stage of `MVGen.run` on synthetic sources and audio.
+
+Sources and audio are generated with ffmpeg lavfi and kept in the fixtures
+directory, so repeated runs only pay for rendering.
+
+Usage:
+    python benchmarks/pipeline.py --library_sizes 4 16 --mix_lengths 30 120 \
+        --durations 0.5 1 2 --workers 1 4 --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mvgen.mvgen import MVGen, get_args  # noqa: E402
+
+STAGES = ('load_audio', 'generate', 'make_join_file', 'join', 'finalize')
+
+# (codec, extension, width, height, fps)
+SOURCE_FORMATS = [
+    ('libx264', 'mp4', 1280, 720, 30),
+    ('mpeg4', 'avi', 640, 360, 25),
+    ('libx264', 'mkv', 1920, 1080, 24),
+    ('mpeg2video', 'mpg', 720, 480, 30),
+]
+
+SOURCE_LENGTHS = (20, 45, 90)
+
+
+def ffmpeg(cmd):
+    subprocess.run(
+        f'ffmpeg -y -hide_banner -loglevel error {cmd}', shell=True, check=True
+    )
+
+
+def make_source(path, codec, width, height, fps, seconds):
+    ffmpeg(
+        f'-f lavfi -i testsrc2=size={width}x{height}:rate={fps}:duration={seconds} '
+        f'-f lavfi -i sine=frequency=440:duration={seconds} '
+        f'-c:v {codec} -c:a aac -shortest "{path}"'
+    )
+
+
+def make_audio(path, seconds):
+    """Beep every second over a low tone, i.e. 60 BPM."""
+    ffmpeg(
+        f'-f lavfi -i sine=frequency=220:beep_factor=4:duration={seconds} '
+        f'-c:a libmp3lame "{path}"'
+    )
+
+
+def make_library(fixtures, size):
+    """Return source name of a library of `size` synthetic videos."""
+    name = f'library_{size}'
+    directory = os.path.join(fixtures, 'sources', name)
+    os.makedirs(directory, exist_ok=True)
+
+    for i in range(size):
+        codec, ext, width, height, fps = SOURCE_FORMATS[i % len(SOURCE_FORMATS)]
+        seconds = SOURCE_LENGTHS[i % len(SOURCE_LENGTHS)]
+        path = os.path.join(directory, f'{i:04d}_{codec}_{width}x{height}.{ext}')
+        if not os.path.exists(path):
+            make_source(path, codec, width, height, fps, seconds)
+
+    return name
+
+
+def make_mix_audio(fixtures, seconds):
+    path = os.path.join(fixtures, 'audio', f'audio_{seconds:g}.mp3')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if not os.path.exists(path):
+        make_audio(path, seconds)
+
+    return path
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(config):
+    """Run `MVGen.run` stage by stage and return stage timings."""
+    times = {}
+
+    started = time.perf_counter()
+    gen = MVGen(**get_args(config, MVGen))
+    times['init'] = time.perf_counter() - started
+
+    for stage in STAGES:
+        function = getattr(MVGen, stage)
+        started = time.perf_counter()
+        getattr(gen, stage)(**get_args(config, function))
+        times[stage] = time.perf_counter() - started
+
+    times['total'] = sum(times.values())
+
+    return times, gen
+
+
+def run(args):
+    results = []
+    commit = git_commit()
+
+    fixtures = os.path.abspath(args.fixtures)
+    os.makedirs(fixtures, exist_ok=True)
+
+    matrix = itertools.product(
+        args.library_sizes, args.mix_lengths, args.durations, args.workers,
+        args.engines
+    )
+
+    for size, mix_length, duration, workers, engine in matrix:
+        source = make_library(fixtures, size)
+        audio = make_mix_audio(fixtures, mix_length)
+
+        for repeat in range(args.repeat):
+            work_directory = tempfile.mkdtemp(prefix='mvgen_bench_')
+            ready_directory = os.path.join(work_directory, 'ready')
+            os.makedirs(ready_directory)
+
+            config = {
+                'work_directory': work_directory,
+                'cache_directory': None if args.cold else os.path.join(fixtures, 'cache'),
+                'src_directory': os.path.join(fixtures, 'sources'),
+                'sources': [source],
+                'audio': audio,
+                'bpm': args.bpm,
+                'duration': duration,
+                'width': args.width,
+                'height': args.height,
+                'workers': workers,
+                'engine': engine,
+                'seed': repeat,
+                'ready_directory': ready_directory,
+                'delete_work_dir': True
+            }
+
+            try:
+                times, gen = run_once(config)
+                error = None
+            except Exception as e:
+                times, gen, error = {}, None, repr(e)
+
+            result = {
+                'commit': commit,
+                'library_size': size,
+                'mix_length': mix_length,
+                'duration': duration,
+                'workers': workers,
+                'engine': engine,
+                'repeat': repeat,
+                'cold_cache': args.cold,
+                'slots': len(gen.timeline['slots']) if gen is not None else None,
+                'times': times,
+                'error': error
+            }
+            results.append(result)
+            print(json.dumps(result), flush=True)
+
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--fixtures', default=os.path.join(tempfile.gettempdir(), 'mvgen_fixtures'),
+        help='Directory of generated sources, audio and warm caches.'
+    )
+    parser.add_argument(
+        '--library_sizes', type=int, nargs='*', default=[4, 16],
+        help='Numbers of source videos.'
+    )
+    parser.add_argument(
+        '--mix_lengths', type=float, nargs='*', default=[30, 120],
+        help='Audio lengths in seconds.'
+    )
+    parser.add_argument(
+        '--durations', type=float, nargs='*', default=[0.5, 1, 2],
+        help='Beats per slot.'
+    )
+    parser.add_argument(
+        '--workers', type=int, nargs='*', default=[1, 4],
+        help='Numbers of concurrent ffmpeg processes.'
+    )
+    parser.add_argument(
+        '--engines', nargs='*', default=['segment'],
+        help='Render engines.'
+    )
+    parser.add_argument(
+        '--bpm', default=None,
+        help='BPM of the audio, detected if not set.'
+    )
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument(
+        '--cold', action='store_true',
+        help='Use a fresh cache directory for every run.'
+    )
+    parser.add_argument('--output', help='Path to JSON results file.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    results = run(args)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
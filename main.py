@@ -100,6 +100,114 @@ def parse_args():
     parser.add_argument(
         '--even_dimensions', type=int
     )
+    parser.add_argument(
+        '--workers', type=int,
+        help='Number of segments to render concurrently.'
+    )
+    parser.add_argument(
+        '--seed', type=int,
+        help='Seed for choosing segments.'
+    )
+    parser.add_argument(
+        '--use_segments', type=int,
+        help='Presegment sources and pick segments from segments directory.'
+    )
+    parser.add_argument(
+        '--segments_directory', type=str,
+        help='Directory for video segments.'
+    )
+    parser.add_argument(
+        '--segment_duration', type=float,
+        help='Duration of the segments.'
+    )
+    parser.add_argument(
+        '--force_segment', type=int,
+        help='Force segmentation of raw video.'
+    )
+    parser.add_argument(
+        '--use_proxies', type=int,
+        help='Make normalized proxies of sources and cut from them.'
+    )
+    parser.add_argument(
+        '--proxy_fps', type=float,
+        help='Frame rate of proxies.'
+    )
+    parser.add_argument(
+        '--proxy_workers', type=int,
+        help='Number of concurrent proxy ffmpeg processes.'
+    )
+    parser.add_argument(
+        '--work_budget', type=str,
+        help='Disk budget of work directory, e.g. 50G.'
+    )
+    parser.add_argument(
+        '--proxy_budget', type=str,
+        help='Disk budget of proxies, e.g. 100G.'
+    )
+    parser.add_argument(
+        '--segments_budget', type=str,
+        help='Disk budget of segments directory, e.g. 100G.'
+    )
+    parser.add_argument(
+        '--trace', type=int,
+        help='Write Chrome trace and summary of all stages and commands.'
+    )
+    parser.add_argument(
+        '--backend', type=str,
+        help='Media backend. Valid values are "cli" and "pyav".'
+    )
+    parser.add_argument(
+        '--single_pass', type=int,
+        help='Join segments and audio into the final file in one pass.'
+    )
+    parser.add_argument(
+        '--progressive', type=int,
+        help='Publish the mix as a growing HLS playlist while rendering.'
+    )
+    parser.add_argument(
+        '--progressive_directory',
+        help='Directory of the HLS playlist, defaults to the work directory.'
+    )
+    parser.add_argument(
+        '--chunk_duration', type=float,
+        help='Minimum duration of HLS chunks in seconds.'
+    )
+    parser.add_argument(
+        '--preview', type=int,
+        help='Render a small, low frame rate preview of the plan.'
+    )
+    parser.add_argument(
+        '--preview_start', type=float,
+        help='Start of the preview window in seconds of the audio.'
+    )
+    parser.add_argument(
+        '--preview_end', type=float,
+        help='End of the preview window in seconds of the audio.'
+    )
+    parser.add_argument(
+        '--avoid_defects', type=int,
+        help='Keep segments out of black, frozen and scene cut intervals.'
+    )
+    parser.add_argument(
+        '--defect_workers', type=int,
+        help='Number of sources analyzed for defects at once.'
+    )
+    parser.add_argument(
+        '--queue_directory',
+        help='Shared directory of a work queue served by mvgen.distributed workers.'
+    )
+    parser.add_argument(
+        '--analysis_workers', type=int,
+        help='Number of processes for BPM detection.'
+    )
+    parser.add_argument(
+        '--engine', type=str,
+        help='Render engine. Valid values are "segment", "batch" and "copy".'
+    )
+    parser.add_argument(
+        '--batch_size', type=int,
+        help='Number of segments per ffmpeg run for the "batch" engine.'
+    )
 
     args, unknown_args = parser.parse_known_args()
 
@@ -0,0 +1,101 @@
+"""Persistent cache of audio analysis results."""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+ANALYSIS_CACHE_FILENAME = 'analysis.sqlite'
+
+# Bytes hashed at the beginning, middle and end of a file
+HASH_CHUNK = 1 << 20
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS analysis (
+    key TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    params TEXT NOT NULL,
+    bpm REAL,
+    beats TEXT,
+    duration REAL,
+    created REAL NOT NULL
+)
+'''
+
+
+def content_hash(path):
+    """Fast hash of file size and its first, middle and last megabyte."""
+    size = os.path.getsize(str(path))
+    digest = hashlib.blake2b(str(size).encode('utf-8'), digest_size=20)
+
+    with open(str(path), 'rb') as file:
+        for offset in sorted({0, max(size // 2 - HASH_CHUNK // 2, 0), max(size - HASH_CHUNK, 0)}):
+            file.seek(offset)
+            digest.update(file.read(HASH_CHUNK))
+
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """SQLite cache of BPM, beats and duration keyed by audio content.
+
+    Entries are keyed by content hash plus analysis mode and parameters, so
+    the same track is recognized under any name or location.
+    """
+
+    def __init__(self, path):
+        self.filename = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.filename, timeout=30, check_same_thread=False
+        )
+        with self.lock, self.conn:
+            self.conn.execute(SCHEMA)
+
+    @staticmethod
+    def key(content, mode, params):
+        data = json.dumps([content, mode, params], sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, path, mode, params):
+        """Return cached analysis dict of `path`, or None."""
+        key = self.key(content_hash(path), mode, params)
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT bpm, beats, duration FROM analysis WHERE key = ?',
+                (key,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'bpm': row[0],
+            'beats': json.loads(row[1]) if row[1] is not None else None,
+            'duration': row[2]
+        }
+
+    def put(self, path, mode, params, bpm=None, beats=None, duration=None):
+        content = content_hash(path)
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO analysis '
+                '(key, hash, mode, params, bpm, beats, duration, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    self.key(content, mode, params), content, mode,
+                    json.dumps(params, sort_keys=True),
+                    None if bpm is None else float(bpm),
+                    None if beats is None else json.dumps([float(i) for i in beats]),
+                    duration, time.time()
+                )
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
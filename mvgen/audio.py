@@ -1,21 +1,166 @@
 """Audio utilities."""
 
-import wave
 import pywt
+import struct
 import logging
 import numpy as np
 
-from scipy import signal
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy import fft, signal
+
+from mvgen import commands as cs
+from mvgen import backends
+from mvgen.utils import get_duration
 
 LOG = logging.getLogger(__name__)
 
 
-def read_wav(filename):
-    with wave.open(filename, 'rb') as wf:
-        nsamps = wf.getnframes()
-        fs = wf.getframerate()
-        samps = np.frombuffer(wf.readframes(nsamps), dtype=np.int32)
-    return samps, fs
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Sample rate audio is decoded to for analysis
+ANALYSIS_RATE = 11025
+
+
+class WavFile:
+    """WAV file with its PCM data memory-mapped, read without copies.
+
+    Supports 8, 16, 24 and 32-bit integer and 32/64-bit float samples with
+    any number of channels.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+
+        with open(self.filename, 'rb') as file:
+            self._parse(file)
+
+        if self.format == WAVE_FORMAT_IEEE_FLOAT:
+            dtype = {4: '<f4', 8: '<f8'}[self.sampwidth]
+        elif self.sampwidth == 3:
+            dtype = np.uint8
+        else:
+            dtype = {1: np.uint8, 2: '<i2', 4: '<i4'}[self.sampwidth]
+
+        shape = (self.nframes, self.channels)
+        if self.sampwidth == 3:
+            shape += (3,)
+
+        self.data = np.memmap(
+            self.filename, dtype=dtype, mode='r', offset=self.offset,
+            shape=shape
+        ) if self.nframes else np.zeros(shape, dtype=dtype)
+
+    def _parse(self, file):
+        riff, _, wave_id = struct.unpack('<4sI4s', file.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError(f'{self.filename} is not a RIFF WAVE file')
+
+        fmt = None
+
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                raise ValueError(f'No data chunk in {self.filename}')
+
+            chunk_id, size = struct.unpack('<4sI', header)
+
+            if chunk_id == b'fmt ':
+                fmt = file.read(size)
+                file.seek(size % 2, 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f'No fmt chunk in {self.filename}')
+                self.offset = file.tell()
+                data_size = size
+                break
+            else:
+                file.seek(size + size % 2, 1)
+
+        self.format, self.channels, self.fs, _, block_align, bits = struct.unpack(
+            '<HHIIHH', fmt[:16]
+        )
+
+        if self.format == WAVE_FORMAT_EXTENSIBLE:
+            self.format, = struct.unpack('<H', fmt[24:26])
+
+        if self.format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise ValueError(f'Unsupported WAV format {self.format} in {self.filename}')
+
+        self.sampwidth = block_align // self.channels
+
+        # Size of data chunk of files that are still being written can be 0
+        # or larger than the file
+        file.seek(0, 2)
+        data_size = min(data_size, file.tell() - self.offset) or file.tell() - self.offset
+        self.nframes = data_size // block_align
+
+    def __len__(self):
+        return self.nframes
+
+    def mono(self, start=0, stop=None):
+        """Return frames from `start` to `stop` downmixed to one channel.
+
+        Mono integer files are returned as views of the mapped data.
+        """
+        data = self.data[start:stop]
+
+        if self.sampwidth == 3:
+            data = data.astype(np.int32)
+            data = data[..., 0] | (data[..., 1] << 8) | (data[..., 2] << 16)
+            data = np.where(data >= 1 << 23, data - (1 << 24), data)
+        elif self.sampwidth == 1:
+            data = data.astype(np.int16) - 128
+
+        if self.channels == 1:
+            return data[:, 0]
+
+        return data.mean(axis=1)
+
+    def windows(self, window, batch_size=32):
+        """Lazily yield mono windows of `window` seconds.
+
+        Yields 2-D arrays of up to `batch_size` windows, so that memory use
+        does not depend on the length of the file.
+        """
+        window_samps = int(window * self.fs)
+        nwindows = self.nframes // window_samps
+
+        for first in range(0, nwindows, batch_size):
+            last = min(first + batch_size, nwindows)
+            data = self.mono(first * window_samps, last * window_samps)
+            yield data.reshape(last - first, window_samps)
+
+
+def decode_audio(filename, fs=ANALYSIS_RATE, chunk_size=1 << 16):
+    """Decode any audio file and yield mono int16 sample chunks.
+
+    Nothing is written to disk, samples are decoded by the active media
+    backend.
+    """
+    return backends.get_backend().decode_audio(filename, fs, chunk_size)
+
+
+def stream_windows(chunks, window_samps, batch_size=32):
+    """Group sample chunks into 2-D arrays of up to `batch_size` windows.
+
+    Trailing samples that do not fill a window are dropped.
+    """
+    batch_samps = window_samps * batch_size
+    buffer = np.zeros(0, dtype=np.int16)
+
+    for chunk in chunks:
+        buffer = np.concatenate([buffer, chunk])
+
+        while len(buffer) >= batch_samps:
+            yield buffer[:batch_samps].reshape(batch_size, window_samps)
+            buffer = buffer[batch_samps:]
+
+    nwindows = len(buffer) // window_samps
+    if nwindows:
+        yield buffer[:nwindows * window_samps].reshape(nwindows, window_samps)
 
 
 def peak_detect(data):
@@ -30,11 +175,16 @@ def peak_detect(data):
     return peak_ndx
 
 
-def bpm_detector(data, fs):
-    cA = []
-    cD = []
-    correl = []
-    cD_sum = []
+def bpm_detector_batch(windows, fs):
+    """Detect BPM of each row of `windows`.
+
+    Windows are processed together as a 2-D array, and the autocorrelation is
+    computed with FFT over the lags of the 40-220 BPM range only.
+
+    Returns:
+        array of BPM values, NaN for windows without audio data
+    """
+    windows = np.atleast_2d(windows)
     levels = 4
     max_decimation = 2 ** (levels - 1)
     min_ndx = 60. / 220 * (fs / max_decimation)
@@ -42,90 +192,252 @@ def bpm_detector(data, fs):
 
     min_ndx, max_ndx = int(np.round(min_ndx)), int(np.round(max_ndx))
 
-    for loop in range(0, levels):
-        cD = []
+    cA = windows
 
+    for loop in range(0, levels):
         # 1) DWT
+        cA, cD = pywt.dwt(cA, 'db4', axis=-1)
+
         if loop == 0:
-            [cA, cD] = pywt.dwt(data, 'db4')
-            cD_minlen = int(len(cD) / max_decimation + 1)
-            cD_sum = np.zeros(cD_minlen)
-        else:
-            [cA, cD] = pywt.dwt(cA, 'db4')
+            cD_minlen = int(cD.shape[-1] / max_decimation + 1)
+            cD_sum = np.zeros((len(windows), cD_minlen))
 
         # 2) Filter
-        cD = signal.lfilter([0.01], [1 - 0.99], cD)
-
-        # 4) Subtractargs.filename out the mean.
+        cD = signal.lfilter([0.01], [1 - 0.99], cD, axis=-1)
 
         # 5) Decimate for reconstruction later.
-        cD = abs(cD[::(2 ** (levels - loop - 1))])
-        cD = cD - np.mean(cD)
+        cD = abs(cD[:, ::(2 ** (levels - loop - 1))])
+        cD = cD - np.mean(cD, axis=-1, keepdims=True)
 
         # 6) Recombine the signal before ACF
-        #    essentially, each level I concatenate
-        #    the detail coefs (i.e. the HPF values)
-        #    to the beginning of the array
-        cD_sum = cD[0:cD_minlen] + cD_sum
+        cD_sum = cD[:, 0:cD_minlen] + cD_sum
 
-    if [b for b in cA if b != 0.0] == []:
-        LOG.info('No audio data for sample, skipping...')
-        return
+    silent = ~np.any(cA != 0, axis=-1)
 
     # Adding in the approximate data as well...
-    cA = signal.lfilter([0.01], [1 - 0.99], cA)
+    cA = signal.lfilter([0.01], [1 - 0.99], cA, axis=-1)
     cA = abs(cA)
-    cA = cA - np.mean(cA)
-    cD_sum = cA[0:cD_minlen] + cD_sum
+    cA = cA - np.mean(cA, axis=-1, keepdims=True)
+    cD_sum = cA[:, 0:cD_minlen] + cD_sum
+
+    # ACF, zero-padded so that lags below max_ndx do not wrap around
+    nfft = fft.next_fast_len(cD_minlen + max_ndx)
+    spectrum = fft.rfft(cD_sum, nfft, axis=-1)
+    correl = fft.irfft(spectrum * np.conj(spectrum), nfft, axis=-1)
+    correl = correl[:, min_ndx:max_ndx]
+
+    # Peak detection, positive peaks take precedence as in `peak_detect`
+    max_val = np.amax(abs(correl), axis=-1, keepdims=True)
+    positive = correl == max_val
+    peak_ndx = np.where(
+        positive.any(axis=-1),
+        positive.argmax(axis=-1),
+        (correl == -max_val).argmax(axis=-1)
+    )
+
+    peak_ndx_adjusted = peak_ndx + min_ndx
 
-    # ACF
-    correl = np.correlate(cD_sum, cD_sum, 'full')
+    bpm = 60. / peak_ndx_adjusted * (fs / max_decimation)
+    bpm[silent] = np.nan
+
+    return bpm
 
-    midpoint = int(len(correl) / 2)
-    correl_midpoint_tmp = correl[midpoint:]
 
-    peak_ndx = peak_detect(correl_midpoint_tmp[min_ndx:max_ndx])
-    if len(peak_ndx) > 1:
+def bpm_detector(data, fs):
+    bpm = bpm_detector_batch(data, fs)[0]
+
+    if np.isnan(bpm):
         LOG.info('No audio data for sample, skipping...')
         return
 
-    peak_ndx_adjusted = peak_ndx[0] + min_ndx
+    return bpm
 
-    bpm = 60. / peak_ndx_adjusted * (fs / max_decimation)
 
-    return bpm
+def median_bpm(bpms):
+    """Median of window BPMs, windows from the first silent one count as zero."""
+    bpms = np.asarray(bpms, dtype=np.float64)
 
+    if not len(bpms):
+        return np.nan
 
-def get_bpm(filename, window=3):
-    samps, fs = read_wav(filename)
+    silent = np.isnan(bpms)
+    if silent.any():
+        LOG.info('No audio data for sample, skipping...')
+        bpms[np.argmax(silent):] = 0
+
+    return np.median(bpms)
 
-    data = []
-    bpm = 0
-    nsamps = len(samps)
-    window_samps = int(window * fs)
-    samps_ndx = 0  # First sample in window_ndx
-    max_window_ndx = int(nsamps / window_samps)
-    bpms = np.zeros(max_window_ndx)
 
-    # Iterate through all windows
-    for window_ndx in range(0, max_window_ndx):
-        data = samps[samps_ndx:samps_ndx + window_samps]
-        if not ((len(data) % window_samps) == 0):
-            raise AssertionError(str(len(data)))
+def get_bpm_windows(batches, fs, nwindows=None):
+    """Detect BPM from an iterable of 2-D arrays of equally sized windows.
 
-        bpm = bpm_detector(data, fs)
+    Windows from the first silent one on count as zero BPM, so the rest of
+    `batches` is not read if the total number of windows `nwindows` is known.
+    """
+    bpms = []
+    count = 0
 
-        if bpm is None:
+    for data in batches:
+        if bpms and np.isnan(bpms[-1]).any():
+            count += len(data)
             continue
 
-        bpms[window_ndx] = bpm
+        bpms.append(bpm_detector_batch(data, fs))
+        count += len(data)
 
-        # Iterate at the end of the loop
-        samps_ndx = samps_ndx + window_samps
+        if nwindows is not None and np.isnan(bpms[-1]).any():
+            break
 
-    bpm = np.median(bpms)
+    if not bpms:
+        return np.nan
 
-    return bpm
+    bpms = np.concatenate(bpms)
+    count = max(count, nwindows or 0)
+
+    return median_bpm(np.pad(bpms, (0, count - len(bpms)), constant_values=np.nan))
+
+
+def _bpm_file_worker(filename, window, first, last):
+    wav = WavFile(filename)
+    window_samps = int(window * wav.fs)
+    data = wav.mono(first * window_samps, last * window_samps)
+    return bpm_detector_batch(data.reshape(-1, window_samps), wav.fs)
+
+
+def _bpm_shared_worker(name, shape, dtype, fs, first, last):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return bpm_detector_batch(data[first:last], fs)
+    finally:
+        shm.close()
+
+
+def _run_parallel(worker, args, nwindows, batch_size, workers):
+    ranges = [
+        (first, min(first + batch_size, nwindows))
+        for first in range(0, nwindows, batch_size)
+    ]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker, *args, *i) for i in ranges]
+        bpms = [i.result() for i in futures]
+
+    if not bpms:
+        return np.nan
+
+    return median_bpm(np.concatenate(bpms))
+
+
+def _to_shared(chunks, dtype, capacity=0):
+    """Copy sample chunks into shared memory of `capacity` samples, growing
+    it when the chunks do not fit.
+
+    Returns:
+        (shared memory, number of samples)
+    """
+    dtype = np.dtype(dtype)
+    capacity = max(int(capacity), 1)
+    shm = shared_memory.SharedMemory(create=True, size=capacity * dtype.itemsize)
+    nsamps = 0
+
+    try:
+        for chunk in chunks:
+            end = nsamps + len(chunk)
+
+            if end > capacity:
+                capacity = max(2 * capacity, end)
+                grown = shared_memory.SharedMemory(
+                    create=True, size=capacity * dtype.itemsize
+                )
+                grown.buf[:nsamps * dtype.itemsize] = shm.buf[:nsamps * dtype.itemsize]
+                shm.close()
+                shm.unlink()
+                shm = grown
+
+            np.ndarray(
+                len(chunk), dtype=dtype, buffer=shm.buf,
+                offset=nsamps * dtype.itemsize
+            )[:] = chunk
+            nsamps = end
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+    return shm, nsamps
+
+
+def _get_bpm_shared(shm, nsamps, dtype, fs, window, workers, batch_size):
+    window_samps = int(window * fs)
+    nwindows = nsamps // window_samps
+
+    try:
+        return _run_parallel(
+            _bpm_shared_worker,
+            (shm.name, (nwindows, window_samps), np.dtype(dtype).str, fs),
+            nwindows, batch_size, workers
+        )
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def get_bpm_parallel(samples, fs, window=3, workers=None, batch_size=8):
+    """Detect BPM of mono `samples` with windows spread over processes.
+
+    Samples are copied once into shared memory that the workers read
+    directly. The result is the same as `get_bpm_windows` on the same data.
+    """
+    samples = np.asarray(samples)
+    shm, nsamps = _to_shared([samples], samples.dtype, len(samples))
+
+    return _get_bpm_shared(
+        shm, nsamps, samples.dtype, fs, window, workers, batch_size
+    )
+
+
+def get_bpm(filename, window=3, batch_size=32, workers=None):
+    """Detect BPM of a WAV file.
+
+    With several `workers`, windows are analyzed in parallel processes that
+    each map the file themselves.
+    """
+    wav = WavFile(filename)
+
+    if workers is not None and workers > 1:
+        window_samps = int(window * wav.fs)
+        return _run_parallel(
+            _bpm_file_worker, (wav.filename, window),
+            wav.nframes // window_samps, max(batch_size // workers, 1),
+            workers
+        )
+
+    return get_bpm_windows(
+        wav.windows(window, batch_size), wav.fs,
+        nwindows=wav.nframes // int(window * wav.fs)
+    )
+
+
+def get_bpm_stream(
+    filename, window=3, fs=ANALYSIS_RATE, batch_size=32, workers=None
+):
+    """Detect BPM of any audio file decoded straight from an ffmpeg pipe."""
+    chunks = decode_audio(filename, fs=fs)
+
+    if workers is not None and workers > 1:
+        # Decoded chunks go straight to shared memory sized from the duration
+        shm, nsamps = _to_shared(
+            chunks, np.int16, get_duration(filename) * fs + fs
+        )
+        return _get_bpm_shared(
+            shm, nsamps, np.int16, fs, window, workers,
+            max(batch_size // workers, 1)
+        )
+
+    return get_bpm_windows(
+        stream_windows(chunks, int(window * fs), batch_size), fs
+    )
 
 
 def get_beats(path):
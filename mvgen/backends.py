@@ -0,0 +1,598 @@
+"""Media backends that probe, decode and cut media.
+
+The CLI backend runs ffmpeg and ffprobe commands. The PyAV backend does the
+same in process with libav and keeps demuxers of recently cut sources open.
+It requires the optional `av` package.
+
+The backend is active in the current context only, so concurrent jobs of a
+server may use different backends. Functions run by other threads take it
+along with `tracing.bind`.
+"""
+
+import time
+import logging
+import tempfile
+import threading
+import subprocess
+import contextvars
+import numpy as np
+
+from fractions import Fraction
+from collections import OrderedDict
+
+from mvgen import commands as cs
+from mvgen import probe
+from mvgen import tracing
+from mvgen import utils
+from mvgen.variables import CUDA
+
+try:
+    import av
+except ImportError:
+    av = None
+
+logging.basicConfig(level=logging.INFO)
+
+BACKENDS = ('cli', 'pyav')
+
+# Open demuxers kept by the PyAV backend, in total and per source
+MAX_OPEN = 16
+POOL_SIZE = 2
+
+_BACKEND = contextvars.ContextVar('backend', default=None)
+_DEFAULT = None
+
+
+class CutTimeout(Exception):
+    """Cut of the PyAV backend took longer than its timeout."""
+
+
+def parse_keyframes(output):
+    """Convert ffprobe packet `pts_time,flags` lines to keyframe times."""
+    times = []
+
+    for line in output.splitlines():
+        parts = line.strip().split(',')
+        if len(parts) < 2 or 'K' not in parts[1]:
+            continue
+        try:
+            times.append(float(parts[0]))
+        except ValueError:
+            continue
+
+    return sorted(times)
+
+
+def activate(backend):
+    """Make `backend` the media backend used by probing, analysis and cuts
+    of the current context, or the default CLI backend if it is None."""
+    _BACKEND.set(backend)
+
+
+def get_backend():
+    global _DEFAULT
+
+    backend = _BACKEND.get()
+    if backend is not None:
+        return backend
+
+    if _DEFAULT is None:
+        _DEFAULT = CLIBackend()
+    return _DEFAULT
+
+
+def make_backend(name):
+    if name == 'cli':
+        return CLIBackend()
+    if name == 'pyav':
+        return PyAVBackend()
+    raise ValueError(f'Unknown media backend {name}')
+
+
+class MediaBackend:
+    """Interface of media backends."""
+
+    name = None
+
+    def probe(self, path):
+        """Return probe record of `path`, see `probe.parse_probe`."""
+        raise NotImplementedError
+
+    def keyframes(self, path):
+        """Return sorted keyframe times of the first video stream of `path`."""
+        raise NotImplementedError
+
+    def decode_audio(self, path, rate, chunk_size=1 << 16):
+        """Yield mono int16 sample chunks of `path` at `rate`, with leading
+        silence removed."""
+        raise NotImplementedError
+
+    def cut(
+        self, start, length, input_file, output_file, cuda=None,
+        segment_codec=None, width=None, height=None, watermark=None,
+        watermark_fontsize=40, even_dimensions=False, fps=None, timeout=None
+    ):
+        """Encode `length` seconds of `input_file` from `start` into an MPEG
+        program stream, see `commands.process_segment`.
+
+        Returns:
+            description of the cut for the debug file
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CLIBackend(MediaBackend):
+    """Run ffmpeg and ffprobe for every operation."""
+
+    name = 'cli'
+
+    def probe(self, path):
+        cmd = cs.probe(path)
+        _, out = tracing.run(cmd, stderr=subprocess.DEVNULL)
+        return probe.parse_probe(out.decode('utf-8', errors='replace'))
+
+    def keyframes(self, path):
+        cmd = cs.get_keyframes(path)
+        _, out = tracing.run(cmd, stderr=subprocess.DEVNULL)
+        return parse_keyframes(out.decode('utf-8', errors='replace'))
+
+    def decode_audio(self, path, rate, chunk_size=1 << 16):
+        cmd = cs.decode_audio(path, rate)
+
+        # stderr goes to a file, a pipe that is only read at the end blocks
+        # ffmpeg once it is full
+        with tempfile.TemporaryFile() as stderr, \
+                tracing.span('ffmpeg', cat='cmd', cmd=cmd) as args:
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=stderr, shell=True
+            )
+
+            try:
+                while True:
+                    chunk = proc.stdout.read(2 * chunk_size)
+                    if not chunk:
+                        break
+                    yield np.frombuffer(chunk[:len(chunk) // 2 * 2], dtype='<i2')
+            finally:
+                proc.stdout.close()
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+                args['exit_code'] = proc.returncode
+
+            stderr.seek(0)
+            error = stderr.read()
+
+        if proc.returncode != 0:
+            raise ValueError(
+                f'Error decoding {path}: {error.decode("utf-8", errors="replace")}'
+            )
+
+    def cut(
+        self, start, length, input_file, output_file, cuda=None,
+        segment_codec=None, width=None, height=None, watermark=None,
+        watermark_fontsize=40, even_dimensions=False, fps=None, timeout=None
+    ):
+        cmd = cs.process_segment(
+            start=start,
+            length=length,
+            input_file=input_file,
+            output_file=output_file,
+            cuda=cuda,
+            segment_codec=segment_codec,
+            width=width,
+            height=height,
+            watermark=watermark,
+            watermark_fontsize=watermark_fontsize,
+            even_dimensions=even_dimensions,
+            fps=fps
+        )
+
+        utils.runcmd(cmd, timeout=timeout)
+
+        return cmd
+
+
+def _split_filters(filters):
+    """Split ffmpeg filter chain strings into (name, args) pairs."""
+    result = []
+
+    for chain in filters:
+        parts, current, escaped = [], '', False
+        for char in chain:
+            if char == ',' and not escaped:
+                parts.append(current)
+                current = ''
+            else:
+                current += char
+            escaped = char == '\\' and not escaped
+        parts.append(current)
+
+        for part in parts:
+            name, _, args = part.strip().partition('=')
+            result.append((name, args or None))
+
+    return result
+
+
+def _stream_record(stream):
+    ctx = stream.codec_context
+    record = {
+        'index': stream.index,
+        'codec_type': stream.type,
+        'codec_name': ctx.name if ctx is not None else None,
+        'profile': getattr(stream, 'profile', None),
+        'bit_rate': ctx.bit_rate if ctx is not None and ctx.bit_rate else None
+    }
+
+    if stream.duration is not None and stream.time_base is not None:
+        record['duration'] = str(float(stream.duration * stream.time_base))
+
+    if stream.type == 'video':
+        record['width'] = ctx.width
+        record['height'] = ctx.height
+        record['pix_fmt'] = ctx.pix_fmt
+        rate = stream.average_rate or stream.base_rate
+        if rate:
+            record['r_frame_rate'] = f'{rate.numerator}/{rate.denominator}'
+    elif stream.type == 'audio':
+        record['sample_rate'] = str(ctx.sample_rate)
+        record['channels'] = ctx.channels
+
+    return {k: v for k, v in record.items() if v is not None}
+
+
+class PyAVBackend(MediaBackend):
+    """Probe, decode and cut media in process with PyAV.
+
+    Demuxers of cut sources are kept open, up to `max_open` in total and
+    `pool_size` per source, so sources that are picked repeatedly, also by
+    concurrent cuts, are not opened and probed again. Cuts with a custom
+    `segment_codec` or CUDA, and cuts that fail, are delegated to the CLI
+    backend. Cuts that take longer than `timeout` are stopped.
+    """
+
+    name = 'pyav'
+
+    def __init__(self, max_open=MAX_OPEN, pool_size=POOL_SIZE):
+        if av is None:
+            raise ImportError('PyAV backend requires the "av" package')
+
+        self.max_open = max_open
+        self.pool_size = pool_size
+        # Idle demuxers by path, least recently used first
+        self.containers = OrderedDict()
+        self.lock = threading.Lock()
+        self.cli = CLIBackend()
+
+    def _acquire(self, path):
+        """Return an idle open demuxer of `path`, or open a new one."""
+        path = str(path)
+
+        with self.lock:
+            idle = self.containers.get(path)
+            if idle:
+                self.containers.move_to_end(path)
+                return idle.pop()
+
+        return av.open(path)
+
+    def _release(self, path, container, reuse=True):
+        """Return `container` to the idle demuxers of `path`, closing the
+        least recently used ones over `max_open`."""
+        path = str(path)
+        closed = []
+
+        with self.lock:
+            idle = self.containers.setdefault(path, [])
+            self.containers.move_to_end(path)
+
+            if reuse and len(idle) < self.pool_size:
+                idle.append(container)
+            else:
+                closed.append(container)
+
+            while len(self.containers) > self.max_open or sum(
+                len(i) for i in self.containers.values()
+            ) > self.max_open:
+                _, old = self.containers.popitem(last=False)
+                closed += old
+
+        for container in closed:
+            container.close()
+
+    def probe(self, path):
+        try:
+            with tracing.span('probe', cat='pyav', path=str(path)):
+                with av.open(str(path)) as container:
+                    streams = [_stream_record(i) for i in container.streams]
+                    duration = container.duration
+                    bit_rate = container.bit_rate
+        except (av.FFmpegError, OSError, ValueError):
+            return probe.parse_probe('')
+
+        video = [s for s in streams if s.get('codec_type') == 'video']
+
+        return {
+            'duration': duration / av.time_base if duration is not None else None,
+            'bitrate': float(bit_rate) if bit_rate else None,
+            'width': video[0].get('width') if video else None,
+            'height': video[0].get('height') if video else None,
+            'streams': streams
+        }
+
+    def keyframes(self, path):
+        times = []
+
+        try:
+            with tracing.span('keyframes', cat='pyav', path=str(path)):
+                with av.open(str(path)) as container:
+                    if not container.streams.video:
+                        return []
+                    stream = container.streams.video[0]
+                    for packet in container.demux(stream):
+                        if packet.is_keyframe and packet.pts is not None:
+                            times.append(float(packet.pts * stream.time_base))
+        except (av.FFmpegError, OSError, ValueError):
+            return []
+
+        return sorted(times)
+
+    def decode_audio(self, path, rate, chunk_size=1 << 16):
+        with tracing.span('decode_audio', cat='pyav', path=str(path)):
+            try:
+                container = av.open(str(path))
+            except (av.FFmpegError, OSError) as e:
+                raise ValueError(f'Error decoding {path}: {e}')
+
+            with container:
+                if not container.streams.audio:
+                    raise ValueError(f'Error decoding {path}: no audio stream')
+
+                stream = container.streams.audio[0]
+
+                graph = av.filter.Graph()
+                nodes = [
+                    graph.add_abuffer(template=stream),
+                    graph.add('silenceremove', '1:0:-50dB'),
+                    graph.add('aresample', str(rate)),
+                    graph.add(
+                        'aformat', 'sample_fmts=s16:channel_layouts=mono'
+                    ),
+                    graph.add('abuffersink')
+                ]
+                for a, b in zip(nodes, nodes[1:]):
+                    a.link_to(b)
+                graph.configure()
+
+                buffer = []
+                buffered = 0
+
+                for frame in container.decode(stream):
+                    graph.push(frame)
+                    for out in self._pull(graph):
+                        buffer.append(out.to_ndarray().reshape(-1))
+                        buffered += out.samples
+                        if buffered >= chunk_size:
+                            yield np.concatenate(buffer).astype('<i2')
+                            buffer, buffered = [], 0
+
+                graph.push(None)
+                for out in self._pull(graph):
+                    buffer.append(out.to_ndarray().reshape(-1))
+
+                if buffer:
+                    yield np.concatenate(buffer).astype('<i2')
+
+    @staticmethod
+    def _pull(graph):
+        while True:
+            try:
+                yield graph.pull()
+            except (av.BlockingIOError, av.EOFError):
+                return
+
+    def _video_graph(self, stream, start, end, filters):
+        graph = av.filter.Graph()
+        nodes = [
+            graph.add_buffer(template=stream),
+            graph.add('trim', f'start={start}:end={end}'),
+            graph.add('setpts', 'PTS-STARTPTS')
+        ]
+        nodes += [graph.add(name, args) for name, args in filters]
+        nodes += [graph.add('format', 'yuv420p'), graph.add('buffersink')]
+        for a, b in zip(nodes, nodes[1:]):
+            a.link_to(b)
+        graph.configure()
+        return graph
+
+    def _audio_graph(self, stream, start, end, frame_size):
+        graph = av.filter.Graph()
+        nodes = [
+            graph.add_abuffer(template=stream),
+            graph.add('atrim', f'start={start}:end={end}'),
+            graph.add('asetpts', 'PTS-STARTPTS'),
+            graph.add('aresample', '48000'),
+            graph.add('aformat', 'sample_fmts=fltp:channel_layouts=stereo'),
+            graph.add('asetnsamples', f'n={frame_size}:p=1'),
+            graph.add('abuffersink')
+        ]
+        for a, b in zip(nodes, nodes[1:]):
+            a.link_to(b)
+        graph.configure()
+        return graph
+
+    def cut(
+        self, start, length, input_file, output_file, cuda=None,
+        segment_codec=None, width=None, height=None, watermark=None,
+        watermark_fontsize=40, even_dimensions=False, fps=None, timeout=None
+    ):
+        if cuda is None:
+            cuda = CUDA
+
+        if cuda or segment_codec is not None:
+            return self.cli.cut(
+                start, length, input_file, output_file, cuda, segment_codec,
+                width, height, watermark, watermark_fontsize, even_dimensions,
+                fps, timeout
+            )
+
+        filters = _split_filters(cs.get_filters(
+            width, height, watermark, watermark_fontsize, even_dimensions,
+            deinterlace=False, colorspace=False, cuda=False, fps=fps
+        ))
+
+        start, length = float(start), float(length)
+        end = start + length
+
+        description = (
+            f'pyav cut "{input_file}" start={start} length={length} '
+            f'filters={filters} to "{output_file}"'
+        )
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with utils.cmd_slot(), tracing.span('cut', cat='pyav', path=str(input_file)) as args:
+            container = None
+            try:
+                container = self._acquire(input_file)
+                self._cut(container, start, end, output_file, filters, fps, deadline)
+                args['exit_code'] = 0
+            except CutTimeout as e:
+                # As a killed ffmpeg, the output fails validation
+                args['exit_code'] = -1
+                args['timeout'] = True
+                logging.error(f'CMD ERROR: {description}')
+                logging.error(e)
+                return description
+            except (av.FFmpegError, OSError, ValueError) as e:
+                args['exit_code'] = 1
+                logging.error(f'CMD ERROR: {description}')
+                logging.error(e)
+            finally:
+                if container is not None:
+                    self._release(
+                        input_file, container, reuse=args.get('exit_code') == 0
+                    )
+
+        if args['exit_code'] != 0:
+            # e.g. a filter missing from the libav build of PyAV
+            logging.info('PYAV: Falling back to CLI backend')
+            return self.cli.cut(
+                start, length, input_file, output_file, cuda, segment_codec,
+                width, height, watermark, watermark_fontsize, even_dimensions,
+                fps, timeout
+            )
+
+        return description
+
+    def _cut(
+        self, container, start, end, output_file, filters, rate=None,
+        deadline=None
+    ):
+        if not container.streams.video:
+            raise ValueError(f'{container.name} has no video stream')
+
+        video = container.streams.video[0]
+        audio = container.streams.audio[0] if container.streams.audio else None
+
+        fps = rate or video.average_rate or video.base_rate or Fraction(25)
+        fps = Fraction(fps).limit_denominator(1001)
+
+        container.seek(
+            int(start / video.time_base), stream=video, backward=True
+        )
+
+        with av.open(str(output_file), 'w', format='mpeg') as output:
+            vout = output.add_stream('libx264', rate=fps)
+            vout.pix_fmt = 'yuv420p'
+            vout.options = {'crf': '27', 'preset': 'ultrafast'}
+            vout.codec_context.gop_size = 100
+
+            vgraph = self._video_graph(video, start, end, filters)
+            streams = [video]
+
+            aout = agraph = None
+            if audio is not None:
+                aout = output.add_stream('ac3', rate=48000)
+                aout.layout = 'stereo'
+                agraph = self._audio_graph(
+                    audio, start, end, aout.codec_context.frame_size or 1536
+                )
+                streams.append(audio)
+
+            state = {'frames': 0, 'samples': 0, 'configured': False, 'pending': []}
+            done = set()
+
+            for packet in container.demux(*streams):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise CutTimeout(
+                        f'Cut of {container.name} from {start} to {end} timed out'
+                    )
+
+                stream = packet.stream
+                if stream in done:
+                    continue
+
+                for frame in packet.decode():
+                    if frame.time is not None and frame.time >= end:
+                        done.add(stream)
+                        break
+
+                    if stream is video:
+                        vgraph.push(frame)
+                        self._encode_video(vgraph, vout, output, fps, state)
+                    else:
+                        agraph.push(frame)
+                        self._encode_audio(agraph, aout, output, state)
+
+                if len(done) == len(streams):
+                    break
+
+            vgraph.push(None)
+            self._encode_video(vgraph, vout, output, fps, state)
+            output.mux(vout.encode(None))
+
+            if not state['configured']:
+                raise ValueError(f'No video frames in {container.name} from {start} to {end}')
+
+            if agraph is not None:
+                agraph.push(None)
+                self._encode_audio(agraph, aout, output, state)
+                output.mux(aout.encode(None))
+
+    def _encode_video(self, graph, stream, output, fps, state):
+        for frame in self._pull(graph):
+            if not state['configured']:
+                # Muxing opens all encoders, so audio waits for video size
+                stream.width = frame.width
+                stream.height = frame.height
+                state['configured'] = True
+                for packets in state['pending']:
+                    output.mux(packets)
+                state['pending'] = []
+
+            frame.pts = state['frames']
+            frame.time_base = 1 / fps
+            state['frames'] += 1
+            output.mux(stream.encode(frame))
+
+    def _encode_audio(self, graph, stream, output, state):
+        for frame in self._pull(graph):
+            frame.pts = state['samples']
+            frame.time_base = Fraction(1, 48000)
+            state['samples'] += frame.samples
+            if state['configured']:
+                output.mux(stream.encode(frame))
+            else:
+                state['pending'].append(stream.encode(frame))
+
+    def close(self):
+        with self.lock:
+            for idle in self.containers.values():
+                for container in idle:
+                    container.close()
+            self.containers.clear()
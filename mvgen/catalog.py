@@ -0,0 +1,302 @@
+"""Persistent catalog of source files."""
+
+import os
+import sqlite3
+import logging
+import threading
+import numpy as np
+
+from pathlib import Path
+
+logging.basicConfig(level=logging.INFO)
+
+CATALOG_FILENAME = 'catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    parent INTEGER,
+    mtime INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    dir INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    duration REAL,
+    UNIQUE (dir, name)
+);
+'''
+
+# Selects a directory and all directories below it. "/" sorts right
+# before "0", so [path + "/", path + "0") is exactly the subtree.
+SUBTREE = '(dirs.path = ? OR (dirs.path >= ? AND dirs.path < ?))'
+
+
+def _subtree_args(path):
+    return path, path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+class CatalogFiles:
+    """Sequence of catalog files, resolved to paths on access."""
+
+    def __init__(self, catalog, ids):
+        self.catalog = catalog
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        return self.catalog.path(self.ids[index])
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self[i]
+
+
+class Catalog:
+    """SQLite catalog of source trees, rescanned using directory mtimes.
+
+    A directory is only listed again when its mtime changes, i.e. when files
+    were added, removed or renamed in it. Files modified in place are only
+    picked up by a scan with `check_files`, which stats every file.
+    """
+
+    def __init__(self, path):
+        self.filename = str(path)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            self.filename, timeout=30, check_same_thread=False
+        )
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def _remove_dir(self, path):
+        args = _subtree_args(path)
+        self.conn.execute(
+            f'DELETE FROM files WHERE dir IN (SELECT id FROM dirs WHERE {SUBTREE})',
+            args
+        )
+        self.conn.execute(f'DELETE FROM dirs WHERE {SUBTREE}', args)
+
+    def _get_dir(self, path, parent):
+        row = self.conn.execute(
+            'SELECT id, mtime FROM dirs WHERE path = ?', (path,)
+        ).fetchone()
+
+        if row is not None:
+            return row
+
+        cursor = self.conn.execute(
+            'INSERT INTO dirs (path, parent, mtime) VALUES (?, ?, NULL)',
+            (path, parent)
+        )
+        return cursor.lastrowid, None
+
+    def _scan_dir(self, path, dir_id):
+        files = {}
+        subdirs = []
+
+        for entry in os.scandir(path):
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+
+        existing = {
+            name: (file_id, size, mtime)
+            for file_id, name, size, mtime in self.conn.execute(
+                'SELECT id, name, size, mtime FROM files WHERE dir = ?',
+                (dir_id,)
+            )
+        }
+
+        self.conn.executemany(
+            'DELETE FROM files WHERE id = ?',
+            [(v[0],) for k, v in existing.items() if k not in files]
+        )
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO files (dir, name, size, mtime, duration) '
+            'VALUES (?, ?, ?, ?, NULL)',
+            [
+                (dir_id, name, size, mtime)
+                for name, (size, mtime) in files.items()
+                if existing.get(name, (None,))[1:] != (size, mtime)
+            ]
+        )
+
+        children = [
+            row[0] for row in self.conn.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (dir_id,)
+            )
+        ]
+        for child in set(children) - set(subdirs):
+            self._remove_dir(child)
+
+        return subdirs
+
+    def _check_files(self, path, dir_id):
+        # Files modified in place do not change the mtime of their directory
+        removed, changed = [], []
+
+        for file_id, name, size, mtime in self.conn.execute(
+            'SELECT id, name, size, mtime FROM files WHERE dir = ?', (dir_id,)
+        ).fetchall():
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                removed.append((file_id,))
+                continue
+
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                changed.append((stat.st_size, stat.st_mtime_ns, file_id))
+
+        self.conn.executemany('DELETE FROM files WHERE id = ?', removed)
+        self.conn.executemany(
+            'UPDATE files SET size = ?, mtime = ?, duration = NULL WHERE id = ?',
+            changed
+        )
+
+        return len(removed) + len(changed)
+
+    def scan(self, root, full=False, check_files=False):
+        """Bring the catalog of `root` up to date.
+
+        Args:
+            full: list all directories, even if their mtime is unchanged
+            check_files: stat files of unchanged directories to pick up
+                files modified in place
+
+        Returns:
+            number of directories that had to be listed
+        """
+        root = os.path.abspath(str(root))
+        stack = [(root, None)]
+        listed = 0
+
+        with self.lock, self.conn:
+            while stack:
+                path, parent = stack.pop()
+
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    self._remove_dir(path)
+                    continue
+
+                dir_id, stored_mtime = self._get_dir(path, parent)
+
+                if stored_mtime == mtime and not full:
+                    if check_files:
+                        self._check_files(path, dir_id)
+                    subdirs = [
+                        row[0] for row in self.conn.execute(
+                            'SELECT path FROM dirs WHERE parent = ?', (dir_id,)
+                        )
+                    ]
+                else:
+                    subdirs = self._scan_dir(path, dir_id)
+                    self.conn.execute(
+                        'UPDATE dirs SET mtime = ? WHERE id = ?',
+                        (mtime, dir_id)
+                    )
+                    listed += 1
+
+                stack.extend((i, dir_id) for i in subdirs)
+
+        logging.info(f'CATALOG: Listed {listed} directories in {root}')
+
+        return listed
+
+    def _select(self, columns, roots):
+        where = ' OR '.join([SUBTREE] * len(roots))
+        args = [
+            i for root in roots
+            for i in _subtree_args(os.path.abspath(str(root)))
+        ]
+
+        with self.lock:
+            return self.conn.execute(
+                f'SELECT {columns} FROM files JOIN dirs ON dirs.id = files.dir '
+                f'WHERE size > 0 AND ({where}) ORDER BY dirs.path, files.name',
+                args
+            ).fetchall()
+
+    def ids(self, roots):
+        """Return ids of non-empty files under `roots`, ordered by path."""
+        rows = self._select('files.id', roots)
+        return np.array([i[0] for i in rows], dtype=np.int64)
+
+    def files(self, roots):
+        return CatalogFiles(self, self.ids(roots))
+
+    def records(self, roots):
+        """Return ids, sizes and durations (NaN if unknown) under `roots`."""
+        rows = self._select('files.id, files.size, files.duration', roots)
+        ids = np.array([i[0] for i in rows], dtype=np.int64)
+        sizes = np.array([i[1] for i in rows], dtype=np.int64)
+        durations = np.array(
+            [np.nan if i[2] is None else i[2] for i in rows], dtype=np.float64
+        )
+        return ids, sizes, durations
+
+    def path(self, file_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT dirs.path, files.name FROM files '
+                'JOIN dirs ON dirs.id = files.dir WHERE files.id = ?',
+                (int(file_id),)
+            ).fetchone()
+
+        if row is None:
+            raise KeyError(file_id)
+
+        return Path(row[0]) / row[1]
+
+    def fill_durations(self, roots, probe_cache, workers=8):
+        """Store durations of files under `roots` that have none yet."""
+        ids, _, durations = self.records(roots)
+        missing = ids[np.isnan(durations)]
+
+        if not len(missing):
+            return 0
+
+        paths = [self.path(i) for i in missing]
+        probe_cache.warm(paths, workers=workers)
+
+        values = [
+            (probe_cache.get(path)['duration'] or 0., int(file_id))
+            for file_id, path in zip(missing, paths)
+        ]
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'UPDATE files SET duration = ? WHERE id = ?', values
+            )
+
+        return len(missing)
+
+    def set_durations(self, records):
+        """Store known durations of files from (path, duration) records."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'UPDATE files SET duration = ? WHERE name = ? AND dir = '
+                '(SELECT id FROM dirs WHERE path = ?)',
+                [
+                    (duration, os.path.basename(str(path)),
+                     os.path.dirname(os.path.abspath(str(path))))
+                    for path, duration in records
+                ]
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
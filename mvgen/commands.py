@@ -5,6 +5,7 @@ import os
 from inspect import getfullargspec
 from functools import wraps
 
+from mvgen import tracing
 from mvgen.variables import WSL, CUDA
 
 
@@ -17,8 +18,8 @@ def windowspath(path):
 
     else:
         cmd = get_windows_path(path)
-        new_path = os.popen(cmd)
-        new_path = new_path.read().strip('\n')
+        _, new_path = tracing.run(cmd, stderr=None)
+        new_path = new_path.decode('utf-8').strip('\n')
 
     return new_path
 
@@ -52,18 +53,28 @@ def handle_command(cmd):
         'ffmpeg', 'ffmpeg.exe', 1).replace('ffprobe', 'ffprobe.exe', 1)
 
 
-@handle_args_decorator(['src', 'dest'], handle_path, handle_command)
-def convert_to_wav(src, dest):
-    cmd = f'ffmpeg -y -hide_banner -loglevel error -i "{src}" -af silenceremove=1:0:-50dB "{dest}"'
+@handle_args_decorator(['src'], handle_path, handle_command)
+def decode_audio(src, rate):
+    cmd = f'ffmpeg -hide_banner -loglevel error -i "{src}" -vn -af silenceremove=1:0:-50dB -ac 1 -ar {rate} -f s16le -'
 
     return cmd
 
 
+def get_segment_codec(cuda, segment_codec):
+    if segment_codec is None:
+        if cuda:
+            segment_codec = '-c:v h264_nvenc -preset:v fast -tune:v hq -rc:v vbr -cq:v 19 -b:v 0 -profile:v high'
+        else:
+            segment_codec = '-c:v libx264 -crf 27 -preset ultrafast'
+
+    return segment_codec
+
+
 @handle_args_decorator(['input_file', 'output_file'], handle_path, handle_command)
 def process_segment(
     start, length, input_file, output_file, cuda, segment_codec,
     width=None, height=None, watermark=None, watermark_fontsize=40,
-    even_dimensions=False
+    even_dimensions=False, fps=None
 ):
     if cuda is None:
         cuda = CUDA
@@ -72,15 +83,11 @@ def process_segment(
     hwaccel = ''
     input_codec = '-c:v h264_cuvid' if cuda else ''
 
-    if segment_codec is None:
-        if cuda:
-            segment_codec = '-c:v h264_nvenc -preset:v fast -tune:v hq -rc:v vbr -cq:v 19 -b:v 0 -profile:v high'
-        else:
-            segment_codec = '-c:v libx264 -crf 27 -preset ultrafast'
+    segment_codec = get_segment_codec(cuda, segment_codec)
 
     vf = get_vf(
         width, height, watermark, watermark_fontsize, even_dimensions,
-        deinterlace=False, colorspace=False, cuda=cuda
+        deinterlace=False, colorspace=False, cuda=cuda, fps=fps
     )
 
     timebase = '-video_track_timescale 60000'
@@ -90,6 +97,117 @@ def process_segment(
     return cmd
 
 
+@handle_args_decorator(['output_file'], handle_path, handle_command)
+def process_batch(
+    segments, output_file, cuda, segment_codec, width=None, height=None,
+    watermark=None, watermark_fontsize=40, even_dimensions=False, fps=None
+):
+    """Render several segments into one file with a single ffmpeg run.
+
+    Args:
+        segments: list of (start, length, input_file, has_audio) tuples
+    """
+    if width is None or height is None:
+        raise ValueError('Batch rendering requires width and height')
+
+    if cuda is None:
+        cuda = CUDA
+
+    segment_codec = get_segment_codec(cuda, segment_codec)
+
+    scale = get_filters(
+        width, height, None, watermark_fontsize, even_dimensions,
+        deinterlace=False, colorspace=True, cuda=False, fps=fps
+    )
+    scale = ','.join(scale + ['setsar=1'])
+
+    inputs = []
+    filters = []
+    streams = []
+
+    for i, (start, length, input_file, has_audio) in enumerate(segments):
+        inputs.append(f'-ss {start} -t {length} -i "{handle_path(input_file)}"')
+
+        filters.append(
+            f'[{i}:v]trim=duration={length},setpts=PTS-STARTPTS,{scale}[v{i}]'
+        )
+
+        if has_audio:
+            audio = f'[{i}:a]atrim=duration={length},asetpts=PTS-STARTPTS,'
+        else:
+            audio = f'anullsrc=r=48000:cl=stereo,atrim=duration={length},'
+        filters.append(
+            audio + f'aformat=sample_rates=48000:channel_layouts=stereo[a{i}]'
+        )
+
+        streams.append(f'[v{i}][a{i}]')
+
+    watermark = get_filters(
+        None, None, watermark, watermark_fontsize, False,
+        deinterlace=False, colorspace=False, cuda=False
+    )
+    video_out = '[vc]' if watermark else '[v]'
+
+    filters.append(
+        f'{"".join(streams)}concat=n={len(segments)}:v=1:a=1{video_out}[a]'
+    )
+
+    if watermark:
+        filters.append(f'[vc]{",".join(watermark)}[v]')
+
+    filter_complex = ';'.join(filters)
+
+    timebase = '-video_track_timescale 60000'
+
+    cmd = f'ffmpeg -y -hide_banner -loglevel error {" ".join(inputs)} -filter_complex "{filter_complex}" -map "[v]" -map "[a]" -ac 2 -c:a ac3 -ar 48000 -g 100 {segment_codec} {timebase} -f mpeg "{output_file}"'
+
+    return cmd
+
+
+@handle_args_decorator(['input_file', 'output_file'], handle_path, handle_command)
+def copy_segment(start, length, input_file, output_file):
+    timebase = '-video_track_timescale 60000'
+
+    cmd = f'ffmpeg -y -hide_banner -loglevel error -ss {start} -t {length} -i "{input_file}" -map 0:v:0 -map 0:a:0? -c:v copy -ac 2 -c:a ac3 -ar 48000 -avoid_negative_ts make_zero {timebase} -f mpeg "{output_file}"'
+
+    return cmd
+
+
+@handle_args_decorator(['input_file', 'output_file'], handle_path, handle_command)
+def make_proxy(input_file, output_file, width=None, height=None, fps=None, gop=12):
+    vf = get_vf(
+        width, height, None, 40, True,
+        deinterlace=False, colorspace=True, cuda=False
+    )
+
+    rate = f'-r {fps}' if fps is not None else ''
+
+    keyframes = f'-g {gop} -keyint_min {gop} -sc_threshold 0'
+
+    cmd = f'ffmpeg -y -hide_banner -loglevel error -i "{input_file}" -map 0:v:0 -map 0:a:0? {vf} {rate} -c:v libx264 -preset veryfast -crf 20 -profile:v high {keyframes} -ac 2 -c:a aac -ar 48000 -movflags +faststart -f mp4 "{output_file}"'
+
+    return cmd
+
+
+@handle_args_decorator(
+    ['input_file', 'output_directory', 'segment_list'], handle_path, handle_command
+)
+def segment(
+    start, length, input_file, output_directory, segment_list,
+    segment_duration, width=None, height=None
+):
+    vf = get_vf(
+        width, height, None, 40, True,
+        deinterlace=False, colorspace=True, cuda=False
+    )
+
+    keyframes = f'-force_key_frames "expr:gte(t,n_forced*{segment_duration})"'
+
+    cmd = f'ffmpeg -y -hide_banner -loglevel error -ss {start} -t {length} -i "{input_file}" -map 0:v:0 -map 0:a:0? {vf} -c:v libx264 -preset veryfast -crf 23 {keyframes} -ac 2 -c:a ac3 -ar 48000 -f segment -segment_time {segment_duration} -reset_timestamps 1 -segment_list "{segment_list}" -segment_list_type csv "{output_directory}/%05d.ts"'
+
+    return cmd
+
+
 @handle_args_decorator(['input_file', 'output'], handle_path, handle_command)
 def join(
     input_file, output,
@@ -97,6 +215,14 @@ def join(
     convert=False, output_codec=None,
     watermark=None, watermark_fontsize=40
 ):
+    hwaccel, output_codec = get_output_codec(convert, output_codec)
+
+    vf = ''
+
+    return f'ffmpeg -y -hide_banner -loglevel error {hwaccel} -auto_convert 1 -f concat -safe 0 -i "{input_file}" {output_codec} -movflags faststart {vf} "{output}"'
+
+
+def get_output_codec(convert, output_codec):
     if convert:
         if output_codec is None:
             # if CUDA:
@@ -111,9 +237,59 @@ def join(
         hwaccel = ''
         output_codec = '-c:v copy'
 
-    vf = ''
+    return hwaccel, output_codec
 
-    return f'ffmpeg -y -hide_banner -loglevel error {hwaccel} -auto_convert 1 -f concat -safe 0 -i "{input_file}" {output_codec} -movflags faststart {vf} "{output}"'
+
+@handle_args_decorator(['input_file', 'output'], handle_path, handle_command)
+def join_final(
+    input_file, output, audio=None, offset=0, channel=1, convert=False,
+    output_codec=None, output_format='mp4'
+):
+    """Join segments of concat list `input_file` and mux in `audio` with one
+    ffmpeg run, see `join` and `join_audio_video`."""
+    hwaccel, output_codec = get_output_codec(convert, output_codec)
+
+    if audio is None:
+        inputs = f'-auto_convert 1 -f concat -safe 0 -i "{input_file}"'
+        mapping = '-map 0:v:0 -map 0:a:0?'
+    else:
+        inputs = f'-itsoffset {offset} -auto_convert 1 -f concat -safe 0 -i "{input_file}" -i "{handle_path(audio)}"'
+        if channel == 'mix':
+            mapping = '-filter_complex "[0:a][1:a]amix=inputs=2[a]" -map 0:v:0 -map "[a]" -shortest'
+        else:
+            mapping = f'-map 0:v:0 -map {channel}:a:0 -shortest'
+
+    return f'ffmpeg -y -hide_banner -loglevel error {hwaccel} {inputs} {mapping} {output_codec} -acodec aac -movflags faststart -f {output_format} "{output}"'
+
+
+@handle_args_decorator(['input_file', 'output'], handle_path, handle_command)
+def make_chunk(
+    input_file, output, position, length, audio=None, offset=0, channel=1
+):
+    """Mux segments of concat list `input_file` that start at `position` of
+    the mix with the matching `length` seconds of `audio` into an MPEG-TS
+    chunk. Video is copied."""
+    video = f'-auto_convert 1 -f concat -safe 0 -i "{input_file}"'
+
+    if audio is None or channel == 0:
+        inputs = video
+        mapping = '-map 0:v:0 -map 0:a:0?'
+    else:
+        start = position + offset
+        seek = f'-ss {start}' if start >= 0 else f'-itsoffset {-start}'
+        inputs = f'{video} {seek} -i "{handle_path(audio)}"'
+        if channel == 'mix':
+            mapping = '-filter_complex "[0:a][1:a]amix=inputs=2[a]" -map 0:v:0 -map "[a]"'
+        else:
+            mapping = f'-map 0:v:0 -map {channel}:a:0'
+
+    return f'ffmpeg -y -hide_banner -loglevel error {inputs} {mapping} -t {length} -c:v copy -c:a aac -ar 48000 -ac 2 -output_ts_offset {position} -f mpegts "{output}"'
+
+
+@handle_args_decorator(['input_file', 'output'], handle_path, handle_command)
+def join_chunks(input_file, output, output_format='mp4'):
+    """Join MPEG-TS chunks of concat list `input_file` without re-encoding."""
+    return f'ffmpeg -y -hide_banner -loglevel error -auto_convert 1 -f concat -safe 0 -i "{input_file}" -map 0:v:0 -map 0:a:0? -c copy -bsf:a aac_adtstoasc -movflags faststart -f {output_format} "{output}"'
 
 
 @handle_args_decorator(['input_file', 'output_file'], handle_path, handle_command)
@@ -122,6 +298,11 @@ def convert_audio(input_file, output_file, acodec):
     return cmd
 
 
+@handle_args_decorator(['input_file', 'output_file'], handle_path, handle_command)
+def cut_audio(input_file, output_file, start, length):
+    return f'ffmpeg -y -hide_banner -loglevel error -ss {start} -t {length} -i "{input_file}" -vn -c:a aac "{output_file}"'
+
+
 @handle_args_decorator(['video', 'audio', 'output'], handle_path, handle_command)
 def join_audio_video(offset, video, audio, channel, output):
     acodec = '-acodec aac'
@@ -148,6 +329,28 @@ def get_streams(path, stream_type):
     return f'ffprobe -i "{path}" -show_streams -select_streams {stream_type} -loglevel error'
 
 
+@handle_args_decorator(['path'], handle_path, handle_command)
+def get_keyframes(path):
+    return f'ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags -of csv=p=0 "{path}"'
+
+
+@handle_args_decorator(['path'], handle_path, handle_command)
+def detect_defects(
+    path, fps=5, width=320, black_duration=0.5, freeze_duration=1,
+    scene_threshold=10
+):
+    """Log black, frozen and scene cut intervals of video `path`, analyzed at
+    `fps` and `width` for speed."""
+    vf = f'fps={fps},scale={width}:-2,blackdetect=d={black_duration}:pix_th=0.10,freezedetect=n=-60dB:d={freeze_duration},scdet=threshold={scene_threshold}'
+
+    return f'ffmpeg -hide_banner -nostats -i "{path}" -map 0:v:0 -an -sn -dn -vf "{vf}" -f null -'
+
+
+@handle_args_decorator(['path'], handle_path, handle_command)
+def probe(path):
+    return f'ffprobe -v error -show_format -show_streams -of json "{path}"'
+
+
 def get_wslpath(path):
     return f'wslpath "{path}"'
 
@@ -156,9 +359,9 @@ def get_windows_path(path):
     return f'wslpath -m "{path}"'
 
 
-def get_vf(
+def get_filters(
     width, height, watermark, watermark_fontsize, even_dimensions, deinterlace,
-    colorspace, cuda
+    colorspace, cuda, fps=None
 ):
     vf = []
 
@@ -167,6 +370,9 @@ def get_vf(
             f'scale=(iw*sar)*min({width}/(iw*sar)\,{height}/ih):ih*min({width}/(iw*sar)\,{height}/ih), pad={width}:{height}:({width}-iw*min({width}/iw\,{height}/ih))/2:({height}-ih*min({width}/iw\,{height}/ih))/2'
         )
 
+    if fps is not None:
+        vf.append(f'fps={fps}')
+
     if even_dimensions:
         vf.append('crop=trunc(iw/2)*2:trunc(ih/2)*2')
 
@@ -186,6 +392,18 @@ def get_vf(
             vf.append(f"drawtext=text='{text}':x=10:y={start}:bordercolor=black:borderw=3:fontcolor=white:fontsize={watermark_fontsize}:fontfile=Arial")
             start += watermark_fontsize + 5
 
+    return vf
+
+
+def get_vf(
+    width, height, watermark, watermark_fontsize, even_dimensions, deinterlace,
+    colorspace, cuda, fps=None
+):
+    vf = get_filters(
+        width, height, watermark, watermark_fontsize, even_dimensions,
+        deinterlace, colorspace, cuda, fps
+    )
+
     if len(vf):
         vf = ','.join(vf)
         vf = f'-vf "[in]{vf}[out]"'
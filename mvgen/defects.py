@@ -0,0 +1,301 @@
+"""Persistent index of black, frozen and scene cut intervals of sources.
+
+Usage:
+    python -m mvgen.defects --work_directory /path/to/work \
+        --src_directory /path/to/sources --sources vidz --workers 4
+"""
+
+import re
+import sqlite3
+import logging
+import argparse
+import threading
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from mvgen import commands as cs
+from mvgen import tracing
+from mvgen.probe import identity
+from mvgen.utils import cmd_slot
+
+logging.basicConfig(level=logging.INFO)
+
+DEFECTS_FILENAME = 'defects.sqlite'
+
+# Segments do not start less than this many seconds before a scene cut
+CUT_MARGIN = 0.25
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS defects (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    black BLOB NOT NULL,
+    freeze BLOB NOT NULL,
+    cuts BLOB NOT NULL
+)
+'''
+
+BLACK_RE = re.compile(r'black_start:\s*(\S+)\s+black_end:\s*(\S+)')
+FREEZE_START_RE = re.compile(r'freeze_start:\s*(\S+)')
+FREEZE_END_RE = re.compile(r'freeze_end:\s*(\S+)')
+CUT_RE = re.compile(r'lavfi\.scd\.time:\s*(\S+)')
+
+
+def parse_defects(output):
+    """Parse blackdetect, freezedetect and scdet log of ffmpeg.
+
+    Returns:
+        dict of black and freeze (start, end) intervals and cut times.
+        A freeze that lasts until the end of the source ends at infinity.
+    """
+    black = [(float(a), float(b)) for a, b in BLACK_RE.findall(output)]
+
+    freeze = []
+    start = None
+    for line in output.splitlines():
+        match = FREEZE_START_RE.search(line)
+        if match:
+            start = float(match.group(1))
+            continue
+        match = FREEZE_END_RE.search(line)
+        if match and start is not None:
+            freeze.append((start, float(match.group(1))))
+            start = None
+    if start is not None:
+        freeze.append((start, np.inf))
+
+    cuts = sorted(float(i) for i in CUT_RE.findall(output))
+
+    return {'black': black, 'freeze': freeze, 'cuts': cuts}
+
+
+def detect_defects(path):
+    """Return defects of `path`, empty if it cannot be analyzed."""
+    cmd = cs.detect_defects(path)
+
+    with cmd_slot():
+        returncode, out = tracing.run(cmd)
+
+    out = out.decode('utf-8', errors='replace')
+
+    if returncode != 0:
+        # Stored as is, so that a broken source is not analyzed on every run
+        logging.error(f'CMD ERROR: {cmd}')
+        logging.error(out)
+        return {'black': [], 'freeze': [], 'cuts': []}
+
+    return parse_defects(out)
+
+
+def _pack(values):
+    return np.asarray(values, dtype=np.float64).tobytes()
+
+
+def _unpack(blob, columns=1):
+    values = np.frombuffer(blob, dtype=np.float64)
+    return values.reshape(-1, 2) if columns == 2 else values
+
+
+class DefectIndex:
+    """SQLite cache of black, frozen and scene cut intervals of sources,
+    keyed by path, size and mtime.
+
+    Sources are indexed ahead of time with `warm`, or in the background with
+    `submit`, so that planning does not wait for the analysis.
+    """
+
+    def __init__(self, path):
+        self.filename = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.filename, timeout=30, check_same_thread=False
+        )
+        with self.lock, self.conn:
+            self.conn.execute(SCHEMA)
+
+        self.executor = None
+        self.futures = {}
+
+    def _lookup(self, key):
+        row = self.conn.execute(
+            'SELECT black, freeze, cuts FROM defects '
+            'WHERE path = ? AND size = ? AND mtime = ?', key
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'black': _unpack(row[0], 2),
+            'freeze': _unpack(row[1], 2),
+            'cuts': _unpack(row[2])
+        }
+
+    def _store(self, records):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO defects '
+            '(path, size, mtime, black, freeze, cuts) VALUES (?, ?, ?, ?, ?, ?)',
+            [
+                key + (
+                    _pack(record['black']), _pack(record['freeze']),
+                    _pack(record['cuts'])
+                )
+                for key, record in records
+            ]
+        )
+
+    def get(self, path):
+        """Return defects of `path`, indexing it on a miss."""
+        key = identity(path)
+        if key is None:
+            return None
+
+        with self.lock:
+            record = self._lookup(key)
+
+        if record is None:
+            record = detect_defects(key[0])
+            with self.lock, self.conn:
+                self._store([(key, record)])
+                record = self._lookup(key)
+
+        return record
+
+    def warm(self, paths, workers=4):
+        """Index all `paths` missing from the cache in one parallel pass."""
+        keys = [k for k in (identity(p) for p in set(paths)) if k is not None]
+
+        with self.lock:
+            missing = [k for k in keys if self._lookup(k) is None]
+
+        if not missing:
+            return 0
+
+        logging.info(f'DEFECTS: Indexing {len(missing)} of {len(keys)} files')
+
+        with ThreadPoolExecutor(max_workers=workers or 1) as executor:
+            records = list(tqdm(
+                executor.map(tracing.bind(detect_defects), [k[0] for k in missing]),
+                total=len(missing)
+            ))
+
+        with self.lock, self.conn:
+            self._store(list(zip(missing, records)))
+
+        return len(missing)
+
+    def _index(self, key):
+        record = detect_defects(key[0])
+        with self.lock, self.conn:
+            self._store([(key, record)])
+
+    def submit(self, paths, workers=4):
+        """Start indexing all `paths` missing from the index in the
+        background with `workers` threads."""
+        keys = [k for k in (identity(p) for p in set(paths)) if k is not None]
+        submitted = 0
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=workers or 1)
+
+            for key in keys:
+                if key in self.futures or self._lookup(key) is not None:
+                    continue
+
+                self.futures[key] = self.executor.submit(
+                    tracing.bind(self._index), key
+                )
+                submitted += 1
+
+        if submitted:
+            logging.info(f'DEFECTS: Indexing {submitted} files in the background')
+
+        return submitted
+
+    def wait(self):
+        """Wait until all submitted paths are indexed."""
+        with self.lock:
+            futures = list(self.futures.values())
+
+        for future in futures:
+            future.result()
+
+    def exclusions(self, paths, workers=4):
+        """Return (intervals, starts) to avoid for every path of `paths`.
+
+        Segments should not overlap `intervals`, i.e. black or frozen video,
+        and should not start in `starts`, i.e. right before a scene cut.
+        Paths missing from the index have nothing to avoid yet, and are
+        indexed in the background, see `submit`.
+        """
+        paths = [str(i) for i in paths]
+        self.submit(paths, workers=workers)
+
+        result = []
+        for path in paths:
+            key = identity(path)
+
+            with self.lock:
+                record = None if key is None else self._lookup(key)
+
+            if record is None:
+                result.append(((), ()))
+                continue
+
+            intervals = [tuple(i) for i in record['black']]
+            intervals += [tuple(i) for i in record['freeze']]
+            starts = [(t - CUT_MARGIN, t) for t in record['cuts']]
+
+            result.append((intervals, starts))
+
+        return result
+
+    def close(self):
+        # Files not being indexed yet are indexed by a later run
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+        with self.lock:
+            self.conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_directory', required=True, help='Work directory.')
+    parser.add_argument('--cache_directory', help='Cache directory.')
+    parser.add_argument(
+        '--src_directory', required=True, help='Directory of sources.'
+    )
+    parser.add_argument(
+        '--sources', nargs='+', required=True,
+        help='Names of the source folders in --src_directory.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Number of sources analyzed at once.'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from mvgen.mvgen import MVGen
+
+    args = parse_args()
+
+    gen = MVGen(
+        work_directory=args.work_directory,
+        cache_directory=args.cache_directory
+    )
+    gen.index_defects(
+        sources=args.sources,
+        src_directory=args.src_directory,
+        workers=args.workers
+    )
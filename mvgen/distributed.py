@@ -0,0 +1,483 @@
+"""Distributed rendering of slots through a work queue on a shared filesystem.
+
+A mix publishes its render jobs to a directory of the queue. Workers on any
+node claim jobs with lease files, keep the leases alive with heartbeats and
+write results back to the directory. Jobs of crashed workers are claimed
+again once their leases expire.
+
+Heartbeats only touch the lease, and a lease expires once its mtime stayed
+the same for a while as seen by the claiming worker, so clocks of nodes need
+not agree. Each lease holds a token of its claim. Workers check it before
+every heartbeat, result and release, so a worker whose lease was taken over
+does not touch the new lease or publish its result.
+
+Usage:
+    python -m mvgen.distributed --queue_directory /shared/queue --workers 4
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import argparse
+import threading
+import traceback
+
+from pathlib import Path
+
+from mvgen import backends
+from mvgen import tracing
+from mvgen.utils import get_duration, mkdir, RenderError
+
+logging.basicConfig(level=logging.INFO)
+
+JOBS_DIRECTORY_NAME = 'jobs'
+LEASES_DIRECTORY_NAME = 'leases'
+DONE_DIRECTORY_NAME = 'done'
+FAILED_DIRECTORY_NAME = 'failed'
+RESULTS_DIRECTORY_NAME = 'results'
+CANCELLED_FILENAME = 'cancelled'
+JOB_SUFFIX = '.json'
+LEASE_SUFFIX = '.lease'
+
+LEASE_TIMEOUT = 60
+HEARTBEAT_INTERVAL = 10
+POLL_INTERVAL = 1
+
+
+def _write_json(filename, data):
+    tmp = filename.with_name(f'.{filename.name}.{uuid.uuid4().hex}.tmp')
+    with open(str(tmp), 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(str(tmp), str(filename))
+
+
+def _read_json(filename):
+    try:
+        with open(str(filename), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove(filename):
+    try:
+        os.remove(str(filename))
+    except FileNotFoundError:
+        pass
+
+
+def _names(directory, suffix):
+    try:
+        return {
+            i[:-len(suffix)] for i in os.listdir(str(directory))
+            if i.endswith(suffix) and not i.startswith('.')
+        }
+    except FileNotFoundError:
+        return set()
+
+
+class Lease:
+    """Lease file `filename` of a claimed job, touched every `interval`
+    seconds while its token is `token`."""
+
+    def __init__(self, filename, token, interval=HEARTBEAT_INTERVAL):
+        self.filename = Path(filename)
+        self.token = token
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def held(self):
+        """Whether the lease still belongs to this claim."""
+        data = _read_json(self.filename)
+        return data is not None and data.get('token') == self.token
+
+    def _beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.held():
+                    logging.error(f'QUEUE: Lease {self.filename.name} was taken over')
+                    return
+                os.utime(str(self.filename))
+            except OSError as e:
+                logging.error(f'QUEUE: Heartbeat of {self.filename.name} failed: {e}')
+
+    def start(self):
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+        self.thread.start()
+
+    def release(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+        if self.held():
+            _remove(self.filename)
+
+
+class MixQueue:
+    """Render jobs of one mix in directory `directory` of the queue."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.jobs = self.directory / JOBS_DIRECTORY_NAME
+        self.leases = self.directory / LEASES_DIRECTORY_NAME
+        self.done = self.directory / DONE_DIRECTORY_NAME
+        self.failed = self.directory / FAILED_DIRECTORY_NAME
+        self.results = self.directory / RESULTS_DIRECTORY_NAME
+
+    def create(self):
+        for directory in (
+            self.jobs, self.leases, self.done, self.failed, self.results
+        ):
+            mkdir(directory)
+
+        # A resumed mix is served again
+        _remove(self.directory / CANCELLED_FILENAME)
+
+    def cancel(self):
+        """Stop workers from claiming jobs, e.g. of a failed coordinator.
+
+        Results are kept for a resumed mix.
+        """
+        _write_json(self.directory / CANCELLED_FILENAME, {})
+
+    def cancelled(self):
+        return (self.directory / CANCELLED_FILENAME).exists()
+
+    def publish(self, spec):
+        """Add job `spec`, replacing a job with the same index.
+
+        A result of the job with the same key, e.g. of a crashed
+        coordinator, is kept instead.
+        """
+        name = str(spec['index'])
+
+        _remove(self.failed / (name + JOB_SUFFIX))
+
+        done = _read_json(self.done / (name + JOB_SUFFIX))
+        if done is not None and done['key'] == spec['key']:
+            _remove(self.jobs / (name + JOB_SUFFIX))
+            return
+
+        _remove(self.done / (name + JOB_SUFFIX))
+        _write_json(self.jobs / (name + JOB_SUFFIX), spec)
+
+    def get(self, name):
+        return _read_json(self.jobs / (name + JOB_SUFFIX))
+
+    def pending(self):
+        """Names of jobs without result, in order."""
+        if self.cancelled():
+            return []
+
+        return sorted(_names(self.jobs, JOB_SUFFIX), key=int)
+
+    def claim(self, name, timeout=LEASE_TIMEOUT, observed=None):
+        """Create the lease of job `name`, taking over an expired lease.
+
+        A lease is expired once its mtime did not change for `timeout`
+        seconds of this process. `observed` keeps {lease: (mtime, monotonic
+        time it was first seen)} of this process across calls.
+
+        Returns:
+            token of the created lease or None
+        """
+        lease = self.leases / (name + LEASE_SUFFIX)
+        observed = {} if observed is None else observed
+
+        try:
+            mtime = os.stat(str(lease)).st_mtime_ns
+        except FileNotFoundError:
+            observed.pop(str(lease), None)
+        else:
+            now = time.monotonic()
+            seen = observed.get(str(lease))
+
+            if seen is None or seen[0] != mtime:
+                observed[str(lease)] = (mtime, now)
+                return None
+
+            if now - seen[1] < timeout:
+                return None
+
+            # Only one worker renames the expired lease
+            expired = lease.with_name(f'.{lease.name}.{uuid.uuid4().hex}.expired')
+            try:
+                os.rename(str(lease), str(expired))
+            except OSError:
+                return None
+            _remove(expired)
+            observed.pop(str(lease), None)
+
+            logging.info(f'QUEUE: Lease of job {name} in {self.directory.name} expired')
+
+        try:
+            fd = os.open(str(lease), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        except FileNotFoundError:
+            # Mix is finished
+            return None
+
+        token = uuid.uuid4().hex
+
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump({
+                'token': token,
+                'pid': os.getpid(),
+                'host': socket.gethostname()
+            }, file)
+
+        return token
+
+    def finish(self, name, key, output=None, duration=None, error=None):
+        """Write the result of job `name`.
+
+        Args:
+            error: Exception or None
+                Error of a failed job, recorded with its type and traceback.
+        """
+        # Jobs with a result are not pending, until published again
+        _remove(self.jobs / (name + JOB_SUFFIX))
+
+        if error is None:
+            _write_json(self.done / (name + JOB_SUFFIX), {
+                'key': key, 'output': output, 'duration': duration
+            })
+        else:
+            _write_json(self.failed / (name + JOB_SUFFIX), {
+                'key': key,
+                'type': type(error).__name__,
+                'error': ''.join(traceback.format_exception(
+                    type(error), error, error.__traceback__
+                ))
+            })
+
+    def results_of(self, kind, seen=()):
+        """Return {name: result} of done or failed jobs.
+
+        Args:
+            seen: names of results already handled, which are not read
+        """
+        directory = self.done if kind == 'done' else self.failed
+        return {
+            name: result for name, result in (
+                (i, _read_json(directory / (i + JOB_SUFFIX)))
+                for i in _names(directory, JOB_SUFFIX) - set(seen)
+            )
+            if result is not None
+        }
+
+
+def render_spec(spec, output_file):
+    """Cut the slot of job `spec` into `output_file`.
+
+    Returns:
+        duration of the output
+    """
+    backends.get_backend().cut(
+        start=spec['start'],
+        length=spec['length'],
+        input_file=spec['input_file'],
+        output_file=output_file,
+        timeout=spec.get('timeout'),
+        **spec['process_kwargs']
+    )
+
+    duration = get_duration(output_file, use_cache=False)
+
+    if duration <= 0:
+        raise RenderError(
+            f'Error when processing file {spec["input_file"]}: '
+            f'output has duration={duration}'
+        )
+
+    return duration
+
+
+class Worker:
+    """Claim and render jobs of all mixes in `queue_directory`.
+
+    Args:
+        mixes: list of str or None
+            Names of mix directories to serve. All if None.
+    """
+
+    def __init__(
+        self, queue_directory, mixes=None, lease_timeout=LEASE_TIMEOUT,
+        heartbeat_interval=HEARTBEAT_INTERVAL, poll_interval=POLL_INTERVAL
+    ):
+        self.queue_directory = Path(queue_directory)
+        self.mixes = mixes
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.name = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.observed = {}
+
+    def _queues(self):
+        if self.mixes is not None:
+            names = self.mixes
+        else:
+            try:
+                names = sorted(os.listdir(str(self.queue_directory)))
+            except FileNotFoundError:
+                names = []
+
+        return [
+            MixQueue(self.queue_directory / i) for i in names
+            if not i.startswith('.')
+        ]
+
+    def claim(self):
+        """Return (queue, name, token) of a claimed job or None."""
+        for queue in self._queues():
+            for name in queue.pending():
+                token = queue.claim(name, self.lease_timeout, self.observed)
+                if token is not None:
+                    return queue, name, token
+
+        return None
+
+    def process(self, queue, name, token):
+        """Render claimed job `name`.
+
+        Jobs whose output fails validation are marked failed, so that the
+        mix rerolls them. Jobs that fail otherwise, e.g. on a full disk, are
+        released for another worker.
+
+        Returns:
+            False if the job was released after an error
+        """
+        lease = Lease(
+            queue.leases / (name + LEASE_SUFFIX), token, self.heartbeat_interval
+        )
+
+        try:
+            lease.start()
+
+            spec = queue.get(name)
+            if spec is None:
+                # Finished or rendered by another worker meanwhile
+                return True
+
+            if (queue.done / (name + JOB_SUFFIX)).exists():
+                _remove(queue.jobs / (name + JOB_SUFFIX))
+                return True
+
+            logging.info(f'WORKER: {self.name} rendering job {name} of {queue.directory.name}')
+
+            tmp = queue.results / f'.{spec["output"]}.{uuid.uuid4().hex}.tmp'
+            try:
+                duration = render_spec(spec, tmp)
+
+                if not lease.held():
+                    logging.error(f'WORKER: Lost lease of job {name} of {queue.directory.name}')
+                    return True
+
+                os.replace(str(tmp), str(queue.results / spec['output']))
+            except RenderError as e:
+                logging.error(f'WORKER: Job {name} of {queue.directory.name} failed: {e}')
+                if lease.held():
+                    queue.finish(name, spec['key'], error=e)
+            except Exception:
+                logging.error(
+                    f'WORKER: Releasing job {name} of {queue.directory.name}\n'
+                    f'{traceback.format_exc()}'
+                )
+                return False
+            else:
+                queue.finish(
+                    name, spec['key'], output=spec['output'], duration=duration
+                )
+            finally:
+                _remove(tmp)
+
+        except OSError as e:
+            # Mix directory was removed, e.g. by a finished coordinator
+            logging.error(f'WORKER: Job {name} of {queue.directory.name}: {e}')
+
+        finally:
+            lease.release()
+
+        return True
+
+    def run(self, stop=None, exit_when_idle=False):
+        """Process jobs until `stop` is set, or no job is left if
+        `exit_when_idle`."""
+        stop = stop or threading.Event()
+
+        logging.info(f'WORKER: {self.name} serving {self.queue_directory}')
+
+        while not stop.is_set():
+            claimed = self.claim()
+
+            if claimed is None:
+                if exit_when_idle:
+                    return
+                stop.wait(self.poll_interval)
+                continue
+
+            if not self.process(*claimed):
+                # Do not claim a job failing on this node again right away
+                stop.wait(self.poll_interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--queue_directory', required=True,
+        help='Shared directory of the work queue.'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of jobs rendered at once by this process.'
+    )
+    parser.add_argument(
+        '--backend', default=None,
+        help='Media backend, "cli" or "pyav".'
+    )
+    parser.add_argument('--lease_timeout', type=float, default=LEASE_TIMEOUT)
+    parser.add_argument('--heartbeat_interval', type=float, default=HEARTBEAT_INTERVAL)
+    parser.add_argument(
+        '--exit_when_idle', action='store_true',
+        help='Exit when no job is left instead of waiting for more.'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.backend is not None:
+        backends.activate(backends.make_backend(args.backend))
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=tracing.bind(Worker(
+                args.queue_directory,
+                lease_timeout=args.lease_timeout,
+                heartbeat_interval=args.heartbeat_interval
+            ).run),
+            args=(stop, args.exit_when_idle)
+        )
+        for _ in range(args.workers)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,125 @@
+"""Persistent keyframe index of sources."""
+
+import bisect
+import sqlite3
+import logging
+import threading
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from mvgen import backends
+from mvgen import tracing
+from mvgen.probe import identity
+
+logging.basicConfig(level=logging.INFO)
+
+KEYFRAMES_FILENAME = 'keyframes.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS keyframes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    times BLOB NOT NULL
+)
+'''
+
+
+def probe_keyframes(path):
+    return backends.get_backend().keyframes(path)
+
+
+def snap(times, ss, low=None, high=None):
+    """Return keyframe time nearest to `ss`, preferring times in [low, high]."""
+    if not len(times):
+        return ss
+
+    lo = 0 if low is None else bisect.bisect_left(times, low)
+    hi = len(times) if high is None else bisect.bisect_right(times, high)
+
+    if lo >= hi:
+        lo, hi = 0, len(times)
+
+    i = bisect.bisect_left(times, ss, lo, hi)
+    candidates = [times[j] for j in (i - 1, i) if lo <= j < hi]
+
+    return min(candidates, key=lambda t: abs(t - ss))
+
+
+class KeyframeIndex:
+    """SQLite cache of video keyframe times keyed by path, size and mtime."""
+
+    def __init__(self, path):
+        self.filename = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.filename, timeout=30, check_same_thread=False
+        )
+        with self.lock, self.conn:
+            self.conn.execute(SCHEMA)
+
+    def _lookup(self, key):
+        row = self.conn.execute(
+            'SELECT times FROM keyframes '
+            'WHERE path = ? AND size = ? AND mtime = ?', key
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return list(np.frombuffer(row[0], dtype=np.float64))
+
+    def _store(self, records):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO keyframes (path, size, mtime, times) '
+            'VALUES (?, ?, ?, ?)',
+            [
+                key + (np.asarray(times, dtype=np.float64).tobytes(),)
+                for key, times in records
+            ]
+        )
+
+    def get(self, path):
+        """Return sorted keyframe times of `path`, indexing it on a miss."""
+        key = identity(path)
+        if key is None:
+            return []
+
+        with self.lock:
+            times = self._lookup(key)
+
+        if times is None:
+            times = probe_keyframes(key[0])
+            with self.lock, self.conn:
+                self._store([(key, times)])
+
+        return times
+
+    def warm(self, paths, workers=8):
+        """Index all `paths` missing from the cache in one parallel pass."""
+        keys = [k for k in (identity(p) for p in set(paths)) if k is not None]
+
+        with self.lock:
+            missing = [k for k in keys if self._lookup(k) is None]
+
+        if not missing:
+            return 0
+
+        logging.info(f'KEYFRAMES: Indexing {len(missing)} of {len(keys)} files')
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            records = list(tqdm(
+                executor.map(tracing.bind(probe_keyframes), [k[0] for k in missing]),
+                total=len(missing)
+            ))
+
+        with self.lock, self.conn:
+            self._store(list(zip(missing, records)))
+
+        return len(missing)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
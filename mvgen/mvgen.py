@@ -1,7 +1,6 @@
 """Main functionality."""
 from multiprocessing import Value
 import os
-import random
 import datetime
 import uuid
 import shutil
@@ -11,17 +10,43 @@ import attr
 import inspect
 import json
 import bisect
+import hashlib
+import time
+import threading
+import contextvars
 
+from functools import partial
 from pathlib import Path
 from tqdm import tqdm
 from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from copy import deepcopy
 
 from mvgen import commands as cs
-from mvgen.audio import get_bpm, get_beats
+from mvgen import backends
+from mvgen import probe
+from mvgen import tracing
+from mvgen.audio import get_bpm, get_bpm_stream, get_beats, ANALYSIS_RATE
+from mvgen.analysis import AnalysisCache, ANALYSIS_CACHE_FILENAME
+from mvgen.probe import ProbeCache, PROBE_CACHE_FILENAME
+from mvgen.catalog import Catalog, CatalogFiles, CATALOG_FILENAME
+from mvgen.segments import presegment
+from mvgen.proxy import ProxyCache, PROXY_DIRECTORY_NAME
+from mvgen.storage import StorageManager, WorkLock, touch
+from mvgen.placement import place
+from mvgen.progressive import ChunkWriter, PROGRESSIVE_DIRECTORY_NAME
+from mvgen.keyframes import KeyframeIndex, KEYFRAMES_FILENAME, snap
+from mvgen.defects import DefectIndex, DEFECTS_FILENAME
+from mvgen.distributed import MixQueue, Worker, POLL_INTERVAL
+from mvgen.timeline import (
+    plan as plan_timeline, reroll_slot, save_timeline, load_timeline,
+    new_seed, make_jobs, job_key, offset_bounds, preview_timeline, Journal,
+    TIMELINE_FILENAME, JOURNAL_FILENAME
+)
 from mvgen.utils import (
-    natural_keys, mkdir, get_duration, get_bitrate, runcmd, modify_filename,
-    str2sec, checkcmd, wslpath, retry
+    natural_keys, mkdir, get_duration, get_bitrate, get_streams, runcmd,
+    modify_filename,
+    str2sec, checkcmd, wslpath, retry, RenderError
 )
 from mvgen.variables import WSL, CUDA, GCP_PROJECT_ID
 
@@ -35,10 +60,30 @@ logging.basicConfig(level=logging.INFO)
 DEBUG_FILENAME = 'debug.txt'
 RANDOM_DIRECTORY_NAME = 'random'
 RANDOM_FILENAME = 'random.txt'
-WAV_FILENAME = 'audio.wav'
 CONVERTED_AUDIO_FILENAME = 'audio3.aac'
 VIDEO_FILENAME = 'all.mp4'
 FINAL_FILENAME = 'all_music.mp4'
+CACHE_DIRECTORY_NAME = '.cache'
+BATCH_FILENAME = 'batch.mpg'
+PREVIEW_DIRECTORY_NAME = 'preview'
+PREVIEW_AUDIO_FILENAME = 'audio_preview.aac'
+RENDER_ENGINES = ('segment', 'batch', 'copy')
+# Maximum difference in seconds between rendered and planned position of a
+# segment before it is re-rendered to compensate the drift
+DRIFT_TOLERANCE = 0.05
+DRIFT_PASSES = 3
+
+RUN_STAGES = (
+    'collect_garbage', 'load_audio', 'generate', 'make_join_file', 'join',
+    'finalize'
+)
+SINGLE_PASS_STAGES = (
+    'collect_garbage', 'load_audio', 'generate', 'make_join_file',
+    'join_finalize'
+)
+PROGRESSIVE_STAGES = ('collect_garbage', 'load_audio', 'generate', 'assemble')
+
+AUDIO_CHANNELS = {'audio': 1, 'original': 0, 'mix': 'mix'}
 
 
 def convert_uid(uid):
@@ -60,19 +105,6 @@ def convert_path(path, make_directory=True):
     return path
 
 
-def get_random_files(paths, limit):
-    segs = np.concatenate([list(i.rglob('*')) for i in paths])
-    segs = [i for i in segs if os.stat(str(i)).st_size > 0]
-
-    random.shuffle(segs)
-
-    if limit is not None and limit > 0:
-        replace = True if limit > len(segs) else False
-        segs = np.random.choice(segs, size=limit, replace=replace)
-
-    return segs
-
-
 def get_args(config, function):
     args = {
         k: v for k, v in config.items()
@@ -86,25 +118,66 @@ class NullNotifier:
         pass
 
 
-class RandomFile:
-    def __init__(self, paths):
-        self.paths = paths
-        self.segs = get_random_files(self.paths, limit=None)
-        self.position = 0
+@attr.s
+class Caches(object):
+    """Caches of a cache directory, opened on first use and shared by all
+    jobs of a process, see `MVGen.caches`."""
 
-        if not self.segs:
-            raise ValueError(f'No files found in {paths}')
+    work_directory = attr.ib(converter=convert_path)
+    cache_directory = attr.ib(default=None)
 
-    def get(self):
-        seg = self.segs[self.position]
+    _catalog = None
+    _analysis_cache = None
+    _keyframe_index = None
+    _defect_index = None
 
-        if self.position >= len(self.segs) - 1:
-            self.segs = get_random_files(self.paths, limit=None)
-            self.position = 0
+    def __attrs_post_init__(self):
+        if self.cache_directory is None:
+            self.cache_directory = self.work_directory / CACHE_DIRECTORY_NAME
+            mkdir(self.cache_directory)
         else:
-            self.position += 1
+            self.cache_directory = convert_path(self.cache_directory)
+
+        self.lock = threading.Lock()
+        self.probe_cache = ProbeCache(self.cache_directory / PROBE_CACHE_FILENAME)
+
+    @property
+    def catalog(self):
+        with self.lock:
+            if self._catalog is None:
+                self._catalog = Catalog(self.cache_directory / CATALOG_FILENAME)
+
+        return self._catalog
+
+    @property
+    def analysis_cache(self):
+        with self.lock:
+            if self._analysis_cache is None:
+                self._analysis_cache = AnalysisCache(
+                    self.cache_directory / ANALYSIS_CACHE_FILENAME
+                )
 
-        return seg
+        return self._analysis_cache
+
+    @property
+    def keyframe_index(self):
+        with self.lock:
+            if self._keyframe_index is None:
+                self._keyframe_index = KeyframeIndex(
+                    self.cache_directory / KEYFRAMES_FILENAME
+                )
+
+        return self._keyframe_index
+
+    @property
+    def defect_index(self):
+        with self.lock:
+            if self._defect_index is None:
+                self._defect_index = DefectIndex(
+                    self.cache_directory / DEFECTS_FILENAME
+                )
+
+        return self._defect_index
 
 
 @attr.s
@@ -112,25 +185,73 @@ class MVGen(object):
     work_directory = attr.ib(converter=convert_path)
     uid = attr.ib(default=None, converter=convert_uid)
     notifier = attr.ib(default=None)
+    cache_directory = attr.ib(default=None)
+    caches = attr.ib(default=None)
+    backend = attr.ib(default=None)
 
     audio = None
     beats = None
     final_file = None
+    timeline = None
+    outputs = None
+    engine = 'segment'
+    batch_size = 1
+    _timeline_files = None
+    _proxy_cache = None
+    _debug_handle = None
+    chunk_writer = None
+    proxy_params = None
 
     def __attrs_post_init__(self):
         self.directory = self.work_directory / self.uid
-        self.random_file = self.directory / RANDOM_FILENAME
-        self.video = self.directory / VIDEO_FILENAME
+        self._set_output_directory(self.directory, self.directory.name)
 
         if self.notifier is None:
             self.notifier = NullNotifier()
 
-    def _write_to_debug(self, data):
-        with open(str(self.debug_file), 'a', encoding='utf-8') as file:
-            file.write(data)
-            file.write('\n')
+        self.debug_lock = threading.Lock()
+        self.work_lock = WorkLock(self.directory)
 
-    def load_audio(self, audio, bpm=None, delete_original_audio=False):
+        if self.caches is None:
+            self.caches = Caches(self.work_directory, self.cache_directory)
+
+        # Caches may be shared, e.g. by all jobs of a server
+        self.cache_directory = self.caches.cache_directory
+        self.probe_cache = self.caches.probe_cache
+
+        probe.activate(self.probe_cache)
+
+        if self.backend is not None:
+            backends.activate(backends.make_backend(self.backend))
+
+    def _set_output_directory(self, directory, name):
+        """Render into `directory` and name final files after `name`."""
+        self.output_directory = directory
+        self.output_name = name
+        self.random_file = directory / RANDOM_FILENAME
+        self.video = directory / VIDEO_FILENAME
+        self.random_directory = directory / RANDOM_DIRECTORY_NAME
+        self.timeline_file = directory / TIMELINE_FILENAME
+
+    def _write_to_debug(self, data):
+        with self.debug_lock:
+            if self._debug_handle is None:
+                self._debug_handle = open(
+                    str(self.debug_file), 'a', encoding='utf-8'
+                )
+            self._debug_handle.write(data)
+            self._debug_handle.write('\n')
+
+    def _close_debug(self):
+        with self.debug_lock:
+            if self._debug_handle is not None:
+                self._debug_handle.close()
+                self._debug_handle = None
+
+    def load_audio(
+        self, audio, bpm=None, delete_original_audio=False,
+        analysis_workers=None
+    ):
         """Load and process audio.
 
         Args:
@@ -145,18 +266,23 @@ class MVGen(object):
                     integer: BPM value
                     "auto": Audio is analyzed for beats
                     file path: Path to beats file
+            analysis_workers: int or None
+                Number of processes for BPM detection.
         """
         self.notifier.notify({'status': 'processing-audio'})
 
         mkdir(self.directory)
+        self.work_lock.start()
 
         self.debug_file = self.directory / DEBUG_FILENAME
-        self.audio = self._copy_audio(
+        self.audio = self._place_audio(
             audio, delete_original_audio=delete_original_audio
         )
-        self.beats = self._process_audio(self.audio, bpm)
+        self.beats = self._process_audio(
+            self.audio, bpm, analysis_workers=analysis_workers
+        )
 
-    def _copy_audio(self, audio, delete_original_audio):
+    def _place_audio(self, audio, delete_original_audio):
         if not os.path.exists(audio):
             with open(str(self.debug_file), 'w', encoding='utf-8') as file:
                 file.write(f'Audio: {audio}\n')
@@ -169,15 +295,20 @@ class MVGen(object):
                 [i for i in audio.iterdir() if os.path.isfile(i)]
             )
 
-        audio_name = modify_filename(os.path.basename(audio))
-        new_audio = self.directory / audio_name
-
-        logging.info(f'AUDIO: Copying {audio} to {new_audio}')
-        shutil.copy(str(audio), str(new_audio))
+        # Commands get the audio under a sanitized name in the work directory
+        new_audio = self.directory / modify_filename(os.path.basename(audio))
 
         if delete_original_audio:
-            logging.info(f'AUDIO: Deleting original audio {audio}')
-            audio.unlink()
+            logging.info(f'AUDIO: Moving original audio {audio} to {new_audio}')
+            place(audio, new_audio, move=True)
+        elif Path(os.path.abspath(audio)) != Path(os.path.abspath(new_audio)):
+            # Audio is only read, so a link to it will do
+            if os.path.lexists(new_audio):
+                os.remove(str(new_audio))
+            try:
+                os.symlink(os.path.abspath(audio), str(new_audio))
+            except OSError:
+                place(audio, new_audio)
 
         audio = new_audio
 
@@ -186,16 +317,42 @@ class MVGen(object):
 
         return audio
 
-    def _process_audio(self, audio, bpm):
+    def _get_analysis_mode(self, audio, bpm):
+        if Path(str(bpm)).exists():
+            return 'duration', {}
+        if bpm == 'beats':
+            return 'beats', {'method': 'specdiff'}
+        if bpm is None or bpm == 'auto':
+            if audio.suffix != '.wav':
+                return 'bpm', {'window': 3, 'rate': ANALYSIS_RATE}
+            return 'bpm', {'window': 3, 'rate': 'wav'}
+        return 'duration', {}
+
+    def _process_audio(self, audio, bpm, analysis_workers=None):
         logging.info(f'AUDIO: Processing {audio}')
 
-        if os.path.exists(audio):
-            self.audio_duration = get_duration(audio, raise_error=True)
+        is_file = os.path.exists(audio)
+        cached = None
+
+        if is_file:
+            mode, params = self._get_analysis_mode(audio, bpm)
+            cached = self.analysis_cache.get(audio, mode, params)
+
+        if cached is not None:
+            logging.info(f'AUDIO: Using cached {mode} analysis')
+            self.audio_duration = cached['duration']
+        elif is_file:
+            self.audio_duration = get_duration(
+                audio, raise_error=True, use_cache=False
+            )
         else:
             self.audio_duration = str2sec(str(audio))
 
         logging.info(f'Audio duration: {self.audio_duration}')
 
+        detected_bpm = None
+        detected_beats = None
+
         if Path(str(bpm)).exists():
             logging.info('AUDIO: Beats file: {}'.format(bpm))
 
@@ -209,30 +366,30 @@ class MVGen(object):
         elif bpm == 'beats':
             logging.info('AUDIO: Beats mode')
 
-            beats = get_beats(str(audio))
-            beats = [0] + beats
+            if cached is not None:
+                detected_beats = cached['beats']
+            else:
+                detected_beats = get_beats(str(audio))
+
+            beats = [0] + detected_beats
 
         else:
             if bpm is None or bpm == 'auto':
                 logging.info('AUDIO: Detecting BPM')
 
-                if not os.path.exists(audio):
+                if not is_file:
                     raise ValueError('Audio is not a file and no bpm is specified')
 
-                if audio.suffix != '.wav':
-                    logging.info('AUDIO: Converting to WAV')
-
-                    wav_audio = audio.parent / WAV_FILENAME
-                    cmd = cs.convert_to_wav(audio, wav_audio)
-                    exit_code = runcmd(cmd)
-
-                    if exit_code != 0:
-                        raise ValueError(f'Error converting {audio.name} to WAV')
+                if cached is not None:
+                    bpm = cached['bpm']
+                elif audio.suffix != '.wav':
+                    logging.info('AUDIO: Decoding for analysis')
+                    bpm = get_bpm_stream(str(audio), workers=analysis_workers)
                 else:
-                    wav_audio = audio
+                    bpm = get_bpm(str(audio), workers=analysis_workers)
 
-                bpm = get_bpm(str(wav_audio))
                 bpm = np.round(bpm)
+                detected_bpm = bpm
 
             bpm = float(bpm)
 
@@ -242,10 +399,17 @@ class MVGen(object):
 
             beats = list(np.arange(0, self.audio_duration, diff))
 
+        if is_file and cached is None:
+            self.analysis_cache.put(
+                audio, mode, params,
+                bpm=detected_bpm,
+                beats=detected_beats,
+                duration=self.audio_duration
+            )
+
         self.bpm = bpm
 
-        with open(str(self.debug_file), 'a') as file:
-            json.dump({'beats': beats}, file)
+        self._write_to_debug(json.dumps({'beats': beats}))
 
         return beats
 
@@ -253,13 +417,129 @@ class MVGen(object):
         self, duration, sources=None, src_directory=None, src_paths=None,
         start=0, end=0, cuda=None, segment_codec=None,
         width=None, height=None, watermark=None, watermark_fontsize=40,
-        even_dimensions=False
+        even_dimensions=False, probe_workers=8, workers=None, seed=None,
+        engine='segment', batch_size=16, use_segments=False,
+        segments_directory=None, segment_duration=2, segment_start=0,
+        segment_end=0, force_segment=False, use_proxies=False, proxy_fps=None,
+        proxy_workers=1, progressive=False, progressive_directory=None,
+        chunk_duration=10, offset=0, audio_mode='audio', preview=False,
+        preview_width=320, preview_height=180, preview_fps=10, preview_start=0,
+        preview_end=None, avoid_defects=False, defect_workers=4,
+        queue_directory=None
     ):
+        """Plan and render random video segments for every beat slot.
+
+        If a timeline already exists in the work directory, e.g. from a
+        crashed or edited job with the same uid, it is rendered instead of
+        planning a new one, and already rendered segments are reused.
+
+        Args:
+            workers: int or None
+                Number of concurrent ffmpeg processes. If None, segments are
+                rendered one by one.
+            seed: int or None
+                Seed for planning. Random if None.
+            engine, batch_size:
+                See `render`.
+            use_segments: bool
+                Presegment sources into `segments_directory` and pick slots
+                from the segments, see `presegment`.
+            use_proxies: bool
+                Make proxies of the sources at the target resolution and
+                `proxy_fps` in the background with `proxy_workers`, and cut
+                slots from the proxies that are ready.
+            progressive: bool
+                Publish the mix with audio as HLS chunks while rendering,
+                see `start_progressive`. Run `assemble` afterwards instead of
+                `join` and `finalize`.
+            preview: bool
+                Render the slots from `preview_start` to `preview_end` seconds
+                of the plan small and fast, see `make_preview`. With the same
+                seed, the cuts are the same as in the full render.
+            avoid_defects: bool
+                Keep slots out of black, frozen and scene cut intervals of
+                sources, see `plan`.
+            queue_directory:
+                See `render`.
+        """
         self.notifier.notify({'status': 'processing-video'})
 
-        self.random_directory = self.directory / RANDOM_DIRECTORY_NAME
-        mkdir(self.random_directory)
+        if preview:
+            full_timeline_file = self.timeline_file
+            self._set_preview_directory(
+                preview_width, preview_height, preview_fps, preview_start,
+                preview_end
+            )
 
+            if engine == 'copy':
+                logging.info('VIDEO: Copy engine cannot scale, using segment engine for preview')
+                engine = 'segment'
+
+        if self.timeline_file.exists():
+            logging.info(f'VIDEO: Resuming timeline {self.timeline_file}')
+            self.timeline = load_timeline(self.timeline_file)
+        elif preview and full_timeline_file.exists():
+            # Preview the cuts of the full render with the same uid
+            logging.info(f'VIDEO: Previewing timeline {full_timeline_file}')
+            self.timeline = load_timeline(full_timeline_file)
+        else:
+            with tracing.span('plan'):
+                self.plan(
+                    duration=duration,
+                    sources=sources,
+                    src_directory=src_directory,
+                    src_paths=src_paths,
+                    start=start,
+                    end=end,
+                    cuda=cuda,
+                    segment_codec=segment_codec,
+                    width=width,
+                    height=height,
+                    watermark=watermark,
+                    watermark_fontsize=watermark_fontsize,
+                    even_dimensions=even_dimensions,
+                    probe_workers=probe_workers,
+                    seed=seed,
+                    workers=workers,
+                    use_segments=use_segments,
+                    segments_directory=segments_directory,
+                    segment_duration=segment_duration,
+                    segment_start=segment_start,
+                    segment_end=segment_end,
+                    force_segment=force_segment,
+                    avoid_defects=avoid_defects,
+                    defect_workers=defect_workers
+                )
+
+        if preview:
+            self.make_preview(
+                width=preview_width,
+                height=preview_height,
+                fps=preview_fps,
+                start=preview_start,
+                end=preview_end
+            )
+
+        if use_proxies:
+            self.make_proxies(fps=proxy_fps, workers=proxy_workers)
+
+        if progressive:
+            self.start_progressive(
+                directory=progressive_directory,
+                offset=offset,
+                audio_mode=audio_mode,
+                chunk_duration=chunk_duration
+            )
+
+        with tracing.span('render', engine=engine, workers=workers):
+            self.render(
+                workers=workers,
+                engine=engine,
+                batch_size=batch_size,
+                queue_directory=queue_directory
+            )
+
+    def _get_src_paths(self, sources=None, src_directory=None, src_paths=None):
         if src_paths is None:
             src_directory = convert_path(src_directory)
             src_paths = [src_directory / i for i in sources]
@@ -271,6 +551,9 @@ class MVGen(object):
                 src_paths[i] = convert_path(src_path)
                 logging.info(f'VIDEO: Using source path {src_path}')
 
+        return src_paths
+
+    def _get_slot_beats(self, duration):
         if duration >= 1:
             duration = int(duration)
             beats = self.beats[::duration]
@@ -283,7 +566,66 @@ class MVGen(object):
                 new_beats.append(new)
             beats = list(np.sort(np.concatenate(new_beats)))
 
-        random_file_gen = RandomFile(paths=src_paths)
+        return beats
+
+    def plan(
+        self, duration, sources=None, src_directory=None, src_paths=None,
+        start=0, end=0, cuda=None, segment_codec=None,
+        width=None, height=None, watermark=None, watermark_fontsize=40,
+        even_dimensions=False, probe_workers=8, seed=None, workers=None,
+        use_segments=False, segments_directory=None, segment_duration=2,
+        segment_start=0, segment_end=0, force_segment=False,
+        avoid_defects=False, defect_workers=4
+    ):
+        """Pick source and offset of every beat slot and write the timeline.
+
+        No video is encoded. The timeline is a JSON file that lists slot index,
+        source, offset, length and processing arguments of every slot, and
+        can be edited before rendering.
+
+        If `avoid_defects`, offsets are moved out of black and frozen video
+        and away from scene cuts of indexed sources. Picked sources missing
+        from the defect index are analyzed in the background with
+        `defect_workers` processes, for rerolls and later plans.
+        """
+        mkdir(self.random_directory)
+
+        src_paths = self._get_src_paths(sources, src_directory, src_paths)
+
+        if use_segments:
+            src_paths = self.presegment(
+                src_paths=src_paths,
+                segments_directory=segments_directory,
+                segment_duration=segment_duration,
+                segment_start=segment_start,
+                segment_end=segment_end,
+                force_segment=force_segment,
+                width=width,
+                height=height,
+                workers=workers,
+                probe_workers=probe_workers
+            )
+            # Segments are already trimmed
+            start, end = 0, 0
+
+        # Keep sources and segments from eviction from now on, as slots are
+        # picked and rerolled from all of them
+        self.work_lock.start()
+        self.work_lock.pin(src_paths)
+
+        beats = self._get_slot_beats(duration)
+
+        if seed is None:
+            seed = new_seed()
+
+        logging.info(f'VIDEO: Planning {len(beats) - 1} segments with seed {seed}')
+
+        files, durations = self._get_source_files(src_paths, probe_workers)
+
+        if not len(files):
+            raise ValueError(f'No files found in {src_paths}')
+
+        rng = np.random.default_rng(seed)
 
         if segment_codec is not None:
             logging.info(f'VIDEO: Using segment codec {segment_codec}')
@@ -298,139 +640,831 @@ class MVGen(object):
             even_dimensions=even_dimensions
         )
 
-        total_dur = 0
+        self.timeline = plan_timeline(
+            beats=beats,
+            sources=src_paths,
+            files=files,
+            durations=durations,
+            rng=rng,
+            seed=seed,
+            start=start,
+            end=end,
+            process_kwargs=process_kwargs,
+            defects=self._get_defects(avoid_defects, defect_workers)
+        )
+
+        save_timeline(self.timeline, self.timeline_file)
+
+        return self.timeline
+
+    def _set_preview_directory(self, width, height, fps, start, end):
+        settings = json.dumps([width, height, fps, start, end])
+        key = hashlib.sha1(settings.encode('utf-8')).hexdigest()[:12]
+
+        self._set_output_directory(
+            self.directory / PREVIEW_DIRECTORY_NAME / key,
+            f'{self.directory.name}_preview_{key}'
+        )
 
-        # i = 0
-        # with tqdm(total=len(beats)) as pbar:
-        #     while total_dur <= self.audio_duration:
-        #         progress = i / (len(beats) - 1) if len(beats) > 1 else i
-
-        #         self.notifier.notify({
-        #             'status': 'processing-video',
-        #             'progress': progress
-        #         })
-
-        #         remaining_ix = np.searchsorted(beats, total_dur, side='right')
-        #         diff = (
-        #             beats[remaining_ix] - total_dur
-        #             if remaining_ix < len(beats)
-        #             else self.audio_duration - total_dur
-        #         )
-
-        #         res = self._make_segment(
-        #             random_file_gen,
-        #             i,
-        #             diff,
-        #             start,
-        #             end,
-        #             process_kwargs
-        #         )
-
-        #         if res is None:
-        #             continue
-
-        #         file, outfile, out_duration, ss = res
-
-        #         self._write_segment_to_debug(
-        #             position=total_dur,
-        #             filename=outfile.name,
-        #             ss=ss,
-        #             diff=diff,
-        #             original_filename=file.name
-        #         )
-
-        #         total_dur += out_duration
-        #         i += 1
-        #         pbar.update(1)
-
-        for i in tqdm(range(len(beats) - 1)):
-            progress = i / (len(beats) - 1) if len(beats) > 1 else i
+    def make_preview(self, width=320, height=180, fps=10, start=0, end=None):
+        """Restrict the planned timeline to a window and render it small.
 
+        Slots that start between `start` and `end` seconds keep their
+        sources and offsets, and are rendered at `width`x`height` and `fps`
+        with the default segment codec. The audio is cut to the window.
+
+        Timeline, segments, audio and final file of a preview are kept
+        apart from those of the full render, in a directory of the preview
+        settings.
+        """
+        self._set_preview_directory(width, height, fps, start, end)
+        mkdir(self.random_directory)
+
+        if 'preview' not in self.timeline:
+            self.timeline = preview_timeline(
+                self.timeline,
+                {
+                    'width': width,
+                    'height': height,
+                    'fps': fps,
+                    'segment_codec': None
+                },
+                start=start,
+                end=end
+            )
+            save_timeline(self.timeline, self.timeline_file)
+
+        window = self.timeline['preview']
+
+        logging.info(
+            f'VIDEO: Preview of {len(self.timeline["slots"])} slots from '
+            f'{window["start"]:.2f}s to {window["end"]:.2f}s at {width}x{height}'
+        )
+
+        if self.audio is not None and os.path.exists(self.audio):
+            self.audio = self._cut_audio(
+                window['start'], window['end'] - window['start']
+            )
+
+        return self.timeline
+
+    def _cut_audio(self, start, length):
+        audio = self.output_directory / PREVIEW_AUDIO_FILENAME
+
+        if not audio.exists():
+            tmp = audio.with_name(f'.{audio.stem}.tmp{audio.suffix}')
+            cmd = cs.cut_audio(self.audio, tmp, start, length)
+            self._write_to_debug(cmd)
+
+            try:
+                runcmd(cmd, raise_error=True)
+                os.replace(str(tmp), str(audio))
+            finally:
+                if tmp.exists():
+                    os.remove(str(tmp))
+
+        return audio
+
+    def reroll(self, indices):
+        """Pick new sources for slots `indices`.
+
+        Only these slots are re-encoded by the next `render`.
+        """
+        if self.timeline is None:
+            self.timeline = load_timeline(self.timeline_file)
+
+        files, durations = self._get_timeline_files()
+
+        for index in indices:
+            slot = self.timeline['slots'][index]
+            reroll_slot(self.timeline, slot, files, durations)
+            logging.info(f'VIDEO: Rerolled segment {index} to {slot["source"]}')
+
+        save_timeline(self.timeline, self.timeline_file)
+
+    def presegment(
+        self, src_paths, segments_directory, segment_duration=2,
+        segment_start=0, segment_end=0, force_segment=False, width=None,
+        height=None, workers=None, probe_workers=8
+    ):
+        """Cut sources into uniform chunks once and return segment roots.
+
+        Only new or changed sources are segmented. Chunks are encoded with a
+        keyframe at the start of each chunk, so slots can be cut from them
+        with the "copy" engine.
+        """
+        self.notifier.notify({'status': 'segmenting-video'})
+
+        segments_directory = convert_path(segments_directory)
+
+        for src_path in src_paths:
+            self.catalog.scan(src_path)
+
+        self.catalog.fill_durations(
+            src_paths, self.probe_cache, workers=probe_workers
+        )
+
+        segment_roots, durations = presegment(
+            roots=src_paths,
+            files={i: list(self.catalog.files([i])) for i in src_paths},
+            segments_directory=segments_directory,
+            segment_duration=segment_duration,
+            segment_start=segment_start,
+            segment_end=segment_end,
+            force_segment=force_segment,
+            width=width,
+            height=height,
+            workers=workers
+        )
+
+        self.work_lock.start()
+        self.work_lock.pin(segment_roots)
+
+        for segment_root in segment_roots:
+            self.catalog.scan(segment_root)
+
+        self.catalog.set_durations(durations)
+
+        return segment_roots
+
+    def _get_source_files(self, src_paths, probe_workers=8):
+        for src_path in src_paths:
+            self.catalog.scan(src_path)
+
+        self.catalog.fill_durations(
+            src_paths, self.probe_cache, workers=probe_workers
+        )
+
+        ids, _, durations = self.catalog.records(src_paths)
+
+        return CatalogFiles(self.catalog, ids), durations
+
+    def _get_timeline_files(self):
+        if self._timeline_files is None:
+            self._timeline_files = self._get_source_files(
+                [Path(i) for i in self.timeline['sources']]
+            )
+
+        return self._timeline_files
+
+    def render(
+        self, workers=None, engine='segment', batch_size=16,
+        queue_directory=None
+    ):
+        """Render all slots of the timeline that have no up-to-date output.
+
+        Args:
+            workers: int or None
+                Number of concurrent ffmpeg processes.
+            engine: str
+                One of
+                    "segment": one ffmpeg run per slot
+                    "batch": one ffmpeg run per `batch_size` consecutive slots,
+                        joined with a concat filter. Requires width and height.
+                    "copy": cut each slot without re-encoding video, starting
+                        at the keyframe nearest to its offset. Requires sources
+                        with the same codec and resolution. Sources are not
+                        scaled or cropped.
+            batch_size: int
+                Number of slots per ffmpeg run for the "batch" engine.
+            queue_directory: str or None
+                Shared directory of a work queue. If set, "segment" jobs are
+                published to the queue and rendered by `distributed.Worker`
+                processes on any node, and by `workers` threads of this
+                process.
+        """
+        mkdir(self.random_directory)
+
+        if self.timeline is None:
+            self.timeline = load_timeline(self.timeline_file)
+
+        if engine not in RENDER_ENGINES:
+            raise ValueError(f'Unknown render engine {engine}')
+
+        if queue_directory is not None and engine != 'segment':
+            raise ValueError('Distributed rendering requires the segment engine')
+
+        if engine == 'batch' and any(
+            i['process_kwargs'].get('width') is None
+            or i['process_kwargs'].get('height') is None
+            for i in self.timeline['slots']
+        ):
+            raise ValueError('Batch rendering requires width and height')
+
+        self.engine = engine
+        self.batch_size = batch_size if engine == 'batch' else 1
+        self.journal = Journal(self.output_directory / JOURNAL_FILENAME)
+
+        self.work_lock.start()
+        self._pin_inputs()
+
+        jobs = self._get_jobs()
+        pending = [i for i in jobs if self._get_rendered(i) is None]
+
+        # Indices of rendered jobs, and number and duration of jobs published
+        # to the progressive output
+        ready = {i['index'] for i in jobs} - {i['index'] for i in pending}
+        published, total_dur = 0, 0
+
+        if self.chunk_writer is not None:
+            published, total_dur = self._publish_jobs(
+                jobs, ready, published, total_dur
+            )
+
+        if engine == 'copy' and pending:
+            self._prepare_copy(pending, workers)
+
+        if queue_directory is None:
+            completed = self._run_jobs(pending, workers)
+        else:
+            completed = self._run_distributed(pending, workers, queue_directory)
+
+        logging.info(
+            f'VIDEO: Rendering {len(pending)} of {len(jobs)} jobs '
+            f'with {workers or 1} workers using {engine} engine'
+        )
+
+        for done, job in enumerate(tqdm(completed, total=len(pending))):
             self.notifier.notify({
                 'status': 'processing-video',
-                'progress': progress
+                'progress': done / len(pending)
             })
 
-            diff = beats[i + 1] - total_dur
+            if self.chunk_writer is not None:
+                ready.add(job['index'])
+                published, total_dur = self._publish_jobs(
+                    jobs, ready, published, total_dur
+                )
 
-            res = self._make_segment(
-                random_file_gen,
-                i,
-                diff,
-                start,
-                end,
-                process_kwargs
+        if self.chunk_writer is not None:
+            self.chunk_writer.finish()
+        else:
+            with tracing.span('compensate_drift'):
+                self._compensate_drift(workers)
+
+        save_timeline(self.timeline, self.timeline_file)
+
+        self.outputs = [
+            self.random_directory / self.journal.get(i)['output']
+            for i in self._get_jobs()
+        ]
+
+    def _run_jobs(self, jobs, workers):
+        """Render `jobs` in a thread pool and yield each job when done."""
+        with ThreadPoolExecutor(max_workers=workers or 1) as executor:
+            futures = {
+                executor.submit(tracing.bind(self._render_job), job): job
+                for job in jobs
+            }
+
+            for future in as_completed(futures):
+                future.result()
+                yield futures[future]
+
+    def _run_distributed(self, jobs, workers, queue_directory, attempts=5):
+        """Publish `jobs` to the work queue and yield each job when its
+        result is collected into the random directory.
+
+        Slots of jobs whose output failed validation are re-rolled and
+        published again, up to `attempts` times. If rendering stops early,
+        the mix is cancelled in the queue, and results so far are kept for a
+        resumed job.
+        """
+        queue_directory = convert_path(queue_directory)
+        queue = MixQueue(queue_directory / self.output_name)
+        queue.create()
+
+        waiting = {}
+        failures = {}
+        # Results that are collected or not waited for are not read again
+        seen = {'done': set(), 'failed': set()}
+        for job in jobs:
+            self._publish_remote(queue, job)
+            waiting[str(job['index'])] = job
+
+        logging.info(f'VIDEO: Published {len(jobs)} jobs to {queue.directory}')
+
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=tracing.bind(
+                    Worker(queue_directory, mixes=[queue.directory.name]).run
+                ),
+                args=(stop,),
+                daemon=True
             )
+            for _ in range(workers or 0)
+        ]
+        for thread in threads:
+            thread.start()
+
+        finished = False
+
+        try:
+            while waiting:
+                for name, result in queue.results_of('done', seen['done']).items():
+                    job = waiting.get(name)
+                    if job is None:
+                        seen['done'].add(name)
+                        continue
+                    if result['key'] != job_key(job):
+                        continue
+
+                    self._collect_remote(queue, job, result)
+                    seen['done'].add(name)
+                    del waiting[name]
+                    yield job
+
+                for name, result in queue.results_of('failed', seen['failed']).items():
+                    job = waiting.get(name)
+                    if job is None:
+                        seen['failed'].add(name)
+                        continue
+                    if result['key'] != job_key(job):
+                        continue
+
+                    failures[name] = failures.get(name, 0) + 1
+                    if failures[name] >= attempts:
+                        raise RenderError(result['error'])
+
+                    if result.get('type') == RenderError.__name__:
+                        logging.info(f'VIDEO: Job {name} failed, rerolling')
+
+                        files, durations = self._get_timeline_files()
+                        defects = self._get_defects(self.timeline.get('avoid_defects'))
+                        for slot in job['slots']:
+                            reroll_slot(self.timeline, slot, files, durations, defects)
+                    else:
+                        logging.info(f'VIDEO: Job {name} failed, publishing again')
+
+                    self._publish_remote(queue, job)
+
+                if waiting:
+                    time.sleep(POLL_INTERVAL)
+
+            finished = True
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            if not finished:
+                queue.cancel()
+
+        shutil.rmtree(str(queue.directory), ignore_errors=True)
+
+    def _publish_remote(self, queue, job):
+        slot, = job['slots']
+
+        filename = modify_filename(
+            os.path.basename(slot['source']), prefix=slot['index']
+        )
+
+        self._remove_stale_output(job, filename)
+
+        queue.publish({
+            'index': job['index'],
+            'key': job_key(job),
+            'start': slot['ss'],
+            'length': slot['length'],
+            'input_file': str(self._get_input(slot)),
+            'output': filename,
+            'timeout': 15,
+            'process_kwargs': slot['process_kwargs']
+        })
 
-            if res is None:
+    def _collect_remote(self, queue, job, result):
+        outfile = self.random_directory / result['output']
+
+        place(queue.results / result['output'], outfile, move=True)
+
+        self._write_to_debug(
+            f'queue "{queue.directory}" job {job["index"]} to "{outfile}"'
+        )
+
+        return self.journal.add(job, outfile.name, result['duration'])
+
+    def start_progressive(
+        self, directory=None, offset=0, audio_mode='audio', chunk_duration=10
+    ):
+        """Publish rendered segments as a growing HLS playlist.
+
+        Segments are muxed with the loaded audio into chunks of at least
+        `chunk_duration` seconds as soon as all previous segments are
+        rendered, see `ChunkWriter`.
+
+        Args:
+            directory: str or None
+                Directory of the playlist and chunks. If None, a directory in
+                the work directory.
+        """
+        directory = self._get_progressive_directory(directory)
+
+        audio = self.audio if self.audio is not None and os.path.exists(self.audio) else None
+
+        self.chunk_writer = ChunkWriter(
+            directory,
+            audio=audio,
+            offset=offset,
+            channel=self._get_channel(audio_mode),
+            chunk_duration=chunk_duration
+        )
+
+        logging.info(f'PROGRESSIVE: Writing playlist {self.chunk_writer.playlist}')
+
+        return self.chunk_writer.playlist
+
+    def _get_progressive_directory(self, directory=None):
+        if directory is None:
+            return self.output_directory / PROGRESSIVE_DIRECTORY_NAME
+
+        return convert_path(directory)
+
+    def _publish_jobs(self, jobs, ready, start, total_dur):
+        # Compensate drift of the rendered jobs that follow all published
+        # jobs and publish them in order
+        while start < len(jobs) and jobs[start]['index'] in ready:
+            entry, total_dur = self._compensate_job(jobs[start], total_dur)
+            start += 1
+
+            if entry is None:
                 continue
 
-            file, outfile, out_duration, ss = res
+            chunk = self.chunk_writer.add(
+                self.random_directory / entry['output'], entry['duration']
+            )
 
-            self._write_segment_to_debug(
-                position=total_dur,
-                filename=outfile.name,
-                ss=ss,
-                diff=diff,
-                original_filename=file.name
+            if chunk is not None:
+                self.notifier.notify({
+                    'status': 'processing-video',
+                    'chunk': len(self.chunk_writer.chunks) - 1,
+                    'playlist': str(self.chunk_writer.playlist)
+                })
+
+        return start, total_dur
+
+    def make_proxies(self, fps=None, gop=12, workers=1):
+        """Start making proxies of all timeline sources in the background."""
+        if self._proxy_cache is None:
+            self._proxy_cache = ProxyCache(
+                self.cache_directory / PROXY_DIRECTORY_NAME, workers=workers
             )
 
-            total_dur += out_duration
+        kwargs = self.timeline['slots'][0]['process_kwargs'] if self.timeline['slots'] else {}
+        self.proxy_params = {
+            'width': kwargs.get('width'),
+            'height': kwargs.get('height'),
+            'fps': fps,
+            'gop': gop
+        }
 
-    @retry(times=5, exceptions=(ValueError,))
-    def _make_segment(
-        self, random_file_gen, prefix, diff, start, end,
-        process_kwargs, raise_error=True
-    ):
-        file = random_file_gen.get()
+        self._proxy_cache.submit(
+            [i['source'] for i in self.timeline['slots']], self.proxy_params
+        )
+
+        self.work_lock.start()
+        self._pin_inputs()
+
+    def _pin_inputs(self):
+        sources = [i['source'] for i in self.timeline['slots']]
+        pins = list(sources)
+
+        if self._proxy_cache is not None:
+            pins += [
+                self._proxy_cache.proxy_file(i, self.proxy_params)
+                for i in sources
+            ]
+
+        self.work_lock.pin([i for i in pins if i is not None])
+
+    def _get_input(self, slot):
+        if self._proxy_cache is not None:
+            proxy = self._proxy_cache.get(slot['source'], self.proxy_params)
+            if proxy is not None:
+                touch(proxy)
+                return proxy
+
+        return slot['source']
+
+    def _get_jobs(self):
+        return make_jobs(self.timeline, self.engine, self.batch_size)
+
+    def _get_rendered(self, job):
+        entry = self.journal.get(job)
+
+        if entry is None:
+            return None
+
+        if not (self.random_directory / entry['output']).exists():
+            return None
+
+        return entry
+
+    @retry(times=5, exceptions=(RenderError,))
+    def _render_job(self, job):
+        with tracing.span(
+            'job', cat='render', index=job['index'], engine=job['engine'],
+            slots=len(job['slots'])
+        ):
+            return self._try_render_job(job)
+
+    def _try_render_job(self, job):
+        try:
+            if job['engine'] == 'batch':
+                return self._render_batch(job)
+            if job['engine'] == 'copy':
+                return self._render_copy(job)
+            return self._render_segment(job)
+        except RenderError:
+            files, durations = self._get_timeline_files()
+            defects = self._get_defects(self.timeline.get('avoid_defects'))
+            for slot in job['slots']:
+                reroll_slot(self.timeline, slot, files, durations, defects)
+            raise
+
+    def _remove_stale_output(self, job, filename):
+        previous = self.journal.entries.get(job['index'])
+
+        if previous is not None and previous['output'] != filename:
+            stale = self.random_directory / previous['output']
+            if stale.exists():
+                os.remove(str(stale))
+
+    def _run_render(self, job, cmd, outfile):
+        self._write_to_debug(cmd)
+
+        runcmd(cmd, timeout=15 * len(job['slots']))
+
+        return self._check_render(job, outfile)
+
+    def _check_render(self, job, outfile):
+        dur = get_duration(outfile, use_cache=False)
+
+        if dur <= 0:
+            if outfile.exists():
+                try:
+                    os.remove(str(outfile))
+                except Exception as e:
+                    logging.error(e)
+
+            sources = ', '.join(i['source'] for i in job['slots'])
+            raise RenderError(
+                f'Error when processing file {sources}: output has has duration={dur}'
+            )
+
+        return self.journal.add(job, outfile.name, dur)
 
-        filename = modify_filename(file.name, prefix=prefix)
+    def _render_segment(self, job):
+        slot, = job['slots']
+
+        filename = modify_filename(
+            os.path.basename(slot['source']), prefix=slot['index']
+        )
         outfile = self.random_directory / filename
 
-        dur = get_duration(file)
+        self._remove_stale_output(job, filename)
 
-        new_start = start * dur if start < 1 else start
+        description = backends.get_backend().cut(
+            start=slot['ss'],
+            length=slot['length'],
+            input_file=self._get_input(slot),
+            output_file=outfile,
+            timeout=15,
+            **slot['process_kwargs']
+        )
 
-        new_end = end * dur if end < 1 else end
-        new_end = dur - end - diff
+        self._write_to_debug(description)
 
-        if new_end < new_start:
-            msg = f'File {file} (duration {dur}, start {start}, end {end}) is too short to generate segment with length {diff}'
-            if raise_error:
-                raise ValueError(msg)
+        return self._check_render(job, outfile)
 
-            logging.error(msg)
-            return
+    def _render_batch(self, job):
+        filename = modify_filename(BATCH_FILENAME, prefix=job['index'])
+        outfile = self.random_directory / filename
 
-        ss = np.random.uniform(new_start, new_end)
+        self._remove_stale_output(job, filename)
 
-        cmd = cs.process_segment(
-            start=ss,
-            length=diff,
-            input_file=file,
+        segments = [
+            (i['ss'], i['length'], input_file, len(get_streams(input_file, 'a')) > 0)
+            for i, input_file in ((i, self._get_input(i)) for i in job['slots'])
+        ]
+
+        cmd = cs.process_batch(
+            segments=segments,
             output_file=outfile,
-            **process_kwargs
+            **job['slots'][0]['process_kwargs']
         )
 
-        self._write_to_debug(cmd)
+        return self._run_render(job, cmd, outfile)
 
-        runcmd(cmd, timeout=15)
+    @property
+    def analysis_cache(self):
+        return self.caches.analysis_cache
 
-        dur = get_duration(outfile)
+    @property
+    def catalog(self):
+        return self.caches.catalog
 
-        if dur <= 0:
-            msg = f'Error when processing file {file}: output has has duration={dur}'
-            if raise_error:
-                raise ValueError(msg)
-            else:
-                if outfile.exists():
-                    try:
-                        os.remove(str(outfile))
-                    except Exception as e:
-                        logging.error(e)
-                return
+    @property
+    def keyframe_index(self):
+        return self.caches.keyframe_index
+
+    @property
+    def defect_index(self):
+        return self.caches.defect_index
+
+    def _get_defects(self, avoid_defects, workers=4):
+        if not avoid_defects:
+            return None
+
+        return partial(self.defect_index.exclusions, workers=workers)
+
+    def index_defects(
+        self, sources=None, src_directory=None, src_paths=None, workers=4,
+        probe_workers=8
+    ):
+        """Analyze all sources missing from the defect index."""
+        src_paths = self._get_src_paths(sources, src_directory, src_paths)
+        files, _ = self._get_source_files(src_paths, probe_workers)
+
+        return self.defect_index.warm(list(files), workers=workers)
+
+    def _prepare_copy(self, jobs, workers):
+        slots = [i for job in jobs for i in job['slots']]
+
+        if self._proxy_cache is not None:
+            # Proxies share codec and resolution, so copy only from proxies
+            logging.info('VIDEO: Waiting for proxies')
+            self._proxy_cache.wait(
+                [i['source'] for i in slots], self.proxy_params
+            )
+
+        formats = set()
+        for slot in slots:
+            video = get_streams(self._get_input(slot), 'v')
+            formats.add(
+                (video[0].get('codec_name'), video[0].get('width'), video[0].get('height'))
+                if video else None
+            )
+
+        if None in formats or len(formats) > 1:
+            raise ValueError(
+                f'Copy engine requires sources with the same video codec and resolution, found {formats}'
+            )
+
+        codec, width, height = formats.pop()
+
+        for slot in slots:
+            kwargs = slot['process_kwargs']
+
+            if kwargs.get('watermark') is not None:
+                raise ValueError('Copy engine does not support watermarks')
+
+            if kwargs.get('width') is not None and (kwargs['width'], kwargs['height']) != (width, height):
+                raise ValueError(
+                    f'Copy engine cannot scale {width}x{height} sources to {kwargs["width"]}x{kwargs["height"]}'
+                )
+
+            if kwargs.get('even_dimensions') and (width % 2 or height % 2):
+                raise ValueError(
+                    f'Copy engine cannot crop {width}x{height} sources to even dimensions'
+                )
+
+        logging.info(f'VIDEO: Copying {codec} {width}x{height} segments')
+
+        self.keyframe_index.warm(
+            [self._get_input(i) for i in slots], workers=workers or 1
+        )
+
+    def _render_copy(self, job):
+        slot, = job['slots']
+
+        filename = modify_filename(
+            os.path.basename(slot['source']), prefix=slot['index']
+        )
+        outfile = self.random_directory / filename
+
+        self._remove_stale_output(job, filename)
+
+        input_file = self._get_input(slot)
+
+        low, high = offset_bounds(
+            get_duration(input_file), slot['length'],
+            self.timeline['start'], self.timeline['end']
+        )
+        ss = snap(
+            self.keyframe_index.get(input_file), slot['ss'], low, high
+        )
+
+        cmd = cs.copy_segment(
+            start=ss,
+            length=slot['length'],
+            input_file=input_file,
+            output_file=outfile
+        )
+
+        return self._run_render(job, cmd, outfile)
+
+    def _compensate_drift(self, workers=None):
+        # Segment durations are rounded to whole frames, so compensate the
+        # accumulated drift by re-rendering jobs that end off the beat. The
+        # correction is applied to the last slot of a job. Corrections are
+        # rendered in the pool assuming that each of them lands on the beat,
+        # and what they miss is corrected in order by the final pass.
+        for _ in range(DRIFT_PASSES):
+            total_dur = 0
+            corrections = []
+
+            for job in self._get_jobs():
+                if self._correct_job(job, total_dur):
+                    corrections.append(job)
+                    total_dur = self._job_target(job)
+                elif job['slots']:
+                    total_dur += self._get_rendered(job)['duration']
+
+            if not corrections:
+                break
+
+            logging.info(
+                f'VIDEO: Re-rendering {len(corrections)} jobs to compensate drift'
+            )
+            for _ in self._run_jobs(corrections, workers):
+                pass
+
+        total_dur = 0
+        for job in self._get_jobs():
+            _, total_dur = self._compensate_job(job, total_dur)
+
+    def _compensate_job(self, job, total_dur):
+        """Re-render `job` if it does not end on the beat after rendered
+        jobs of `total_dur` seconds.
+
+        Returns:
+            (render entry or None if the job was dropped, total duration)
+        """
+        if self._correct_job(job, total_dur):
+            self._render_job(job)
+
+        if not job['slots']:
+            return None, total_dur
+
+        entry = self._get_rendered(job)
+        self._write_job_to_debug(job, entry, total_dur)
+
+        return entry, total_dur + entry['duration']
+
+    def _job_target(self, job):
+        slots = self.timeline['slots']
+        index = job['slots'][-1]['index']
+
+        if index < len(slots) - 1:
+            return slots[index + 1]['position']
+
+        return self.timeline['duration']
+
+    def _correct_job(self, job, total_dur):
+        """Fit the last slot of `job` to end on the beat after rendered jobs
+        of `total_dur` seconds.
+
+        Returns:
+            True if the job has to be rendered again
+        """
+        last = job['slots'][-1]
+        diff = self._job_target(job) - total_dur
+        other = sum(i['length'] for i in job['slots'][:-1])
+
+        entry = self._get_rendered(job)
 
-        return file, outfile, dur, ss
+        if diff - other <= 0:
+            logging.info(f'VIDEO: Dropping segment {last["index"]}')
+            last['length'] = 0
+            job['slots'] = job['slots'][:-1]
+
+            if not job['slots']:
+                os.remove(str(self.random_directory / entry['output']))
+                return False
+
+            return True
+
+        if abs(diff - entry['duration']) <= DRIFT_TOLERANCE:
+            return False
+
+        key = job_key(job)
+        last['length'] = diff - other
+
+        # The same slots can not end closer to the beat, so keep the
+        # journaled output and let the next job take the drift
+        return job_key(job) != key
+
+    def _write_job_to_debug(self, job, entry, position):
+        for slot in job['slots']:
+            self._write_segment_to_debug(
+                position=position,
+                filename=entry['output'],
+                ss=slot['ss'],
+                diff=slot['length'],
+                original_filename=os.path.basename(slot['source'])
+            )
+            position += slot['length']
 
     def _write_segment_to_debug(
         self, position, filename, ss, diff, original_filename
@@ -448,10 +1482,13 @@ class MVGen(object):
     def make_join_file(self):
         logging.info(f'VIDEO: MAKING JOIN FILE for {self.random_directory}')
 
-        self.random_file = self.directory / RANDOM_FILENAME
+        self.random_file = self.output_directory / RANDOM_FILENAME
 
-        fs = list(self.random_directory.iterdir())
-        fs.sort(key=lambda x: natural_keys(x.name))
+        if self.outputs is not None:
+            fs = self.outputs
+        else:
+            fs = list(self.random_directory.iterdir())
+            fs.sort(key=lambda x: natural_keys(x.name))
 
         with open(str(self.random_file), 'w') as tf:
             for f in fs:
@@ -466,7 +1503,7 @@ class MVGen(object):
         if not CUDA:
             logging.info('VIDEO: Not using CUDA')
 
-        self.video = self.directory / VIDEO_FILENAME
+        self.video = self.output_directory / VIDEO_FILENAME
 
         logging.info(f'VIDEO: JOINING {self.random_file} into {self.video}')
 
@@ -494,25 +1531,18 @@ class MVGen(object):
     ):
         self.notifier.notify({'status': 'finalizing'})
 
-        final_file = self.directory / FINAL_FILENAME
+        self._close_debug()
+
+        final_file = self.output_directory / FINAL_FILENAME
 
         if os.path.exists(self.audio):
             logging.info(f'FINALIZE: Joining audio and video using audio mode {audio_mode}')
 
-            if audio_mode == 'audio':
-                channel = 1
-            elif audio_mode == 'original':
-                channel = 0
-            elif audio_mode == 'mix':
-                channel = 'mix'
-            else:
-                raise ValueError(audio_mode)
-
             cmd = cs.join_audio_video(
                 offset=offset,
                 video=self.video,
                 audio=self.audio,
-                channel=channel,
+                channel=self._get_channel(audio_mode),
                 output=final_file
             )
 
@@ -529,26 +1559,138 @@ class MVGen(object):
         if ready_directory is not None:
             logging.info(f'FINALIZE: Moving results to ready directory {ready_directory}')
 
-            video_suffix = os.path.splitext(FINAL_FILENAME)[-1]
-            debug_suffix = os.path.splitext(DEBUG_FILENAME)[-1]
+            ready_file = self._get_final_file(ready_directory)
 
-            debug_file = self.directory / DEBUG_FILENAME
+            logging.info(f'FINALIZE: Moving {final_file} to {ready_file}')
+            place(final_file, ready_file, move=delete_work_dir)
+
+            final_file = ready_file
 
-            ready_directory = convert_path(ready_directory)
-            ready_file = ready_directory / (self.directory.name + video_suffix)
-            ready_debug_file = ready_directory / (self.directory.name + debug_suffix)
+        return self._publish(final_file, ready_directory, delete_work_dir)
 
-            logging.info(f'FINALIZE: Moving {final_file} to {ready_file}')
-            shutil.copy(str(final_file), str(ready_file))
+    def join_finalize(
+        self, ready_directory=None, offset=0, delete_work_dir=True,
+        audio_mode='audio', convert=False, output_codec=None
+    ):
+        """Join segments and mux in audio with one ffmpeg run.
+
+        Replaces `join` and `finalize`. The final file is written once,
+        straight into `ready_directory` under a temporary name that is
+        renamed when done, instead of writing the joined video, the video
+        with audio and a copy of it.
+        """
+        self.notifier.notify({'status': 'encoding-video'})
+
+        final_file = self._get_final_file(ready_directory)
+        tmp = final_file.with_name(f'.{final_file.stem}.tmp{final_file.suffix}')
+
+        audio = self.audio if os.path.exists(self.audio) else None
+
+        logging.info(
+            f'VIDEO: JOINING {self.random_file} with audio {audio} '
+            f'using audio mode {audio_mode} into {final_file}'
+        )
+
+        cmd = cs.join_final(
+            input_file=self.random_file,
+            output=tmp,
+            audio=audio,
+            offset=offset,
+            channel=self._get_channel(audio_mode),
+            convert=convert,
+            output_codec=output_codec
+        )
+
+        self._write_to_debug(cmd)
+        self._close_debug()
+
+        try:
+            runcmd(cmd, raise_error=True)
+            os.replace(str(tmp), str(final_file))
+        finally:
+            if tmp.exists():
+                os.remove(str(tmp))
+
+        self.video = final_file
+
+        return self._publish(final_file, ready_directory, delete_work_dir)
+
+    def assemble(
+        self, ready_directory=None, delete_work_dir=True,
+        progressive_directory=None
+    ):
+        """Join the chunks of the progressive output into the final file.
+
+        Replaces `join` and `finalize` after a progressive `generate`. Chunks
+        already contain the audio, so streams are only copied. In a resumed
+        job, chunks are read from the playlist in `progressive_directory`.
+        """
+        if self.chunk_writer is None:
+            self.chunk_writer = ChunkWriter(
+                self._get_progressive_directory(progressive_directory),
+                resume=True
+            )
+
+        if not self.chunk_writer.finished:
+            raise ValueError(
+                f'No finished progressive output in {self.chunk_writer.directory}, '
+                'generate with progressive=True'
+            )
+
+        self.notifier.notify({'status': 'finalizing'})
+
+        final_file = self._get_final_file(ready_directory)
+        tmp = final_file.with_name(f'.{final_file.stem}.tmp{final_file.suffix}')
+
+        logging.info(
+            f'FINALIZE: Assembling {len(self.chunk_writer.chunks)} chunks '
+            f'into {final_file}'
+        )
+
+        try:
+            cmd = self.chunk_writer.assemble(tmp)
+            os.replace(str(tmp), str(final_file))
+        finally:
+            if tmp.exists():
+                os.remove(str(tmp))
+
+        self._write_to_debug(cmd)
+        self._close_debug()
+
+        self.video = final_file
+
+        return self._publish(final_file, ready_directory, delete_work_dir)
+
+    @staticmethod
+    def _get_channel(audio_mode):
+        if audio_mode not in AUDIO_CHANNELS:
+            raise ValueError(audio_mode)
+        return AUDIO_CHANNELS[audio_mode]
+
+    def _get_final_file(self, ready_directory=None):
+        if ready_directory is None:
+            return self.output_directory / FINAL_FILENAME
+
+        video_suffix = os.path.splitext(FINAL_FILENAME)[-1]
+        ready_directory = convert_path(ready_directory)
+        return ready_directory / (self.output_name + video_suffix)
+
+    def _publish(self, final_file, ready_directory, delete_work_dir):
+        if ready_directory is not None:
+            debug_suffix = os.path.splitext(DEBUG_FILENAME)[-1]
+
+            debug_file = self.directory / DEBUG_FILENAME
+            ready_debug_file = convert_path(ready_directory) / (self.output_name + debug_suffix)
 
             logging.info(f'FINALIZE: Moving {debug_file} to {ready_debug_file}')
-            shutil.copy(str(debug_file), str(ready_debug_file))
+            place(debug_file, ready_debug_file, move=delete_work_dir)
 
             if delete_work_dir:
-                logging.info(f'FINALIZE: Deleting work directory {self.directory}')
-                shutil.rmtree(str(self.directory))
+                # Only the directory of a preview, a full render may follow
+                logging.info(f'FINALIZE: Deleting work directory {self.output_directory}')
+                shutil.rmtree(str(self.output_directory))
 
-            final_file = ready_file
+        self.work_lock.release()
 
         logging.info(f'FINALIZE: Final file {final_file}')
 
@@ -556,21 +1698,94 @@ class MVGen(object):
 
         return final_file
 
+    def collect_garbage(
+        self, work_budget=None, proxy_budget=None, segments_directory=None,
+        segments_budget=None, orphan_age=None
+    ):
+        """Delete work directories of crashed jobs and evict least recently
+        used work directories, proxies and segments over their budgets.
+
+        Budgets are bytes or strings like "50G". Nothing used by a running
+        job is evicted.
+        """
+        if self.directory.exists():
+            # Resumed job, keep its work directory
+            self.work_lock.start()
+
+        manager = StorageManager(self.work_directory)
+
+        if orphan_age is not None:
+            manager.orphan_age = orphan_age
+
+        manager.add(self.work_directory, work_budget)
+        manager.add(
+            self.cache_directory / PROXY_DIRECTORY_NAME, proxy_budget
+        )
+        if segments_directory is not None:
+            manager.add(convert_path(segments_directory), segments_budget, depth=2)
+
+        return manager.collect()
+
+    def close(self):
+        """Release the work lock, close the debug file and stop proxies that
+        are not being made yet. Caches stay open."""
+        self.work_lock.release()
+        self._close_debug()
+
+        if self._proxy_cache is not None:
+            self._proxy_cache.shutdown(wait=True, cancel=True)
+
+    def export_trace(self, tracer):
+        """Write Chrome trace and summary next to the final file."""
+        directory = Path(self.final_file).parent
+
+        trace_file = directory / f'{self.output_name}_{tracing.TRACE_FILENAME}'
+        summary_file = directory / f'{self.output_name}_{tracing.TRACE_SUMMARY_FILENAME}'
+
+        logging.info(f'TRACE: Writing {trace_file}')
+        tracer.export(trace_file)
+        tracer.write_summary(summary_file)
+
+        return trace_file
+
     @staticmethod
     def run(config):
+        # The tracer and backend of the job stay in a context of its own, so
+        # they do not leak to later jobs run by the same thread of a server
+        return contextvars.copy_context().run(MVGen._run, config)
+
+    @staticmethod
+    def _run(config):
         started = datetime.datetime.now()
 
-        gen = MVGen(**get_args(config, MVGen))
+        tracer = tracing.Tracer() if config.get('trace') else None
+        if tracer is not None:
+            tracing.activate(tracer)
 
-        gen.load_audio(**get_args(config, MVGen.load_audio))
+        gen = None
 
-        gen.generate(**get_args(config, MVGen.generate))
+        try:
+            gen = MVGen(**get_args(config, MVGen))
+
+            if config.get('progressive'):
+                stages = PROGRESSIVE_STAGES
+            elif config.get('single_pass'):
+                stages = SINGLE_PASS_STAGES
+            else:
+                stages = RUN_STAGES
 
-        gen.make_join_file(**get_args(config, MVGen.make_join_file))
+            for stage in stages:
+                with tracing.span(stage):
+                    getattr(gen, stage)(**get_args(config, getattr(MVGen, stage)))
+        finally:
+            if gen is not None:
+                gen.close()
 
-        gen.join(**get_args(config, MVGen.join))
+            if tracer is not None:
+                tracing.activate(None)
 
-        gen.finalize(**get_args(config, MVGen.finalize))
+        if tracer is not None:
+            gen.export_trace(tracer)
 
         finished = datetime.datetime.now()
 
@@ -0,0 +1,89 @@
+"""Placement of files without full copies where the filesystem allows it."""
+
+import os
+import errno
+import shutil
+import logging
+
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logging.basicConfig(level=logging.INFO)
+
+# Linux ioctl that shares extents of a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def reflink(src, dest):
+    """Clone `src` to `dest` sharing data blocks (btrfs, XFS, ...)."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+
+    with open(str(src), 'rb') as s, open(str(dest), 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(str(dest))
+            raise
+
+
+def _tmp(dest):
+    return dest.with_name(f'.{dest.name}.tmp')
+
+
+def _link(src, dest):
+    """Place a copy of `src` at `dest` by reflink or streamed copy.
+
+    Hardlinks are never used, as writes to either file would show in both.
+    """
+    tmp = _tmp(dest)
+    if tmp.exists():
+        os.remove(str(tmp))
+
+    for method, function in (('reflink', reflink), ('copy', shutil.copyfile)):
+        try:
+            function(str(src), str(tmp))
+        except OSError:
+            if tmp.exists():
+                os.remove(str(tmp))
+            if method == 'copy':
+                raise
+            continue
+
+        os.replace(str(tmp), str(dest))
+        return method
+
+
+def place(src, dest, move=False):
+    """Put file `src` at `dest` with the cheapest available method.
+
+    A moved file is renamed when `src` and `dest` are on the same filesystem.
+    Otherwise, and for copies, `dest` is a reflink of `src` if supported, else
+    a streamed copy. Reflinks share data blocks copy-on-write, so `src` and
+    `dest` stay independent files.
+
+    Returns:
+        name of the method used
+    """
+    src, dest = Path(src), Path(dest)
+
+    if move:
+        try:
+            os.replace(str(src), str(dest))
+            method = 'rename'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            method = _link(src, dest)
+            os.remove(str(src))
+    else:
+        method = _link(src, dest)
+
+    logging.info(f'PLACE: {src} to {dest} by {method}')
+
+    return method
@@ -0,0 +1,182 @@
+"""Persistent media probe cache."""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from mvgen import backends
+from mvgen import tracing
+
+logging.basicConfig(level=logging.INFO)
+
+PROBE_CACHE_FILENAME = 'probe.sqlite'
+
+STREAM_FIELDS = (
+    'index', 'codec_type', 'codec_name', 'profile', 'pix_fmt', 'width',
+    'height', 'r_frame_rate', 'sample_rate', 'channels', 'duration',
+    'bit_rate'
+)
+
+STREAM_TYPES = {'v': 'video', 'a': 'audio', 's': 'subtitle', 'd': 'data'}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS probe (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    duration REAL,
+    bitrate REAL,
+    width INTEGER,
+    height INTEGER,
+    streams TEXT
+)
+'''
+
+_CACHE = None
+
+
+def activate(cache):
+    """Make `cache` the probe cache used by `mvgen.utils` probe helpers."""
+    global _CACHE
+    _CACHE = cache
+
+
+def get_cache():
+    return _CACHE
+
+
+def identity(path):
+    """Return (path, size, mtime) key of a file, or None if it is missing."""
+    path = os.path.abspath(str(path))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_probe(output):
+    """Convert ffprobe JSON output into a probe record."""
+    try:
+        data = json.loads(output)
+    except ValueError:
+        data = {}
+
+    fmt = data.get('format', {})
+    streams = [
+        {k: s[k] for k in STREAM_FIELDS if k in s}
+        for s in data.get('streams', [])
+    ]
+    video = [s for s in streams if s.get('codec_type') == 'video']
+
+    return {
+        'duration': _to_float(fmt.get('duration')),
+        'bitrate': _to_float(fmt.get('bit_rate')),
+        'width': video[0].get('width') if video else None,
+        'height': video[0].get('height') if video else None,
+        'streams': streams
+    }
+
+
+def probe_file(path):
+    """Probe `path` once with the active media backend."""
+    return backends.get_backend().probe(path)
+
+
+class ProbeCache:
+    """SQLite cache of ffprobe results keyed by path, size and mtime."""
+
+    def __init__(self, path):
+        self.filename = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.filename, timeout=30, check_same_thread=False
+        )
+        with self.lock, self.conn:
+            self.conn.execute(SCHEMA)
+
+    def _lookup(self, key):
+        row = self.conn.execute(
+            'SELECT duration, bitrate, width, height, streams FROM probe '
+            'WHERE path = ? AND size = ? AND mtime = ?', key
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'duration': row[0],
+            'bitrate': row[1],
+            'width': row[2],
+            'height': row[3],
+            'streams': json.loads(row[4]) if row[4] else []
+        }
+
+    def _store(self, records):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO probe '
+            '(path, size, mtime, duration, bitrate, width, height, streams) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                key + (
+                    r['duration'], r['bitrate'], r['width'], r['height'],
+                    json.dumps(r['streams'])
+                )
+                for key, r in records
+            ]
+        )
+
+    def get(self, path):
+        """Return probe record of `path`, probing it on a cache miss."""
+        key = identity(path)
+        if key is None:
+            return parse_probe('')
+
+        with self.lock:
+            record = self._lookup(key)
+
+        if record is None:
+            record = probe_file(key[0])
+            with self.lock, self.conn:
+                self._store([(key, record)])
+
+        return record
+
+    def warm(self, paths, workers=8):
+        """Probe all `paths` missing from the cache in one parallel pass."""
+        keys = [k for k in (identity(p) for p in paths) if k is not None]
+
+        with self.lock:
+            missing = [k for k in keys if self._lookup(k) is None]
+
+        if not missing:
+            return 0
+
+        logging.info(f'PROBE: Probing {len(missing)} of {len(keys)} files')
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            records = list(tqdm(
+                executor.map(tracing.bind(probe_file), [k[0] for k in missing]),
+                total=len(missing)
+            ))
+
+        with self.lock, self.conn:
+            self._store(list(zip(missing, records)))
+
+        return len(missing)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
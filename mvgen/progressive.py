@@ -0,0 +1,202 @@
+"""Progressive output of a mix as a growing HLS playlist of chunks."""
+
+import os
+import math
+import logging
+
+from pathlib import Path
+
+from mvgen import commands as cs
+from mvgen import tracing
+from mvgen.utils import mkdir, runcmd
+from mvgen.variables import WSL
+
+logging.basicConfig(level=logging.INFO)
+
+PROGRESSIVE_DIRECTORY_NAME = 'hls'
+PLAYLIST_FILENAME = 'index.m3u8'
+CHUNKS_FILENAME = 'chunks.txt'
+CHUNK_FILENAME = 'chunk_{:05d}.ts'
+
+# Files of a previous output, including temporary files of `ChunkWriter`
+OUTPUT_PATTERNS = (
+    'chunk_*.ts', PLAYLIST_FILENAME, CHUNKS_FILENAME, '.chunk_*.ts.tmp',
+    '.chunk_*.txt', f'.{PLAYLIST_FILENAME}.tmp'
+)
+
+
+def write_concat_list(filename, paths):
+    with open(str(filename), 'w') as tf:
+        for f in paths:
+            f = os.path.abspath(f)
+            if WSL:
+                f = cs.windowspath(f)
+            tf.write("file '{}'\n".format(f))
+
+
+def _replace_text(filename, text):
+    tmp = filename.with_name(f'.{filename.name}.tmp')
+    with open(str(tmp), 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(str(tmp), str(filename))
+
+
+class ChunkWriter:
+    """Publish rendered segments as MPEG-TS chunks with audio.
+
+    Segments are added in timeline order. Once at least `chunk_duration`
+    seconds are pending, they are muxed with the matching part of `audio`
+    into a chunk, and the chunk is appended to an HLS event playlist, so the
+    mix is playable while later slots are rendered. Chunks end on segment
+    boundaries, i.e. on beats.
+
+    Args:
+        directory: str or Path
+            Directory of chunks and playlist. Chunks and playlist of a
+            previous output are removed, other files are kept.
+        audio: str, Path or None
+            Audio of the mix. If None, the audio of the segments is used.
+        offset: float
+            Offset of the video against the audio, see `MVGen.finalize`.
+        channel: int or str
+            Audio channel, see `AUDIO_CHANNELS`.
+        chunk_duration: float
+            Minimum duration of a chunk in seconds.
+        resume: bool
+            Keep the chunks of a previous output and read them from its
+            playlist instead, e.g. to `assemble` them.
+    """
+
+    def __init__(
+        self, directory, audio=None, offset=0, channel=1, chunk_duration=10,
+        resume=False
+    ):
+        self.directory = Path(directory)
+        self.audio = audio
+        self.offset = offset
+        self.channel = channel
+        self.chunk_duration = chunk_duration
+
+        self.playlist = self.directory / PLAYLIST_FILENAME
+        self.chunks = []
+        self.pending = []
+        self.position = 0
+        self.finished = False
+
+        mkdir(self.directory)
+
+        if resume:
+            self._read_playlist()
+        else:
+            for pattern in OUTPUT_PATTERNS:
+                for path in self.directory.glob(pattern):
+                    if path.is_file():
+                        os.remove(str(path))
+
+    def _read_playlist(self):
+        if not self.playlist.exists():
+            return
+
+        length = None
+        with open(str(self.playlist), 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#EXTINF:'):
+                    length = float(line[len('#EXTINF:'):].split(',')[0])
+                elif line == '#EXT-X-ENDLIST':
+                    self.finished = True
+                elif line and not line.startswith('#') and length is not None:
+                    self.chunks.append((self.directory / line, length))
+                    self.position += length
+                    length = None
+
+    def add(self, path, duration):
+        """Add segment `path` and publish a chunk if enough is pending.
+
+        Returns:
+            path of the published chunk or None
+        """
+        self.pending.append((path, duration))
+
+        if sum(i[1] for i in self.pending) < self.chunk_duration:
+            return None
+
+        return self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return None
+
+        length = sum(i[1] for i in self.pending)
+        index = len(self.chunks)
+        chunk = self.directory / CHUNK_FILENAME.format(index)
+        tmp = self.directory / f'.{chunk.name}.tmp'
+        segments = self.directory / f'.{chunk.stem}.txt'
+
+        write_concat_list(segments, [i[0] for i in self.pending])
+
+        cmd = cs.make_chunk(
+            input_file=segments,
+            output=tmp,
+            position=self.position,
+            length=length,
+            audio=self.audio,
+            offset=self.offset,
+            channel=self.channel
+        )
+
+        with tracing.span('chunk', cat='progressive', index=index):
+            try:
+                runcmd(cmd, raise_error=True)
+                os.replace(str(tmp), str(chunk))
+            finally:
+                if tmp.exists():
+                    os.remove(str(tmp))
+                os.remove(str(segments))
+
+        self.chunks.append((chunk, length))
+        self.position += length
+        self.pending = []
+
+        self._write_playlist()
+
+        logging.info(
+            f'PROGRESSIVE: Published {chunk.name}, {self.position:.2f}s playable'
+        )
+
+        return chunk
+
+    def _write_playlist(self, end=False):
+        target = max([self.chunk_duration] + [i[1] for i in self.chunks])
+
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-PLAYLIST-TYPE:EVENT',
+            f'#EXT-X-TARGETDURATION:{math.ceil(target)}',
+            '#EXT-X-MEDIA-SEQUENCE:0',
+            '#EXT-X-INDEPENDENT-SEGMENTS'
+        ]
+        for chunk, length in self.chunks:
+            lines.append(f'#EXTINF:{length:.6f},')
+            lines.append(chunk.name)
+        if end:
+            lines.append('#EXT-X-ENDLIST')
+
+        _replace_text(self.playlist, '\n'.join(lines) + '\n')
+
+    def finish(self):
+        """Publish the pending segments and close the playlist."""
+        self.flush()
+        self._write_playlist(end=True)
+        self.finished = True
+
+    def assemble(self, output):
+        """Join all chunks into `output` without re-encoding."""
+        chunks = self.directory / CHUNKS_FILENAME
+        write_concat_list(chunks, [i[0] for i in self.chunks])
+
+        cmd = cs.join_chunks(input_file=chunks, output=output)
+        runcmd(cmd, raise_error=True)
+
+        return cmd
@@ -0,0 +1,166 @@
+"""Cache of normalized proxies of sources."""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait as wait_all
+
+from mvgen import commands as cs
+from mvgen import tracing
+from mvgen.probe import identity
+from mvgen.storage import _pid_alive
+from mvgen.utils import get_duration, modify_filename, mkdir, runcmd
+
+logging.basicConfig(level=logging.INFO)
+
+PROXY_DIRECTORY_NAME = 'proxies'
+PROXY_SUFFIX = '.mp4'
+TMP_SUFFIX = '.tmp'
+
+# Temporary proxies of other hosts unchanged for this many seconds are
+# left over by killed runs
+TMP_TIMEOUT = 3600
+
+
+def proxy_name(key, params):
+    """Name of the proxy of a source with `identity` key."""
+    data = json.dumps([key, params], sort_keys=True)
+    digest = hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+    fname = os.path.splitext(modify_filename(os.path.basename(key[0])))[0]
+    return f'{fname}_{digest}{PROXY_SUFFIX}'
+
+
+class ProxyCache:
+    """Short-GOP H.264 proxies of sources at the target resolution.
+
+    Proxies are keyed by source path, size, mtime and the proxy parameters,
+    and are transcoded in the background. Until a proxy is ready, its source
+    is used as is.
+    """
+
+    def __init__(self, directory, workers=1):
+        self.directory = Path(directory)
+        mkdir(self.directory)
+
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers or 1)
+        self.futures = {}
+
+        self._remove_stale_tmp()
+
+    def _remove_stale_tmp(self):
+        host = socket.gethostname()
+
+        for path in self.directory.glob(f'*{TMP_SUFFIX}.*'):
+            owner = path.name.rsplit(TMP_SUFFIX + '.', 1)[-1].rsplit('.', 1)[0]
+            owner_host, _, pid = owner.rpartition('.')
+
+            try:
+                if owner_host == host and pid.isdigit():
+                    # Processes of other hosts can not be checked
+                    if _pid_alive(int(pid)):
+                        continue
+                elif time.time() - path.stat().st_mtime < TMP_TIMEOUT:
+                    continue
+
+                os.remove(str(path))
+            except OSError:
+                pass
+
+    def proxy_file(self, source, params):
+        """Path the proxy of `source` has or will have."""
+        key = identity(source)
+        if key is None:
+            return None
+        return self.directory / proxy_name(key, params)
+
+    def get(self, source, params):
+        """Return path of the proxy of `source`, or None if it is not ready."""
+        proxy = self.proxy_file(source, params)
+
+        if proxy is None or not proxy.exists():
+            return None
+
+        return proxy
+
+    def _build(self, source, proxy, params):
+        tmp = proxy.with_name(
+            f'{proxy.name}{TMP_SUFFIX}.{socket.gethostname()}.{os.getpid()}{PROXY_SUFFIX}'
+        )
+
+        cmd = cs.make_proxy(
+            input_file=source,
+            output_file=tmp,
+            width=params['width'],
+            height=params['height'],
+            fps=params['fps'],
+            gop=params['gop']
+        )
+
+        try:
+            runcmd(cmd, raise_error=True)
+
+            if get_duration(tmp, use_cache=False) <= 0:
+                raise ValueError(f'Proxy of {source} has no duration')
+
+            os.replace(str(tmp), str(proxy))
+        except Exception as e:
+            logging.error(f'PROXY: Error when making proxy of {source}: {e}')
+            if tmp.exists():
+                os.remove(str(tmp))
+
+        return proxy
+
+    def submit(self, sources, params):
+        """Start making proxies of all `sources` that have none."""
+        submitted = 0
+
+        with self.lock:
+            for source in dict.fromkeys(str(i) for i in sources):
+                proxy = self.proxy_file(source, params)
+
+                if proxy is None or proxy.exists() or proxy in self.futures:
+                    continue
+
+                self.futures[proxy] = self.executor.submit(
+                    tracing.bind(self._build), source, proxy, params
+                )
+                submitted += 1
+
+        if submitted:
+            logging.info(f'PROXY: Making {submitted} proxies in {self.directory}')
+
+        return submitted
+
+    def wait(self, sources=None, params=None):
+        """Wait until proxies of `sources`, or all submitted proxies, are made."""
+        with self.lock:
+            if sources is None:
+                futures = list(self.futures.values())
+            else:
+                proxies = [self.proxy_file(i, params) for i in sources]
+                futures = [self.futures[i] for i in proxies if i in self.futures]
+
+        wait_all(futures)
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop the background transcodes.
+
+        Args:
+            wait: bool
+                Wait until running transcodes are finished.
+            cancel: bool
+                Drop transcodes that have not started yet.
+        """
+        if cancel:
+            with self.lock:
+                for future in self.futures.values():
+                    future.cancel()
+
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,208 @@
+"""Presegmentation of sources into a store of uniform chunks."""
+
+import os
+import csv
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from mvgen import commands as cs
+from mvgen import tracing
+from mvgen.probe import identity
+from mvgen.storage import touch
+from mvgen.timeline import trims
+from mvgen.utils import get_duration, modify_filename, mkdir, runcmd
+
+logging.basicConfig(level=logging.INFO)
+
+MANIFEST_DIRECTORY_NAME = '.manifests'
+
+
+def source_directory_name(root):
+    """Name of the segment store of source root `root`."""
+    root = os.path.abspath(str(root))
+    digest = hashlib.sha1(root.encode('utf-8')).hexdigest()[:8]
+    return f'{os.path.basename(root)}_{digest}'
+
+
+def segment_name(key, params):
+    """Name of the segment directory of a source with `identity` key."""
+    data = json.dumps([key, params], sort_keys=True)
+    digest = hashlib.sha1(data.encode('utf-8')).hexdigest()[:12]
+    fname = os.path.splitext(modify_filename(os.path.basename(key[0])))[0]
+    return f'{fname}_{digest}'
+
+
+def segment_source(source, directory, manifest, params):
+    """Segment one source into `directory` and write its manifest.
+
+    Segments are written to a temporary directory first, so that a killed
+    run never leaves a partial segment directory behind.
+    """
+    dur = get_duration(source)
+    new_start, new_end = trims(dur, params['segment_start'], params['segment_end'])
+    new_start, length = float(new_start), float(dur - new_start - new_end)
+
+    # Hidden and unique, so that concurrent runs do not share it
+    tmp = directory.with_name(f'.{directory.name}.{uuid.uuid4().hex}.tmp')
+    mkdir(tmp)
+
+    segments = []
+
+    if length > 0:
+        segment_list = tmp.with_suffix('.csv')
+
+        cmd = cs.segment(
+            start=new_start,
+            length=length,
+            input_file=source,
+            output_directory=tmp,
+            segment_list=segment_list,
+            segment_duration=params['segment_duration'],
+            width=params['width'],
+            height=params['height']
+        )
+        runcmd(cmd, raise_error=True)
+
+        with open(str(segment_list), 'r', encoding='utf-8') as file:
+            for name, start, end in csv.reader(file):
+                segments.append({
+                    'name': os.path.basename(name),
+                    'duration': float(end) - float(start)
+                })
+        os.remove(str(segment_list))
+
+    if directory.exists():
+        shutil.rmtree(str(directory))
+    os.replace(str(tmp), str(directory))
+
+    with open(str(manifest), 'w', encoding='utf-8') as file:
+        json.dump({
+            'source': str(source),
+            'params': params,
+            'segments': segments
+        }, file, ensure_ascii=False)
+
+    return segments
+
+
+def _remove(path):
+    try:
+        os.remove(str(path))
+    except FileNotFoundError:
+        pass
+
+
+def read_manifest(manifest):
+    with open(str(manifest), 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _sweep(segment_root, manifest_root):
+    """Remove segments of sources that no longer exist.
+
+    Segments of changed sources or other parameters may still be used by
+    concurrent runs, so they are left to the storage budget.
+    """
+    for manifest in list(manifest_root.glob('*.json')):
+        try:
+            source = read_manifest(manifest)['source']
+        except (FileNotFoundError, ValueError):
+            continue
+
+        if os.path.exists(source):
+            continue
+
+        logging.info(f'SEGMENTS: Removing segments of missing source {source}')
+        shutil.rmtree(str(segment_root / manifest.stem), ignore_errors=True)
+        _remove(manifest)
+
+
+def presegment(
+    roots, files, segments_directory, segment_duration=2, segment_start=0,
+    segment_end=0, force_segment=False, width=None, height=None, workers=1
+):
+    """Segment new or changed sources of `roots` into `segments_directory`.
+
+    Each source root gets its own directory of segment directories. A source
+    is only segmented again when its path, size, mtime or the segmentation
+    parameters change. Segments of sources that no longer exist are removed.
+
+    Args:
+        roots: list of source root directories
+        files: dict of root to list of source files in it
+
+    Returns:
+        (segment roots, list of (segment path, duration))
+    """
+    segments_directory = Path(segments_directory)
+    params = {
+        'segment_duration': segment_duration,
+        'segment_start': segment_start,
+        'segment_end': segment_end,
+        'width': width,
+        'height': height
+    }
+
+    segment_roots = []
+    pending = []
+    expected = {}
+
+    for root in roots:
+        name = source_directory_name(root)
+        segment_root = segments_directory / name
+        manifest_root = segments_directory / MANIFEST_DIRECTORY_NAME / name
+        mkdir(segment_root)
+        mkdir(manifest_root)
+        segment_roots.append(segment_root)
+
+        expected[segment_root] = set()
+
+        for source in files[root]:
+            key = identity(source)
+            if key is None:
+                continue
+
+            directory = segment_root / segment_name(key, params)
+            manifest = manifest_root / (directory.name + '.json')
+            expected[segment_root].add(directory.name)
+
+            if force_segment or not manifest.exists() or not directory.exists():
+                pending.append((source, directory, manifest))
+            else:
+                touch(directory)
+
+    for segment_root in segment_roots:
+        _sweep(
+            segment_root,
+            segments_directory / MANIFEST_DIRECTORY_NAME / segment_root.name
+        )
+
+    logging.info(
+        f'SEGMENTS: Segmenting {len(pending)} sources into {segments_directory}'
+    )
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=workers or 1) as executor:
+            futures = [
+                executor.submit(tracing.bind(segment_source), *i, params) for i in pending
+            ]
+            for future in tqdm(futures):
+                future.result()
+
+    durations = []
+    for segment_root, names in expected.items():
+        manifest_root = segments_directory / MANIFEST_DIRECTORY_NAME / segment_root.name
+        for name in names:
+            for segment in read_manifest(manifest_root / (name + '.json'))['segments']:
+                durations.append(
+                    (segment_root / name / segment['name'], segment['duration'])
+                )
+
+    return segment_roots, durations
@@ -0,0 +1,251 @@
+"""Local job queue server for rendering many mixes in one process.
+
+Usage:
+    python -m mvgen.server --work_directory /path/to/work --port 8765
+
+    curl -X POST localhost:8765/jobs -d '{"audio": "...", "sources": ["vidz"], ...}'
+    curl localhost:8765/jobs/<id>
+"""
+
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+import traceback
+
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mvgen.mvgen import MVGen, Caches
+from mvgen.utils import set_cmd_limit
+
+logging.basicConfig(level=logging.INFO)
+
+MAX_EVENTS = 100
+
+
+class JobNotifier:
+    """Notifier that records status events of one job."""
+
+    def __init__(self, job):
+        self.job = job
+
+    def notify(self, event, *args, **kwargs):
+        with self.job.lock:
+            self.job.events.append(dict(event, time=time.time()))
+            del self.job.events[:-MAX_EVENTS]
+            self.job.status = event.get('status', self.job.status)
+            self.job.progress = event.get('progress')
+
+
+class Job:
+    def __init__(self, config):
+        self.id = uuid.uuid4().hex
+        self.config = config
+        self.state = 'queued'
+        self.status = None
+        self.progress = None
+        self.events = []
+        self.error = None
+        self.final_file = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def to_dict(self, events=False):
+        with self.lock:
+            data = {
+                'id': self.id,
+                'state': self.state,
+                'status': self.status,
+                'progress': self.progress,
+                'error': self.error,
+                'final_file': self.final_file,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished
+            }
+            if events:
+                data['events'] = list(self.events)
+        return data
+
+
+class JobQueue:
+    """Run `MVGen.run` configs concurrently with shared caches.
+
+    Args:
+        config: dict
+            Default config that every submitted config is merged into.
+        jobs: int
+            Number of jobs running at once.
+        ffmpeg_workers: int or None
+            Number of ffmpeg processes running at once across all jobs.
+    """
+
+    def __init__(self, config, jobs=2, ffmpeg_workers=None):
+        self.config = config
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+
+        set_cmd_limit(ffmpeg_workers)
+
+        # Caches stay open for the lifetime of the server
+        self.caches = Caches(
+            work_directory=config['work_directory'],
+            cache_directory=config.get('cache_directory')
+        )
+
+    def submit(self, config):
+        job = Job(dict(deepcopy(self.config), **config))
+
+        with self.lock:
+            self.jobs[job.id] = job
+
+        logging.info(f'SERVER: Queued job {job.id}')
+        self.executor.submit(self._run, job)
+
+        return job
+
+    def _run(self, job):
+        config = dict(
+            job.config,
+            notifier=JobNotifier(job),
+            caches=self.caches
+        )
+        config.setdefault('uid', job.id)
+
+        with job.lock:
+            job.state = 'running'
+            job.started = time.time()
+
+        logging.info(f'SERVER: Running job {job.id}')
+
+        try:
+            gen = MVGen.run(config)
+        except Exception as e:
+            logging.error(f'SERVER: Job {job.id} failed: {e}')
+            with job.lock:
+                job.state = 'failed'
+                job.error = traceback.format_exc()
+        else:
+            with job.lock:
+                job.state = 'done'
+                job.final_file = str(gen.final_file)
+        finally:
+            with job.lock:
+                job.finished = time.time()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class Handler(BaseHTTPRequestHandler):
+    queue = None
+
+    def _send(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parts(self):
+        return [i for i in self.path.split('?')[0].split('/') if i]
+
+    def do_GET(self):
+        parts = self._parts()
+
+        if parts == ['jobs']:
+            return self._send(200, [i.to_dict() for i in self.queue.list()])
+
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = self.queue.get(parts[1])
+            if job is None:
+                return self._send(404, {'error': f'Unknown job {parts[1]}'})
+            return self._send(200, job.to_dict(events=True))
+
+        self._send(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self._parts() != ['jobs']:
+            return self._send(404, {'error': f'Unknown path {self.path}'})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            config = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            return self._send(400, {'error': f'Invalid JSON: {e}'})
+
+        if not isinstance(config, dict):
+            return self._send(400, {'error': 'Config must be a JSON object'})
+
+        job = self.queue.submit(config)
+        self._send(202, job.to_dict())
+
+    def log_message(self, format, *args):
+        logging.debug(f'SERVER: {format % args}')
+
+
+def make_server(queue, host='127.0.0.1', port=8765):
+    handler = type('JobHandler', (Handler,), {'queue': queue})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', help='Path to default config file.')
+    parser.add_argument('--work_directory', help='Work directory.')
+    parser.add_argument('--cache_directory', help='Cache directory.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument(
+        '--jobs', type=int, default=2,
+        help='Number of jobs running at once.'
+    )
+    parser.add_argument(
+        '--ffmpeg_workers', type=int,
+        help='Number of ffmpeg processes running at once across all jobs.'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import yaml
+
+    args = parse_args()
+
+    config = {}
+    if args.config is not None:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = yaml.load(f, Loader=yaml.SafeLoader) or {}
+
+    for key in ('work_directory', 'cache_directory'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    queue = JobQueue(config, jobs=args.jobs, ffmpeg_workers=args.ffmpeg_workers)
+    server = make_server(queue, args.host, args.port)
+
+    logging.info(f'SERVER: Listening on {args.host}:{args.port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        queue.shutdown(wait=False)
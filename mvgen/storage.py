@@ -0,0 +1,296 @@
+"""Disk budgets of work, proxy and segment directories."""
+
+import os
+import json
+import time
+import shutil
+import socket
+import logging
+import threading
+
+from pathlib import Path
+
+logging.basicConfig(level=logging.INFO)
+
+LOCK_FILENAME = '.lock'
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 120
+ORPHAN_AGE = 24 * 60 * 60
+
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+    """Convert size like 1024, "500M" or "2G" to bytes."""
+    if size is None or isinstance(size, (int, float)):
+        return size
+
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(float(size))
+
+
+def disk_usage(path):
+    """Total size in bytes of file or directory tree `path`."""
+    path = str(path)
+
+    if not os.path.isdir(path):
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def touch(path):
+    """Mark `path` as recently used."""
+    try:
+        os.utime(str(path))
+    except OSError:
+        pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def read_lock(directory, name=LOCK_FILENAME):
+    try:
+        with open(str(Path(directory) / name), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_live(lock, timeout=HEARTBEAT_TIMEOUT):
+    """Whether the job that wrote `lock` is still running."""
+    if lock is None:
+        return False
+
+    if lock.get('host') == socket.gethostname() and not _pid_alive(lock['pid']):
+        return False
+
+    return time.time() - lock['heartbeat'] < timeout
+
+
+class WorkLock:
+    """Lock file of a running job with a heartbeat and pinned paths.
+
+    Storage eviction never removes the work directory of a live job or
+    anything its pinned paths point into.
+    """
+
+    def __init__(self, directory, interval=HEARTBEAT_INTERVAL, name=LOCK_FILENAME):
+        self.filename = Path(directory) / name
+        self.interval = interval
+        self.pins = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _write(self):
+        data = {
+            'pid': os.getpid(),
+            'host': socket.gethostname(),
+            'heartbeat': time.time(),
+            'pins': self.pins
+        }
+
+        tmp = self.filename.with_name(self.filename.name + '.tmp')
+        with self.lock:
+            if not self.filename.parent.exists():
+                return
+            with open(str(tmp), 'w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False)
+            os.replace(str(tmp), str(self.filename))
+
+    def _beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self._write()
+            except OSError as e:
+                logging.error(f'STORAGE: Heartbeat failed: {e}')
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self._write()
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+        self.thread.start()
+
+    def pin(self, paths):
+        """Protect `paths` and everything in them from eviction while the
+        job runs, in addition to paths pinned before."""
+        self.pins = sorted(
+            set(self.pins) | {os.path.abspath(str(i)) for i in paths}
+        )
+        self._write()
+
+    def release(self):
+        if self.thread is None:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+        with self.lock:
+            if self.filename.exists():
+                os.remove(str(self.filename))
+
+
+class StorageManager:
+    """Keep directories within byte budgets by evicting least recently used
+    entries, and delete work directories of crashed jobs.
+
+    Args:
+        work_directory: Path
+            Directory of job work directories.
+        orphan_age: float
+            Seconds since the last heartbeat of a crashed job after which
+            its work directory is deleted. Until then it can be resumed.
+    """
+
+    def __init__(
+        self, work_directory, orphan_age=ORPHAN_AGE,
+        heartbeat_timeout=HEARTBEAT_TIMEOUT
+    ):
+        self.work_directory = Path(work_directory)
+        self.orphan_age = orphan_age
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stores = []
+
+    def add(self, directory, budget, depth=1):
+        """Keep `directory` within `budget` bytes.
+
+        Entries evicted as a whole are the files and directories `depth`
+        levels below `directory`. Names starting with a dot are never evicted.
+        """
+        budget = parse_size(budget)
+        if directory is not None and budget is not None:
+            self.stores.append((Path(directory), budget, depth))
+
+    def _work_directories(self):
+        if not self.work_directory.exists():
+            return []
+        return [
+            i for i in self.work_directory.iterdir()
+            if i.is_dir() and not i.name.startswith('.')
+        ]
+
+    def _live(self):
+        """Return live work directories and all pinned paths."""
+        directories, pins = set(), set()
+
+        for directory in self._work_directories():
+            lock = read_lock(directory)
+            if is_live(lock, self.heartbeat_timeout):
+                directories.add(os.path.abspath(str(directory)))
+                pins.update(lock.get('pins', []))
+
+        return directories, pins
+
+    def remove_orphans(self):
+        """Delete work directories of crashed jobs older than `orphan_age`."""
+        removed = []
+
+        for directory in self._work_directories():
+            lock = read_lock(directory)
+            if lock is None or is_live(lock, self.heartbeat_timeout):
+                continue
+
+            if time.time() - lock['heartbeat'] < self.orphan_age:
+                continue
+
+            logging.info(f'STORAGE: Removing orphaned work directory {directory}')
+            shutil.rmtree(str(directory), ignore_errors=True)
+            removed.append(directory)
+
+        return removed
+
+    @staticmethod
+    def _entries(directory, depth):
+        entries = [directory]
+        for _ in range(depth):
+            entries = [
+                i for e in entries if e.is_dir() for i in e.iterdir()
+                if not i.name.startswith('.') and '.tmp' not in i.name
+            ]
+        return entries
+
+    @staticmethod
+    def _is_pinned(entry, live, pins):
+        entry = os.path.abspath(str(entry))
+        prefix = entry + os.sep
+
+        if entry in live:
+            return True
+
+        return any(
+            i == entry or i.startswith(prefix) or entry.startswith(i + os.sep)
+            for i in pins
+        )
+
+    def evict(self, directory, budget, depth=1):
+        """Remove least recently used entries until `directory` fits `budget`."""
+        live, pins = self._live()
+
+        entries = []
+        for entry in self._entries(Path(directory), depth):
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            entries.append((mtime, entry, disk_usage(entry)))
+
+        total = sum(i[2] for i in entries)
+        freed = 0
+
+        for mtime, entry, size in sorted(entries, key=lambda x: x[0]):
+            if total - freed <= budget:
+                break
+
+            if self._is_pinned(entry, live, pins):
+                continue
+
+            logging.info(f'STORAGE: Evicting {entry} ({size} bytes)')
+            if entry.is_dir():
+                shutil.rmtree(str(entry), ignore_errors=True)
+            else:
+                os.remove(str(entry))
+            freed += size
+
+        if total - freed > budget:
+            logging.warning(
+                f'STORAGE: {directory} uses {total - freed} bytes of {budget} '
+                f'after eviction, the rest is in use'
+            )
+
+        return freed
+
+    def collect(self):
+        """Delete orphaned work directories and evict all stores to budget."""
+        self.remove_orphans()
+
+        freed = 0
+        for directory, budget, depth in self.stores:
+            if directory.exists():
+                freed += self.evict(directory, budget, depth)
+
+        return freed
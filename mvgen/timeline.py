@@ -0,0 +1,357 @@
+"""Seeded segment planning and timeline files."""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from pathlib import Path
+
+TIMELINE_FILENAME = 'timeline.json'
+JOURNAL_FILENAME = 'rendered.jsonl'
+TIMELINE_VERSION = 1
+
+
+def new_seed():
+    return int(np.random.SeedSequence().entropy % 2 ** 32)
+
+
+def slot_rng(seed, index, attempt):
+    """Random generator for re-rolling slot `index` for the `attempt` time."""
+    return np.random.default_rng([seed, index, attempt])
+
+
+def trims(durations, start, end):
+    """Return seconds trimmed from start and end of sources.
+
+    Values of `start` and `end` below 1 are fractions of the duration.
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    new_start = start * durations if start < 1 else np.full_like(durations, start)
+    new_end = end * durations if end < 1 else np.full_like(durations, end)
+    return new_start, new_end
+
+
+def offset_bounds(dur, diff, start, end):
+    """Return range of valid offsets for a segment of length `diff`."""
+    new_start, new_end = trims(dur, start, end)
+    return float(new_start), float(dur - new_end - diff)
+
+
+def sample_slots(durations, diffs, start, end, rng):
+    """Pick source index and offset for segments of lengths `diffs`.
+
+    Only sources long enough for a segment are drawn, uniformly, so no
+    source is ever rejected after being picked.
+
+    Args:
+        durations: array of source durations, NaN if unknown
+        diffs: array of segment lengths
+        rng: numpy.random.Generator
+
+    Returns:
+        (indices, offsets) arrays
+    """
+    durations = np.nan_to_num(np.asarray(durations, dtype=np.float64))
+    diffs = np.asarray(diffs, dtype=np.float64)
+
+    new_start, new_end = trims(durations, start, end)
+    usable = durations - new_start - new_end
+
+    order = np.argsort(usable, kind='stable')
+    first = np.searchsorted(usable[order], diffs, side='left')
+    eligible = len(durations) - first
+
+    if np.any(eligible == 0):
+        diff = diffs[eligible == 0].max()
+        raise ValueError(
+            f'No source long enough to generate segment with length {diff} '
+            f'(start {start}, end {end})'
+        )
+
+    picks = first + (rng.random(len(diffs)) * eligible).astype(np.int64)
+    indices = order[np.minimum(picks, len(durations) - 1)]
+
+    offsets = (
+        new_start[indices]
+        + rng.random(len(diffs)) * (usable[indices] - diffs)
+    )
+
+    return indices, offsets
+
+
+def move_offset(ss, low, high, diff, intervals=(), starts=()):
+    """Move offset `ss` in [low, high] of a segment of length `diff` out of
+    defects.
+
+    The segment must not overlap any of `intervals` and must not start in
+    any of `starts`. The offset keeps its relative position among the valid
+    offsets, so no random numbers are drawn. If there is no valid offset,
+    `ss` is returned.
+    """
+    if high <= low:
+        return ss
+
+    blocked = [(a - diff, b) for a, b in intervals] + [tuple(i) for i in starts]
+    blocked = sorted(
+        (max(a, low), min(b, high)) for a, b in blocked if a < high and b > low
+    )
+
+    if not blocked:
+        return ss
+
+    allowed = []
+    cursor = low
+    for a, b in blocked:
+        if a > cursor:
+            allowed.append((cursor, a))
+        cursor = max(cursor, b)
+    if cursor < high:
+        allowed.append((cursor, high))
+
+    total = sum(b - a for a, b in allowed)
+    if total <= 0:
+        return ss
+
+    position = (ss - low) / (high - low) * total
+    for a, b in allowed:
+        if position <= b - a:
+            return a + position
+        position -= b - a
+
+    return allowed[-1][1]
+
+
+def avoid_defects(files, indices, offsets, diffs, durations, start, end, defects):
+    """Move sampled offsets out of defects of their sources.
+
+    Args:
+        defects: function that returns (intervals, starts) of every path of
+            a list of paths, see `move_offset`
+
+    Returns:
+        array of offsets
+    """
+    durations = np.nan_to_num(np.asarray(durations, dtype=np.float64))
+    new_start, new_end = trims(durations, start, end)
+
+    exclusions = defects([files[i] for i in indices])
+
+    return np.array([
+        move_offset(
+            ss, new_start[index], durations[index] - new_end[index] - diff,
+            diff, intervals, starts
+        )
+        for index, ss, diff, (intervals, starts)
+        in zip(indices, offsets, diffs, exclusions)
+    ], dtype=np.float64)
+
+
+def make_slot(index, source, ss, length, position, process_kwargs):
+    return {
+        'index': index,
+        'source': os.path.abspath(str(source)),
+        'ss': ss,
+        'length': float(length),
+        'position': float(position),
+        'attempt': 0,
+        'process_kwargs': dict(process_kwargs)
+    }
+
+
+def plan(
+    beats, sources, files, durations, rng, seed, start, end, process_kwargs,
+    defects=None
+):
+    """Plan source and offset of every beat slot.
+
+    The result only depends on the seed, the beats and the source files, so
+    planning the same inputs twice gives the same timeline.
+
+    Args:
+        files: sequence of source files
+        durations: array of durations of `files`
+        defects: function or None
+            If set, offsets are moved out of defects, see `avoid_defects`.
+            Sources are picked as without it.
+    """
+    diffs = np.diff(np.asarray(beats, dtype=np.float64))
+    indices, offsets = sample_slots(durations, diffs, start, end, rng)
+
+    if defects is not None:
+        offsets = avoid_defects(
+            files, indices, offsets, diffs, durations, start, end, defects
+        )
+
+    slots = [
+        make_slot(i, files[index], float(ss), diff, beats[i], process_kwargs)
+        for i, (index, ss, diff) in enumerate(zip(indices, offsets, diffs))
+    ]
+
+    return {
+        'version': TIMELINE_VERSION,
+        'seed': seed,
+        'sources': [str(i) for i in sources],
+        'start': start,
+        'end': end,
+        'duration': float(beats[-1]) if len(beats) else 0.,
+        'avoid_defects': defects is not None,
+        'slots': slots
+    }
+
+
+def reroll_slot(timeline, slot, files, durations, defects=None):
+    """Deterministically pick a new source and offset for `slot`."""
+    slot['attempt'] += 1
+    rng = slot_rng(timeline['seed'], slot['index'], slot['attempt'])
+
+    indices, offsets = sample_slots(
+        durations, [slot['length']], timeline['start'], timeline['end'], rng
+    )
+
+    if defects is not None:
+        offsets = avoid_defects(
+            files, indices, offsets, [slot['length']], durations,
+            timeline['start'], timeline['end'], defects
+        )
+
+    slot['source'] = os.path.abspath(str(files[indices[0]]))
+    slot['ss'] = float(offsets[0])
+
+    return slot
+
+
+def preview_timeline(timeline, process_kwargs, start=0, end=None):
+    """Return the slots of `timeline` that start between `start` and `end`
+    seconds as a timeline of their own, rendered with `process_kwargs`.
+
+    Sources and offsets are kept, so a preview shows the cuts of the full
+    render. Slots are renumbered and moved to start at 0.
+    """
+    slots = timeline['slots']
+    window = [
+        i for i in slots
+        if i['position'] >= start and (end is None or i['position'] < end)
+    ]
+
+    if not window:
+        raise ValueError(f'No slots between {start} and {end}')
+
+    first, last = window[0], window[-1]
+    window_start = first['position']
+    window_end = (
+        slots[last['index'] + 1]['position']
+        if last['index'] < len(slots) - 1
+        else timeline['duration']
+    )
+
+    preview = []
+    for index, slot in enumerate(window):
+        slot = dict(slot, index=index, position=slot['position'] - window_start)
+        slot['process_kwargs'] = dict(slot['process_kwargs'], **process_kwargs)
+        preview.append(slot)
+
+    return dict(
+        timeline,
+        duration=window_end - window_start,
+        slots=preview,
+        preview={'start': window_start, 'end': window_end}
+    )
+
+
+def slot_key(slot):
+    """Hash of everything that affects the rendered output of `slot`."""
+    data = json.dumps(
+        [slot['source'], slot['ss'], slot['length'], slot['process_kwargs']],
+        sort_keys=True
+    )
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def make_jobs(timeline, engine, batch_size=1):
+    """Group slots of the timeline into render jobs.
+
+    Slots are grouped by index, so that dropping a slot does not change the
+    other jobs.
+    """
+    jobs = {}
+
+    for slot in timeline['slots']:
+        if slot['length'] > 0:
+            jobs.setdefault(slot['index'] // batch_size, []).append(slot)
+
+    return [
+        {'index': slots[0]['index'], 'engine': engine, 'slots': slots}
+        for _, slots in sorted(jobs.items())
+    ]
+
+
+def job_key(job):
+    data = json.dumps([job['engine'], [slot_key(i) for i in job['slots']]])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def save_timeline(timeline, path):
+    path = Path(path)
+    tmp = path.with_suffix('.tmp')
+
+    with open(str(tmp), 'w', encoding='utf-8') as file:
+        json.dump(timeline, file, ensure_ascii=False, indent=1)
+
+    os.replace(str(tmp), str(path))
+
+
+def load_timeline(path):
+    with open(str(path), 'r', encoding='utf-8') as file:
+        timeline = json.load(file)
+
+    if timeline.get('version') != TIMELINE_VERSION:
+        raise ValueError(f'Unsupported timeline version in {path}')
+
+    return timeline
+
+
+class Journal:
+    """Append-only record of rendered jobs, used to resume and re-render."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if self.path.exists():
+            with open(str(self.path), 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of a killed job can be truncated
+                        continue
+                    self.entries[entry['index']] = entry
+
+    def get(self, job):
+        """Return render entry of `job` if it matches its current state."""
+        entry = self.entries.get(job['index'])
+
+        if entry is None or entry['key'] != job_key(job):
+            return None
+
+        return entry
+
+    def add(self, job, output, duration):
+        entry = {
+            'index': job['index'],
+            'key': job_key(job),
+            'output': str(output),
+            'duration': duration
+        }
+
+        with self.lock:
+            with open(str(self.path), 'a', encoding='utf-8') as file:
+                file.write(json.dumps(entry, ensure_ascii=False))
+                file.write('\n')
+
+            self.entries[job['index']] = entry
+
+        return entry
@@ -0,0 +1,231 @@
+"""Tracing of subprocess calls and pipeline stages.
+
+Spans are recorded by the active tracer, see `activate`, and exported as
+Chrome trace JSON, which opens in chrome://tracing and ui.perfetto.dev.
+The tracer is active in the current context only, so concurrent jobs of a
+server trace separately. Functions run by other threads take it along with
+`bind`.
+"""
+
+import os
+import json
+import time
+import signal
+import logging
+import functools
+import threading
+import contextlib
+import contextvars
+import subprocess
+
+from collections import defaultdict
+
+logging.basicConfig(level=logging.INFO)
+
+TRACE_FILENAME = 'trace.json'
+TRACE_SUMMARY_FILENAME = 'trace_summary.json'
+
+# Bytes per block of rusage ru_oublock
+BLOCK_SIZE = 512
+
+_TRACER = contextvars.ContextVar('tracer', default=None)
+
+
+def activate(tracer):
+    """Make `tracer` record spans of the current context, or stop tracing if
+    it is None."""
+    _TRACER.set(tracer)
+
+
+def get_tracer():
+    return _TRACER.get()
+
+
+def bind(function):
+    """Return `function` running in a copy of the current context, i.e. with
+    the tracer and backend active now, also when called by another thread,
+    e.g. of a pool."""
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def bound(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(function, *args, **kwargs)
+
+    return bound
+
+
+def _now():
+    return time.perf_counter() * 1e6
+
+
+class Tracer:
+    """Collects completed spans of all threads."""
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name, cat, start, duration, args):
+        with self.lock:
+            self.events.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': start,
+                'dur': duration,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args
+            })
+
+    def export(self, filename):
+        """Write spans in Chrome trace event format."""
+        with self.lock:
+            events = list(self.events)
+
+        with open(str(filename), 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents': events}, file)
+
+    def summary(self):
+        """Aggregate spans by category and name."""
+        with self.lock:
+            events = list(self.events)
+
+        summary = defaultdict(lambda: {
+            'count': 0, 'wall': 0., 'cpu': 0., 'max_rss': 0,
+            'write_bytes': 0, 'errors': 0
+        })
+
+        for event in events:
+            args = event['args']
+            item = summary[f'{event["cat"]}:{event["name"]}']
+            item['count'] += 1
+            item['wall'] += event['dur'] / 1e6
+            item['cpu'] += args.get('utime', 0) + args.get('stime', 0)
+            item['max_rss'] = max(item['max_rss'], args.get('max_rss', 0))
+            item['write_bytes'] += args.get('write_bytes', 0)
+            item['errors'] += int(args.get('exit_code', 0) != 0)
+
+        return dict(sorted(
+            summary.items(), key=lambda x: x[1]['wall'], reverse=True
+        ))
+
+    def write_summary(self, filename):
+        summary = self.summary()
+
+        with open(str(filename), 'w', encoding='utf-8') as file:
+            json.dump(summary, file, indent=1)
+
+        for name, item in list(summary.items())[:10]:
+            logging.info(
+                f'TRACE: {name} count={item["count"]} wall={item["wall"]:.2f}s '
+                f'cpu={item["cpu"]:.2f}s max_rss={item["max_rss"] >> 20}MB'
+            )
+
+        return summary
+
+
+@contextlib.contextmanager
+def span(name, cat='stage', **args):
+    """Record wall time of the enclosed block.
+
+    The yielded dict can be updated with more span arguments.
+    """
+    tracer = get_tracer()
+
+    if tracer is None:
+        yield args
+        return
+
+    start = _now()
+    try:
+        yield args
+    finally:
+        tracer.add(name, cat, start, _now() - start, args)
+
+
+def _command_name(cmd):
+    name = os.path.basename(cmd.split()[0]) if cmd.strip() else 'cmd'
+    return name.replace('.exe', '')
+
+
+def _usage_args(usage):
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        'utime': usage.ru_utime,
+        'stime': usage.ru_stime,
+        'max_rss': usage.ru_maxrss * 1024,
+        'write_bytes': usage.ru_oublock * BLOCK_SIZE,
+        'read_bytes': usage.ru_inblock * BLOCK_SIZE
+    }
+
+
+def run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=None):
+    """Run shell command `cmd`, read its output and trace it.
+
+    CPU time, peak RSS and bytes written by the command are taken from the
+    rusage of the reaped process.
+
+    Returns:
+        (exit code, output bytes)
+
+    Raises:
+        subprocess.TimeoutExpired: the command was killed after `timeout`.
+    """
+    with span(_command_name(cmd), cat='cmd', cmd=cmd) as args:
+        if not hasattr(os, 'wait4'):
+            proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, shell=True)
+            out, _ = proc.communicate(timeout=timeout)
+            args['exit_code'] = proc.returncode
+            return proc.returncode, out or b''
+
+        # The shell does not always exec the command, so a command with a
+        # timeout gets its own process group that is killed as a whole
+        proc = subprocess.Popen(
+            cmd, stdout=stdout, stderr=stderr, shell=True,
+            start_new_session=timeout is not None
+        )
+
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+
+        try:
+            out = proc.stdout.read() if proc.stdout is not None else b''
+            _, status, usage = os.wait4(proc.pid, 0)
+        except BaseException:
+            if timeout is not None:
+                kill()
+                proc.wait()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if proc.stdout is not None:
+                proc.stdout.close()
+
+        proc.returncode = (
+            -os.WTERMSIG(status) if os.WIFSIGNALED(status)
+            else os.WEXITSTATUS(status)
+        )
+
+        args.update(_usage_args(usage))
+        args['exit_code'] = proc.returncode
+        args['output_bytes'] = len(out)
+
+        if killed.is_set():
+            args['timeout'] = True
+            raise subprocess.TimeoutExpired(cmd, timeout, output=out)
+
+    return proc.returncode, out
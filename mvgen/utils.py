@@ -4,12 +4,34 @@ import re
 import os
 import subprocess
 import logging
+import threading
+import contextlib
 import unidecode
 
 from mvgen import commands as cs
+from mvgen import probe
+from mvgen import tracing
 
 logging.basicConfig(level=logging.INFO)
 
+_CMD_SLOTS = None
+
+
+class RenderError(ValueError):
+    """Rendered output is missing or empty, e.g. because of a broken source."""
+
+
+def set_cmd_limit(limit):
+    """Limit number of `runcmd` processes running at once in this process."""
+    global _CMD_SLOTS
+    _CMD_SLOTS = threading.BoundedSemaphore(limit) if limit else None
+
+
+def cmd_slot():
+    if _CMD_SLOTS is None:
+        return contextlib.nullcontext()
+    return _CMD_SLOTS
+
 
 def natural_keys(text):
     return [
@@ -23,10 +45,14 @@ def mkdir(path):
         path.mkdir(parents=True, exist_ok=True)
 
 
-def get_duration(filename, raise_error=False):
-    cmd = cs.get_duration(filename)
-    duration = os.popen(cmd)
-    duration = duration.read().strip('\n')
+def get_duration(filename, raise_error=False, use_cache=True):
+    cache = probe.get_cache() if use_cache else None
+
+    if cache is not None:
+        duration = cache.get(filename)['duration']
+    else:
+        duration = probe.probe_file(filename)['duration']
+
     try:
         return float(duration)
     except Exception:
@@ -35,55 +61,70 @@ def get_duration(filename, raise_error=False):
         return 0.
 
 
-def get_bitrate(filename):
-    cmd = cs.get_bitrate(filename)
-    duration = os.popen(cmd)
-    duration = duration.read().strip('\n')
+def get_bitrate(filename, use_cache=True):
+    cache = probe.get_cache() if use_cache else None
+
+    if cache is not None:
+        bitrate = cache.get(filename)['bitrate']
+    else:
+        bitrate = probe.probe_file(filename)['bitrate']
+
     try:
-        return float(duration)
+        return float(bitrate)
     except Exception:
         return 0.
 
 
+def get_streams(filename, stream_type=None, use_cache=True):
+    """Return stream info dicts of `filename`, optionally of one type ("v", "a")."""
+    cache = probe.get_cache() if use_cache else None
+
+    if cache is not None:
+        streams = cache.get(filename)['streams']
+    else:
+        streams = probe.probe_file(filename)['streams']
+
+    if stream_type is not None:
+        codec_type = probe.STREAM_TYPES.get(stream_type[0], stream_type)
+        streams = [s for s in streams if s.get('codec_type') == codec_type]
+
+    return streams
+
+
+def read_output(cmd):
+    """Run `cmd` and return its stdout as text."""
+    _, out = tracing.run(cmd, stderr=None)
+    return out.decode('utf-8', errors='replace')
+
 
 def runcmd(cmd, raise_error=False, timeout=None):
     logging.debug(cmd)
 
-    log = os.devnull
-    with open(log, 'a') as stdout:
-        res = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True
-        )
-
+    with cmd_slot():
         try:
-            out, err = res.communicate(timeout=timeout)
+            returncode, out = tracing.run(cmd, timeout=timeout)
         except Exception as e:
             if raise_error:
                 raise e
-            out = str(e).encode('utf-8')
+            returncode, out = -1, str(e).encode('utf-8')
 
-        if res.returncode != 0:
+        if returncode != 0:
             logging.error(f'CMD ERROR: {cmd}')
-            logging.error(out.decode('utf-8'))
+            logging.error(out.decode('utf-8', errors='replace'))
 
             if raise_error:
-                raise ValueError(out.decode('utf-8'))
+                raise ValueError(out.decode('utf-8', errors='replace'))
 
-    return res.returncode
+    return returncode
 
 
 def checkcmd(cmd):
-    log = os.devnull
-    with open(log, 'a') as stdout:
-        res = subprocess.Popen(
-            cmd, stdout=stdout, stderr=subprocess.STDOUT, shell=True
-        )
-        res.communicate()
-
-    if res.returncode != 0:
+    returncode, _ = tracing.run(cmd, stdout=subprocess.DEVNULL)
+
+    if returncode != 0:
         logging.error(cmd)
 
-    return res.returncode
+    return returncode
 
 
 def modify_filename(filename, prefix=None, suffix=None):
@@ -130,8 +171,7 @@ def str2sec(s):
 def wslpath(path):
     path = str(path)
     cmd = cs.get_wslpath(path)
-    new_path = os.popen(cmd)
-    new_path = new_path.read().strip('\n')
+    new_path = read_output(cmd).strip('\n')
 
     return new_path
 
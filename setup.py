@@ -27,5 +27,9 @@ setup(
     include_package_data=True,
     python_requires='>=3.6.7',
     install_requires=requirements,
+    extras_require={
+        # In-process media backend, see `mvgen.backends`
+        'pyav': ['av'],
+    },
     # scripts=['scripts/pmvc'],
 )
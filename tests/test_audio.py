@@ -0,0 +1,81 @@
+import numpy as np
+import pywt
+
+from scipy import signal
+
+from mvgen.audio import bpm_detector, bpm_detector_batch, peak_detect
+
+FS = 11025
+
+
+def reference_bpm(data, fs):
+    """BPM of one window as detected before windows were batched."""
+    levels = 4
+    max_decimation = 2 ** (levels - 1)
+    min_ndx = int(np.round(60. / 220 * (fs / max_decimation)))
+    max_ndx = int(np.round(60. / 40 * (fs / max_decimation)))
+
+    cA = data
+    for loop in range(levels):
+        cA, cD = pywt.dwt(cA, 'db4')
+
+        if loop == 0:
+            cD_minlen = int(len(cD) / max_decimation + 1)
+            cD_sum = np.zeros(cD_minlen)
+
+        cD = signal.lfilter([0.01], [1 - 0.99], cD)
+        cD = abs(cD[::(2 ** (levels - loop - 1))])
+        cD = cD - np.mean(cD)
+        cD_sum = cD[0:cD_minlen] + cD_sum
+
+    if not np.any(cA != 0):
+        return np.nan
+
+    cA = signal.lfilter([0.01], [1 - 0.99], cA)
+    cA = abs(cA)
+    cA = cA - np.mean(cA)
+    cD_sum = cA[0:cD_minlen] + cD_sum
+
+    correl = np.correlate(cD_sum, cD_sum, 'full')
+    correl = correl[int(len(correl) / 2):]
+
+    peak_ndx = peak_detect(correl[min_ndx:max_ndx])[0][0] + min_ndx
+
+    return 60. / peak_ndx * (fs / max_decimation)
+
+
+def click_track(bpm, seconds, fs=FS):
+    data = np.zeros(int(seconds * fs) + 200)
+    period = int(round(60. / bpm * fs))
+    for start in range(0, int(seconds * fs), period):
+        data[start:start + 200] = np.sin(np.arange(200) * 0.3)
+    return data[:int(seconds * fs)]
+
+
+def test_batch_matches_reference():
+    rng = np.random.default_rng(0)
+    window = 3 * FS
+
+    windows = np.stack(
+        [click_track(bpm, 3) for bpm in (60, 96, 120, 128, 174)]
+        + [rng.standard_normal(window) for _ in range(3)]
+    )
+
+    expected = [reference_bpm(i, FS) for i in windows]
+
+    np.testing.assert_allclose(bpm_detector_batch(windows, FS), expected)
+
+
+def test_click_tracks_are_detected():
+    for bpm in (120, 128, 174):
+        assert abs(bpm_detector(click_track(bpm, 3), FS) - bpm) < 1
+
+
+def test_silent_windows():
+    windows = np.stack([click_track(120, 3), np.zeros(3 * FS)])
+
+    bpms = bpm_detector_batch(windows, FS)
+
+    assert not np.isnan(bpms[0])
+    assert np.isnan(bpms[1])
+    assert bpm_detector(np.zeros(3 * FS), FS) is None
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pytest
+
+from mvgen.catalog import Catalog
+
+
+def write(path, data=b'data'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def bump(path, seconds=10):
+    # File times are coarse, so quick changes may keep the mtime
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+
+def names(catalog, root):
+    return sorted(os.path.relpath(str(i), str(root)) for i in catalog.files([root]))
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(tmp_path / 'catalog.sqlite')
+    yield catalog
+    catalog.close()
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'sources'
+    write(root / 'a.mp4')
+    write(root / 'sub' / 'b.mp4')
+    write(root / 'sub' / 'deep' / 'c.mp4')
+    write(root / 'empty.mp4', b'')
+    return root
+
+
+def test_rescan_lists_nothing_unchanged(catalog, root):
+    assert catalog.scan(root) == 3
+    assert names(catalog, root) == ['a.mp4', 'sub/b.mp4', 'sub/deep/c.mp4']
+
+    assert catalog.scan(root) == 0
+    assert names(catalog, root) == ['a.mp4', 'sub/b.mp4', 'sub/deep/c.mp4']
+
+
+def test_rescan_lists_changed_directories(catalog, root):
+    catalog.scan(root)
+
+    write(root / 'sub' / 'new.mp4')
+    bump(root / 'sub')
+
+    assert catalog.scan(root) == 1
+    assert names(catalog, root) == [
+        'a.mp4', 'sub/b.mp4', 'sub/deep/c.mp4', 'sub/new.mp4'
+    ]
+
+    os.remove(str(root / 'sub' / 'deep' / 'c.mp4'))
+    os.rmdir(str(root / 'sub' / 'deep'))
+    bump(root / 'sub')
+
+    assert catalog.scan(root) == 1
+    assert names(catalog, root) == ['a.mp4', 'sub/b.mp4', 'sub/new.mp4']
+
+
+def test_full_scan_lists_everything(catalog, root):
+    catalog.scan(root)
+    assert catalog.scan(root, full=True) == 3
+
+
+def test_files_modified_in_place_need_check(catalog, root):
+    catalog.scan(root)
+    catalog.set_durations([(root / 'a.mp4', 5.)])
+
+    write(root / 'a.mp4', b'longer data')
+    bump(root / 'a.mp4')
+
+    catalog.scan(root)
+    _, sizes, durations = catalog.records([root])
+    assert sizes[0] == 4 and durations[0] == 5.
+
+    catalog.scan(root, check_files=True)
+    _, sizes, durations = catalog.records([root])
+    assert sizes[0] == 11 and np.isnan(durations[0])
+
+
+def test_roots_are_separate(catalog, tmp_path):
+    write(tmp_path / 'vid' / 'a.mp4')
+    write(tmp_path / 'vid2' / 'b.mp4')
+
+    catalog.scan(tmp_path / 'vid')
+    catalog.scan(tmp_path / 'vid2')
+
+    assert names(catalog, tmp_path / 'vid') == ['a.mp4']
+    assert names(catalog, tmp_path / 'vid2') == ['b.mp4']
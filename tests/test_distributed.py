@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from mvgen.distributed import MixQueue, Lease, LEASE_SUFFIX
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = MixQueue(tmp_path / 'mix')
+    queue.create()
+    queue.publish({'index': 0, 'key': 'a'})
+    return queue
+
+
+def lease_of(queue, name, token, interval=10):
+    return Lease(queue.leases / (name + LEASE_SUFFIX), token, interval)
+
+
+def test_claim_is_exclusive(queue):
+    token = queue.claim('0')
+
+    assert token is not None
+    assert queue.claim('0') is None
+    assert lease_of(queue, '0', token).held()
+
+
+def test_expired_lease_is_taken_over(queue):
+    token = queue.claim('0')
+    observed = {}
+
+    # First sight of a lease only starts its timeout
+    assert queue.claim('0', timeout=0.1, observed=observed) is None
+    time.sleep(0.2)
+
+    new_token = queue.claim('0', timeout=0.1, observed=observed)
+
+    assert new_token not in (None, token)
+    assert not lease_of(queue, '0', token).held()
+    assert lease_of(queue, '0', new_token).held()
+
+
+def test_heartbeat_keeps_lease(queue):
+    lease = lease_of(queue, '0', queue.claim('0'), interval=0.02)
+    lease.start()
+    observed = {}
+
+    try:
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            assert queue.claim('0', timeout=0.2, observed=observed) is None
+            time.sleep(0.05)
+    finally:
+        lease.release()
+
+    assert not (queue.leases / ('0' + LEASE_SUFFIX)).exists()
+
+
+def test_release_of_lost_lease_keeps_new_lease(queue):
+    old = lease_of(queue, '0', queue.claim('0'))
+    observed = {}
+
+    queue.claim('0', timeout=0, observed=observed)
+    new = lease_of(queue, '0', queue.claim('0', timeout=0, observed=observed))
+
+    old.release()
+
+    assert new.held()
+
+
+def test_results_leave_pending(queue):
+    queue.publish({'index': 1, 'key': 'b'})
+    assert queue.pending() == ['0', '1']
+
+    queue.finish('0', 'a', output='0.mp4', duration=0.5)
+    queue.finish('1', 'b', error=ValueError('broken'))
+
+    assert queue.pending() == []
+    assert queue.results_of('done') == {
+        '0': {'key': 'a', 'output': '0.mp4', 'duration': 0.5}
+    }
+    assert queue.results_of('done', seen={'0'}) == {}
+    assert queue.results_of('failed')['1']['type'] == 'ValueError'
+
+    # Failed jobs are published again, done jobs with the same key are kept
+    queue.publish({'index': 0, 'key': 'a'})
+    queue.publish({'index': 1, 'key': 'b'})
+
+    assert queue.pending() == ['1']
+    assert queue.results_of('failed') == {}
+
+
+def test_cancelled_mix_has_no_pending_jobs(queue):
+    queue.cancel()
+    assert queue.pending() == []
+
+    queue.create()
+    assert queue.pending() == ['0']
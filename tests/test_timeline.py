@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+
+from mvgen.timeline import (
+    plan, make_jobs, job_key, save_timeline, load_timeline, Journal
+)
+
+FILES = ['/sources/a.mp4', '/sources/b.mp4', '/sources/c.mp4']
+DURATIONS = np.array([30., 45., 60.])
+BEATS = np.arange(0, 10.5, 0.5)
+
+
+def make_timeline(seed):
+    return plan(
+        beats=BEATS,
+        sources=['/sources'],
+        files=FILES,
+        durations=DURATIONS,
+        rng=np.random.default_rng(seed),
+        seed=seed,
+        start=0,
+        end=0,
+        process_kwargs={'width': 320, 'height': 180}
+    )
+
+
+def test_plan_depends_only_on_seed():
+    assert make_timeline(1) == make_timeline(1)
+    assert make_timeline(1)['slots'] != make_timeline(2)['slots']
+
+
+def test_plan_covers_beats():
+    timeline = make_timeline(1)
+
+    assert len(timeline['slots']) == len(BEATS) - 1
+    assert timeline['duration'] == BEATS[-1]
+
+    for slot, position, length in zip(timeline['slots'], BEATS, np.diff(BEATS)):
+        assert slot['position'] == position
+        assert slot['length'] == length
+        assert 0 <= slot['ss'] <= DURATIONS[FILES.index(slot['source'])] - length
+
+
+def test_job_key_survives_saving(tmp_path):
+    timeline = make_timeline(1)
+    save_timeline(timeline, tmp_path / 'timeline.json')
+
+    keys = [job_key(i) for i in make_jobs(timeline, 'segment')]
+    loaded = load_timeline(tmp_path / 'timeline.json')
+
+    assert [job_key(i) for i in make_jobs(loaded, 'segment')] == keys
+
+
+def test_job_key_changes_with_output():
+    job = make_jobs(make_timeline(1), 'segment')[0]
+    key = job_key(job)
+
+    assert job_key(dict(job, engine='copy')) != key
+
+    job['slots'][0]['length'] += 0.01
+    assert job_key(job) != key
+
+
+def test_journal_resumes_rendered_jobs(tmp_path):
+    timeline = make_timeline(1)
+    jobs = make_jobs(timeline, 'segment')
+
+    journal = Journal(tmp_path / 'rendered.jsonl')
+    for job in jobs[:3]:
+        journal.add(job, f'{job["index"]}.mp4', 0.5)
+
+    # Last line of a killed job
+    with open(str(tmp_path / 'rendered.jsonl'), 'a', encoding='utf-8') as file:
+        file.write(json.dumps({'index': 3})[:5])
+
+    journal = Journal(tmp_path / 'rendered.jsonl')
+
+    assert [journal.get(i)['output'] for i in jobs[:3]] == ['0.mp4', '1.mp4', '2.mp4']
+    assert journal.get(jobs[3]) is None
+
+    jobs[0]['slots'][0]['length'] -= 0.1
+    assert journal.get(jobs[0]) is None
+
+
+def test_journal_keeps_last_entry(tmp_path):
+    job = make_jobs(make_timeline(1), 'segment')[0]
+
+    journal = Journal(tmp_path / 'rendered.jsonl')
+    journal.add(job, 'old.mp4', 0.5)
+    journal.add(job, 'new.mp4', 0.5)
+
+    assert Journal(tmp_path / 'rendered.jsonl').get(job)['output'] == 'new.mp4'